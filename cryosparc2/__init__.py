@@ -56,8 +56,9 @@ class Plugin(em.Plugin):
                        var_type=VarTypes.FOLDER)
 
         cls._defineVar(CRYOSPARC_PASSWORD, None,
-                       description='The password with which cryoSPARC was installed. This is only required for the use '
-                                   'of the Flexutils plugin and its connection to the 3D flex training protocol.')
+                       description='The password with which cryoSPARC was installed. This is required for the use '
+                                   'of the Flexutils plugin and its connection to the 3D flex training protocol. '
+                                   'If defined, the particles are also imported as .cs files (external jobs).')
         cls._defineVar(CRYOSPARC_USER, None, description='This is the email with which cryoSPARC was installed.')
         cls._defineVar(PYEM_ENV_ACTIVATION,PYEM_ACTIVATION_CMD, description='This is the PYEM conda environment activation command in the scipion.conf. Default to the one defined in contants.py')
 
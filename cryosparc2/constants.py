@@ -43,10 +43,15 @@ CRYOSPARC_USE_SSD = 'CRYOSPARC_USE_SSD'
 CRYOSPARC_MASTER = 'cryosparc_master'
 CRYOSPARC_STANDALONE_INSTALLATION = 'CRYOSPARC_STANDALONE_INSTALLATION'
 CRYOSPARC_DEFAULT_LANE = 'CRYOSPARC_DEFAULT_LANE'
+CRYOSPARC_HARVEST_SYMLINKS = 'CRYOSPARC_HARVEST_SYMLINKS'
 CRYOSPARC_VERSION_FILE = 'version'
 CRYOSPARC_CONFIG_FILE = 'config.sh'
 CRYOSPARC_LICENSE_ID_VARIABLE = 'CRYOSPARC_LICENSE_ID'
 CRYOSPARC_CS2STAR_SCRIPT = 'cs2Start.py'
+STACK_CACHE_DIR = 'scipion_stacks'  # converted stacks shared by the project runs
+STACK_CACHE_INDEX = 'index.json'
+IMPORT_REGISTRY_FILE = 'scipion_imports.json'  # cryoSPARC import jobs by input hash
+PARTICLES_ROWS_DIR = 'scipion_particles'  # particle rows imported by cryoSPARC jobs
 
 
 def getPyemEnvName(version):
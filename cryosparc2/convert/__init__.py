@@ -28,3 +28,4 @@
 from .convert import *
 from .dataimport import *
 from .cs2Start import *
+from .csconvert import *
@@ -30,6 +30,10 @@ import emtable
 import numpy as np
 import os
 import argparse
+import hashlib
+import json
+import weakref
+from concurrent.futures import ProcessPoolExecutor
 import sys
 import logging
 logger = logging.getLogger(__name__)
@@ -37,9 +41,9 @@ logger = logging.getLogger(__name__)
 from emtable.metadata import _guessType
 from pwem.emlib.image import ImageHandler
 import pwem.emlib.metadata as md
-from pwem.objects import (String, Integer, Transform, Particle,
+from pwem.objects import (String, Integer, Transform, Particle, ParticleFlex,
                           Coordinate, Acquisition, CTFModel)
-from pyworkflow.object import ObjectWrap, Float
+from pyworkflow.object import ObjectWrap, Float, Boolean
 import pyworkflow.utils as pwutils
 from pwem.constants import *
 
@@ -66,6 +70,7 @@ def convertCs2Star(argsList):
     out, error = process.communicate()
     logger.info(out.decode())
     logger.error(error.decode())
+    return process.returncode
 
 
 def defineArgs():
@@ -402,6 +407,12 @@ def rowToAlignment(alignmentRow, alignType, pixelSize=1.0):
     inverseTransform = alignType == ALIGN_PROJ
     if alignmentRow.hasAnyColumn(ALIGNMENT_DICT.values()):
         alignment = Transform()
+        # Rows of a whole table (e.g CsRow) can provide the matrix
+        # already computed for all the rows at once
+        getAlignmentMatrix = getattr(alignmentRow, 'getAlignmentMatrix', None)
+        if getAlignmentMatrix is not None:
+            alignment.setMatrix(getAlignmentMatrix(alignType, pixelSize))
+            return alignment
         angles = np.zeros(3)
         shifts = np.zeros(3)
         shifts[0] = alignmentRow.get(RELIONCOLUMNS.rlnOriginXAngst.value, default=0.)/pixelSize
@@ -424,18 +435,11 @@ def rowToAlignment(alignmentRow, alignType, pixelSize=1.0):
 def setCryosparcAttributes(obj, objRow, *labels):
     """ Set an attribute to obj from a label that is not
     basic ones. The new attribute will be named _rlnLabelName
-    and the datatype will be set correctly.
+    and the datatype will be set correctly. The datatype is resolved
+    once per table (see getRowSetter)
     """
-    for label in labels:
-        value = objRow.get(label)
-        valueType = _guessType(value)
-        if valueType is int:
-            value = Integer(value)
-        elif valueType is float:
-            value = Float(value)
-        else:
-            value = String(value)
-        setattr(obj, '_%s' % label, value)
+    getRowSetter(objRow, extraLabels=labels,
+                 guessTypes=True).setAttributes(obj, objRow)
 
 
 def matrixFromGeometry(shifts, angles, inverseTransform):
@@ -455,17 +459,222 @@ def matrixFromGeometry(shifts, angles, inverseTransform):
     return M
 
 
-def convertBinaryFiles(imgSet, outputDir, extension='mrcs', **kwargs):
+def matricesFromGeometry(shifts, angles, inverseTransform):
+    """ Vectorized version of matrixFromGeometry.
+    Params:
+        shifts: (N, 3) array with the shifts in X, Y and Z
+        angles: (N, 3) array with the 3 euler angles (degrees)
+    Return:
+        (N, 4, 4) array with the transformation matrices
+    """
+    shifts = np.asarray(shifts, dtype=np.float64)
+    radAngles = -np.deg2rad(np.asarray(angles, dtype=np.float64))
+    n = len(radAngles)
+
+    def rotZ(a):
+        c, s = np.cos(a), np.sin(a)
+        R = np.zeros((n, 3, 3))
+        R[:, 0, 0], R[:, 0, 1], R[:, 1, 0], R[:, 1, 1] = c, -s, s, c
+        R[:, 2, 2] = 1
+        return R
+
+    def rotY(a):
+        c, s = np.cos(a), np.sin(a)
+        R = np.zeros((n, 3, 3))
+        R[:, 0, 0], R[:, 0, 2], R[:, 2, 0], R[:, 2, 2] = c, s, -s, c
+        R[:, 1, 1] = 1
+        return R
+
+    # Same as euler_matrix(ai, aj, ak, 'szyz')
+    R = rotZ(radAngles[:, 2]) @ rotY(radAngles[:, 1]) @ rotZ(radAngles[:, 0])
+
+    M = np.zeros((n, 4, 4))
+    M[:, 3, 3] = 1
+    if inverseTransform:
+        # inverse of [R | -shifts] is [R^T | R^T * shifts]
+        Rt = np.transpose(R, (0, 2, 1))
+        M[:, :3, :3] = Rt
+        M[:, :3, 3] = np.einsum('nij,nj->ni', Rt, shifts[:, :3])
+    else:
+        M[:, :3, :3] = R
+        M[:, :3, 3] = shifts[:, :3]
+
+    return M
+
+
+def alignmentMatricesFromColumns(columns, size, alignType, pixelSize=1.0):
+    """ Vectorized version of rowToAlignment for a whole table.
+    Params:
+        columns: dictionary with the label as key and the column
+                 values as value
+        size: number of rows
+    Return:
+        (N, 4, 4) array with the transformation matrices
+    """
+    if alignType == ALIGN_3D:
+        raise Exception("3D alignment conversion for Relion not implemented.")
+
+    is2D = alignType == ALIGN_2D
+    inverseTransform = alignType == ALIGN_PROJ
+
+    def column(label):
+        if label in columns:
+            return np.asarray(columns[label], dtype=np.float64)
+        return np.zeros(size)
+
+    angles = np.zeros((size, 3))
+    shifts = np.zeros((size, 3))
+    shifts[:, 0] = column(RELIONCOLUMNS.rlnOriginXAngst.value) / pixelSize
+    shifts[:, 1] = column(RELIONCOLUMNS.rlnOriginYAngst.value) / pixelSize
+    if not is2D:
+        angles[:, 0] = column(RELIONCOLUMNS.rlnAngleRot.value)
+        angles[:, 1] = column(RELIONCOLUMNS.rlnAngleTilt.value)
+        angles[:, 2] = column(RELIONCOLUMNS.rlnAnglePsi.value)
+        shifts[:, 2] = column(RELIONCOLUMNS.rlnOriginZAngst.value) / pixelSize
+    else:
+        angles[:, 2] = - column(RELIONCOLUMNS.rlnAnglePsi.value)
+
+    return matricesFromGeometry(shifts, angles, inverseTransform)
+
+
+def _convertStack(fn, newFn):
+    """ Convert a stack in a worker process. The stack is written with a
+    temporary name, so a partial file is never taken as converted """
+    tmpFn = '%s.%d.tmp.mrc' % (pwutils.removeExt(newFn), os.getpid())
+    ImageHandler().convertStack(fn, tmpFn)
+    os.replace(tmpFn, newFn)
+    return newFn
+
+
+def convertStacks(stacks, numberOfWorkers=1):
+    """ Convert the stacks given as (source, target) pairs. With more than
+    one worker (e.g. the threads of the protocol), the stacks are converted
+    in a process pool """
+    stacks = list(stacks)
+    if len(stacks) == 1 or numberOfWorkers <= 1:
+        for fn, newFn in stacks:
+            _convertStack(fn, newFn)
+            logger.debug("   %s -> %s" % (fn, newFn))
+    elif stacks:
+        numberOfWorkers = min(numberOfWorkers, len(stacks))
+        with ProcessPoolExecutor(max_workers=numberOfWorkers) as executor:
+            sources, targets = zip(*stacks)
+            for fn, newFn in zip(sources, executor.map(_convertStack,
+                                                        sources, targets)):
+                logger.debug("   %s -> %s" % (fn, newFn))
+
+
+class JsonIndex:
+    """ Dictionary stored in a json file that several runs (processes)
+    can read and update """
+    def __init__(self, indexFile):
+        self.indexFile = indexFile
+
+    def read(self):
+        try:
+            with open(self.indexFile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def update(self, entries, removed=()):
+        # Other runs may have updated the index meanwhile
+        index = self.read()
+        index.update(entries)
+        for key in removed:
+            index.pop(key, None)
+        tmpFile = '%s.%d.tmp' % (self.indexFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmpFile, self.indexFile)
+
+
+class StackCache:
+    """ Project-level cache of converted stacks. The stacks are keyed by
+    source path, size, modification time and target format, so a stack is
+    converted only once for all the protocols of the project. The mapping
+    is recorded in an index file (json) inside the cache folder, which the
+    protocols place next to the cryoSPARC project (STACK_CACHE_DIR).
+    The stacks whose source was removed or modified are deleted from the
+    cache (see clean) every time it is used.
+    """
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.index = JsonIndex(os.path.join(cacheDir, STACK_CACHE_INDEX))
+
+    @staticmethod
+    def getKey(fn, extension):
+        fn = os.path.abspath(fn)
+        stat = os.stat(fn)
+        return '%s|%d|%d|%s' % (fn, stat.st_size, stat.st_mtime_ns, extension)
+
+    @classmethod
+    def isStale(cls, key):
+        """ Whether the source of a cache entry was removed or modified """
+        fn, _, _, extension = key.rsplit('|', 3)
+        try:
+            return cls.getKey(fn, extension) != key
+        except OSError:
+            return True
+
+    def clean(self):
+        """ Delete the stacks whose source was removed or modified
+        :returns: the index without those stacks
+        """
+        index = self.index.read()
+        stale = {key: fn for key, fn in index.items() if self.isStale(key)}
+        if stale:
+            self.index.update({}, removed=stale)
+            index = {key: fn for key, fn in index.items() if key not in stale}
+            for fn in set(stale.values()) - set(index.values()):
+                pwutils.cleanPath(fn)
+            logger.debug("StackCache: %d stacks removed" % len(stale))
+        return index
+
+    def getStacks(self, files, extension='mrc', numberOfWorkers=1):
+        """ Return a dictionary with the converted stack of each file,
+        converting the ones that are not in the cache yet """
+        pwutils.makePath(self.cacheDir)
+        index = self.clean()
+        stacksDict = {}
+        missing = {}
+
+        for fn in files:
+            key = self.getKey(fn, extension)
+            cachedFn = index.get(key)
+            if cachedFn is None or not os.path.exists(cachedFn):
+                cachedFn = os.path.join(self.cacheDir, '%s_%s' % (
+                    hashlib.sha1(key.encode()).hexdigest()[:16],
+                    pwutils.replaceBaseExt(fn, extension)))
+                missing[key] = (fn, cachedFn)
+            stacksDict[fn] = cachedFn
+
+        if missing:
+            logger.debug("convertBinaryFiles: %d stacks from the cache, "
+                         "converting %d" % (len(stacksDict) - len(missing),
+                                            len(missing)))
+            convertStacks(missing.values(), numberOfWorkers)
+            self.index.update({key: cachedFn for key, (_, cachedFn)
+                               in missing.items()})
+        return stacksDict
+
+
+def convertBinaryFiles(imgSet, outputDir, extension='mrcs', cacheDir=None,
+                       numberOfWorkers=1, **kwargs):
     """ Convert binary images files to a format read by Cryosparc.
     Params:
         imgSet: input image set to be converted.
         outputDir: where to put the converted file(s)
+        cacheDir: folder of the project stacks cache (see StackCache). If
+            given, converted stacks are reused from there and linked
+            in outputDir.
+        numberOfWorkers: processes used to convert the stacks (e.g. the
+            threads of the protocol).
     Return:
         A dictionary with old-file as key and new-file as value
         If empty, not conversion was done.
     """
     filesDict = {}
-    ih = ImageHandler()
     outputRoot = os.path.join(outputDir, 'input')
     # Get the extension without the dot
     stackFiles = imgSet.getFiles()
@@ -500,13 +709,15 @@ def convertBinaryFiles(imgSet, outputDir, extension='mrcs', **kwargs):
             logger.debug("   %s -> %s" % (newFn, fn))
         return newFn
 
+    stacksToConvert = []
+
     def convertStack(fn):
         """ Convert from a format that is not read by Cryosparc
-        to an spider stack.
+        to an mrc stack. The stacks are converted all together
+        at the end.
         """
         newFn = getUniqueFileName(fn, 'mrc')
-        ih.convertStack(fn, newFn)
-        logger.debug("   %s -> %s" % (fn, newFn))
+        stacksToConvert.append((fn, newFn))
         return newFn
 
     def replaceRoot(fn):
@@ -537,13 +748,24 @@ def convertBinaryFiles(imgSet, outputDir, extension='mrcs', **kwargs):
             newFn = mapFunc(fn)  # convert or link
             filesDict[fn] = newFn  # map new filename
 
+    if stacksToConvert and cacheDir is not None:
+        # Link the stacks converted by this or any previous run
+        cachedStacks = StackCache(cacheDir).getStacks(
+            [fn for fn, _ in stacksToConvert], 'mrc', numberOfWorkers)
+        for fn, newFn in stacksToConvert:
+            pwutils.createAbsLink(cachedStacks[fn], newFn)
+            logger.debug("   %s -> %s" % (newFn, cachedStacks[fn]))
+    elif stacksToConvert:
+        convertStacks(stacksToConvert, numberOfWorkers)
+
     return filesDict
 
 
-def writeSetOfParticles(imgSet, fileName, extraPath):
+def writeSetOfParticles(imgSet, fileName, extraPath, **kwargs):
     args = {'outputDir': extraPath,
             'fillMagnification': True,
             'fillRandomSubset': True}
+    args.update(kwargs)
     # try:
     #     logger.info('Trying to generate the star file with Relion convert...')
     #     from relion import convert
@@ -563,8 +785,33 @@ def writeSetOfParticles(imgSet, fileName, extraPath):
 
 def cryosPARCwriteSetOfParticles(imgSet, starFile, outputDir, **kwargs):
     if outputDir is not None:
-        filesDict = convertBinaryFiles(imgSet, outputDir)
+        filesDict = convertBinaryFiles(imgSet, outputDir,
+                                       cacheDir=kwargs.pop('cacheDir', None),
+                                       numberOfWorkers=kwargs.pop('numberOfWorkers', 1))
         kwargs['filesDict'] = filesDict
+
+    blockName = kwargs.get('blockName', 'particles')
+    columns = particlesToStarColumns(imgSet, **kwargs)
+    if columns is None:
+        _writeParticlesRows(imgSet, starFile, **kwargs)
+        return
+
+    size = len(next(iter(columns.values())))
+    if kwargs.get('fillMagnification', False):
+        pixelSize = imgSet.getSamplingRate()
+        mag = imgSet.getAcquisition().getMagnification()
+        detectorPxSize = mag * pixelSize / 10000
+
+        columns[md.label2Str(md.RLN_CTF_MAGNIFICATION)] = [mag] * size
+        columns[md.label2Str(md.RLN_CTF_DETECTOR_PIXEL_SIZE)] = [detectorPxSize] * size
+    else:
+        columns.pop(md.label2Str(md.RLN_CTF_MAGNIFICATION), None)
+
+    writeStarColumns(starFile, columns, blockName)
+
+
+def _writeParticlesRows(imgSet, starFile, **kwargs):
+    """ Write the particles STAR file row by row (see particleToRow) """
     partMd = md.MetaData()
     setOfImagesToMd(imgSet, partMd, particleToRow, **kwargs)
 
@@ -585,6 +832,247 @@ def cryosPARCwriteSetOfParticles(imgSet, starFile, outputDir, **kwargs):
     partMd.write('%s@%s' % (blockName, starFile))
 
 
+def _labelName(label):
+    return label if isinstance(label, str) else md.label2Str(label)
+
+
+def _setObjectColumns(obj, row, attrDict, extraLabels):
+    """ Same values as objectToRow, in a dictionary row """
+    row[RELIONCOLUMNS.rlnEnabled.value] = obj.isEnabled()
+    for attr, label in attrDict.items():
+        if hasattr(obj, attr):
+            valueType = md.label2Python(label)
+            row[label] = valueType(getattr(obj, attr).get())
+    attrLabels = attrDict.values()
+    for label in extraLabels:
+        attrName = '_' + label
+        if label not in attrLabels and hasattr(obj, attrName):
+            row[label] = obj.getAttributeValue(attrName)
+
+
+def geometriesFromMatrices(matrices, inverseTransform):
+    """ Vectorized version of geometryFromMatrix. The operations are the
+    same, so the values are identical to the ones of geometryFromMatrix.
+    Params:
+        matrices: (N, 4, 4) array with the transformation matrices
+    Return:
+        (N, 3) arrays with the shifts and the 3 euler angles (degrees)
+    """
+    matrices = np.asarray(matrices, dtype=np.float64)
+    if inverseTransform:
+        matrices = np.linalg.inv(matrices)
+        shifts = -matrices[:, :3, 3]
+    else:
+        shifts = matrices[:, :3, 3].copy()
+
+    # euler_from_matrix(matrix, axes='szyz')
+    m = matrices
+    sy = np.sqrt(m[:, 2, 1] * m[:, 2, 1] + m[:, 2, 0] * m[:, 2, 0])
+    regular = sy > np.finfo(float).eps * 4.0
+    ax = np.where(regular, np.arctan2(m[:, 2, 1], m[:, 2, 0]),
+                  np.arctan2(-m[:, 1, 0], m[:, 1, 1]))
+    ay = np.arctan2(sy, m[:, 2, 2])
+    az = np.where(regular, np.arctan2(m[:, 1, 2], -m[:, 0, 2]), 0.0)
+    angles = -np.rad2deg(-np.stack([ax, ay, az], axis=1))
+    return shifts, angles
+
+
+def particlesToStarColumns(imgSet, **kwargs):
+    """
+    Columns of the particles STAR table, with the same labels and values
+    that particleToRow writes, extracted in one pass over the set. The
+    alignment is converted for all the particles at once.
+    Accepts the same keyword arguments as setOfImagesToMd.
+    :return: a dictionary with the label as key and the list of values as
+             value, or None if the particles must be written row by row
+             (row hooks other than addRandomSubset, particles with
+             different labels...)
+    """
+    postprocessImageRow = kwargs.get('postprocessImageRow')
+    if (kwargs.get('preprocessImageRow') is not None or
+            postprocessImageRow not in (None, addRandomSubset)):
+        return None
+
+    alignType = kwargs.get('alignType', imgSet.getAlignment())
+    if alignType == ALIGN_3D:
+        return None
+    filesDict = kwargs.get('filesDict', {})
+    fillRandomSubset = kwargs.get('fillRandomSubset')
+    writeCtf = kwargs.get('writeCtf', True)
+    writeAcquisition = kwargs.get('writeAcquisition', True)
+    imageExtraLabels = IMAGE_EXTRA_LABELS + kwargs.get('extraLabels', [])
+    imageLabel = RELIONCOLUMNS.rlnImageName.value
+    micNameLabel = RELIONCOLUMNS.rlnMicrographName.value
+    randomSubsetLabel = _labelName(md.RLN_PARTICLE_RANDOM_SUBSET)
+    if alignType == ALIGN_2D:
+        alignLabels = [RELIONCOLUMNS.rlnOriginX.value, RELIONCOLUMNS.rlnOriginY.value,
+                       RELIONCOLUMNS.rlnAnglePsi.value]
+    else:
+        alignLabels = [RELIONCOLUMNS.rlnOriginX.value, RELIONCOLUMNS.rlnOriginY.value,
+                       RELIONCOLUMNS.rlnOriginZ.value, RELIONCOLUMNS.rlnAngleRot.value,
+                       RELIONCOLUMNS.rlnAngleTilt.value, RELIONCOLUMNS.rlnAnglePsi.value]
+
+    columns = None
+    matrices = []
+    for part in imgSet:
+        row = {}
+        # particleToRow
+        coord = part.getCoordinate()
+        if coord is not None:
+            _setObjectColumns(coord, row, COOR_DICT, COOR_EXTRA_LABELS)
+            if coord.getMicName():
+                row[micNameLabel] = str(coord.getMicName().replace(" ", ""))
+            elif coord.getMicId():
+                row[micNameLabel] = str(coord.getMicId())
+        if part.hasMicId():
+            row[RELIONCOLUMNS.rlnMicrographId.value] = int(part.getMicId())
+            if micNameLabel not in row:
+                row[micNameLabel] = 'fake_micrograph_%06d.mrc' % part.getMicId()
+        if part.hasAttribute('_rlnParticleId'):
+            row[_labelName(md.RLN_PARTICLE_ID)] = int(part._rlnParticleId.get())
+        if fillRandomSubset and part.hasAttribute('_rlnRandomSubset'):
+            row[randomSubsetLabel] = int(part._rlnRandomSubset.get())
+            if part.hasAttribute('_rlnBeamTiltX'):
+                row['rlnBeamTiltX'] = float(part._rlnBeamTiltX.get())
+                row['rlnBeamTiltY'] = float(part._rlnBeamTiltY.get())
+
+        # imageToRow
+        row[RELIONCOLUMNS.rlnImageId.value] = int(part.getObjId())
+        index, fn = part.getLocation()
+        row[imageLabel] = locationToCryosparc(index, filesDict.get(fn, fn))
+        if writeCtf and part.hasCTF():
+            ctfModel = part.getCTF()
+            phaseShift = ctfModel.getPhaseShift()
+            if phaseShift is not None:
+                row[RELIONCOLUMNS.rlnPhaseShift.value] = phaseShift
+            _setObjectColumns(ctfModel, row, CTF_DICT, CTF_EXTRA_LABELS)
+        if alignType != ALIGN_NONE and part.hasTransform():
+            # Computed for all the particles at the end
+            matrices.append(part.getTransform().getMatrix())
+            for label in alignLabels:
+                row[label] = None
+        if writeAcquisition and part.hasAcquisition():
+            _setObjectColumns(part.getAcquisition(), row, ACQUISITION_DICT, [])
+        _setObjectColumns(part, row, {}, imageExtraLabels)
+        if postprocessImageRow is not None:
+            row[randomSubsetLabel] = int(1 + (part.getObjId() % 2))
+
+        if columns is None:
+            columns = {label: [] for label in row}
+        elif row.keys() != columns.keys():
+            return None
+        for label, value in row.items():
+            columns[label].append(value)
+
+    if columns is None or any(md.str2Label(label) < 0 for label in columns):
+        return None
+
+    if matrices:
+        shifts, angles = geometriesFromMatrices(matrices, alignType == ALIGN_PROJ)
+        if alignType == ALIGN_2D:
+            values = [shifts[:, 0], shifts[:, 1], -(angles[:, 0] + angles[:, 2])]
+        else:
+            values = [shifts[:, 0], shifts[:, 1], shifts[:, 2],
+                      angles[:, 0], angles[:, 1], angles[:, 2]]
+        for label, labelValues in zip(alignLabels, values):
+            column = columns[label]
+            # Values set after the alignment (e.g. extra labels) are kept
+            columns[label] = [v if c is None else c
+                              for c, v in zip(column, labelValues.tolist())]
+    if any(value is None for values in columns.values() for value in values):
+        return None
+    return columns
+
+
+def _formatStarString(value):
+    value = str(value)
+    if value and ' ' not in value and "'" not in value and '"' not in value:
+        return value
+    quote = '"' if "'" in value else "'"
+    return quote + value + quote
+
+
+def _formatStarColumn(label, values):
+    """ Format and values of a STAR column as written by the metadata """
+    labelType = md.labelType(md.str2Label(label))
+    if labelType == md.LABEL_DOUBLE:
+        values = np.asarray(values, dtype=np.float64)
+        absValues = np.abs(values)
+        scientific = np.isnan(values) | ((absValues > 0) & (absValues < 0.001))
+        if not scientific.any():
+            return '%12.6f', values.tolist()
+        # NaN are written as the minimum double
+        values = np.where(np.isnan(values), np.finfo(np.float64).tiny, values)
+        return '%s', [('%12.6e' if sci else '%12.6f') % v
+                      for sci, v in zip(scientific.tolist(), values.tolist())]
+    if labelType in (md.LABEL_INT, md.LABEL_SIZET):
+        return '%20d', [int(v) for v in values]
+    if labelType == md.LABEL_BOOL:
+        return '%d', [int(bool(v)) for v in values]
+    return '%s', [_formatStarString(v) for v in values]
+
+
+def writeStarColumns(starFile, columns, blockName='particles'):
+    """
+    Write a STAR table from its columns (see particlesToStarColumns) in
+    the same format as the metadata (md.MetaData.write): columns sorted
+    by label and the values formatted by label type.
+    :param columns: dictionary with the label as key and the list of
+                    values as value
+    """
+    labels = sorted(columns, key=md.str2Label)
+    formats, values = zip(*[_formatStarColumn(label, columns[label])
+                            for label in labels])
+    rowFormat = ' '.join(formats) + ' \n'
+
+    with open(starFile, 'w') as f:
+        f.write('# XMIPP_STAR_1 * \n# \ndata_%s\nloop_\n' % blockName)
+        f.write(''.join(' _%s\n' % label for label in labels))
+        f.writelines(rowFormat % row for row in zip(*values))
+
+
+def _rowHash(row):
+    return int.from_bytes(hashlib.blake2b(row.encode(), digest_size=8).digest(),
+                          'little')
+
+
+def readStarRowHashes(starFile, strip=''):
+    """
+    Identify the rows of a STAR file (a single table, as written by
+    writeSetOfParticles) by a 64 bits hash of their content, so the same
+    particle (image, CTF and alignment) can be found in other STAR files
+    :param starFile: STAR file path
+    :param strip: path removed from the rows (e.g. the run folder)
+    :return: a hash of the header (block and columns) and an uint64 array
+             with the hash of each row, in the file order
+    """
+    header = hashlib.sha1()
+    hashes = []
+    with open(starFile) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line[0] in '#_' or line.startswith(('data_', 'loop_')):
+                header.update(('%s\n' % line).encode())
+            else:
+                hashes.append(_rowHash(' '.join(line.replace(strip, '').split())))
+    return header.hexdigest(), np.array(hashes, dtype=np.uint64)
+
+
+def matchRows(sourceHashes, hashes):
+    """
+    Position in sourceHashes of each of the rows of hashes (see
+    readStarRowHashes), or None if any of the rows is not in the source
+    """
+    order = np.argsort(sourceHashes, kind='stable')
+    sortedHashes = sourceHashes[order]
+    positions = np.searchsorted(sortedHashes, hashes)
+    if np.any(positions >= len(sortedHashes)):
+        return None
+    if not np.array_equal(sortedHashes[positions], hashes):
+        return None
+    return order[positions]
+
+
 def rowToCtfModel(ctfRow):
     """ Create a CTFModel from a row of a meta """
     if ctfRow.hasAllColumns(CTF_DICT.values()):
@@ -612,6 +1100,89 @@ def setPsdFiles(ctfModel, ctfRow):
             setattr(ctfModel, attr, String(ctfRow.get(label)))
 
 
+# Scipion type of the Python values, as ObjectWrap does
+_WRAP_TYPES = {int: Integer, bool: Boolean, float: Float, str: String}
+# Scipion type of the _guessType types, as setCryosparcAttributes does
+_GUESS_TYPES = {int: Integer, float: Float, str: String}
+
+
+def _getValueType(value, guessTypes=False):
+    """ Scipion class that wraps the values of a column, from one of them.
+    With guessTypes, numbers are Integer or Float and the type of
+    the strings is guessed from their content. """
+    valueType = type(value)
+    if not guessTypes:
+        return _WRAP_TYPES.get(valueType, ObjectWrap)
+    if valueType is str:
+        return _GUESS_TYPES[_guessType(value)]
+    if valueType is float:
+        return Float
+    return Integer if valueType in (int, bool) else String
+
+
+class RowSetter:
+    """ Setter of the values of a row as attributes of an object
+    (see rowToObject). The labels present in the table and the Scipion
+    type of their values are resolved once, from the header and the first
+    row, and reused by all the rows of the same table.
+    """
+    def __init__(self, row, attrDict=None, extraLabels=(), guessTypes=False):
+        attrDict = attrDict or {}
+        # (attribute, label, type) of the attrDict labels
+        self._attrs = [(attr, label, _getValueType(row.get(label)))
+                       for attr, label in attrDict.items()]
+        # (attribute, label, type) of the extra labels present in the table
+        attrLabels = set(attrDict.values())
+        self._extraAttrs = [('_' + label, label,
+                             _getValueType(row.get(label), guessTypes))
+                            for label in extraLabels
+                            if label not in attrLabels and row.hasColumn(label)]
+
+    def setAttributes(self, obj, row):
+        for attr, label, valueType in self._attrs:
+            value = row.get(label)
+            objAttr = getattr(obj, attr, None)
+            if objAttr is None:
+                setattr(obj, attr, valueType(value))
+            else:
+                objAttr.set(value)
+
+        for attr, label, valueType in self._extraAttrs:
+            setattr(obj, attr, valueType(row.get(label)))
+
+
+# Row setters of each table: CsTable or emtable row class (one per STAR table)
+_rowSetters = weakref.WeakKeyDictionary()
+
+
+def _getRowTable(row):
+    """ Object that identifies the table of a row and the number of
+    columns of the table, or None if the table is unknown """
+    table = getattr(row, '_table', None)
+    if table is not None:  # CsRow
+        return table, len(table.getColumnNames())
+    fields = getattr(type(row), '_fields', None)
+    if fields is not None:  # emtable Row, the class has the table columns
+        return type(row), len(fields)
+    return None, 0
+
+
+def getRowSetter(row, attrDict=None, extraLabels=(), guessTypes=False):
+    """ RowSetter for the table of a row, created for the first row of the
+    table and reused by the rest of its rows """
+    table, size = _getRowTable(row)
+    if table is None:
+        return RowSetter(row, attrDict, extraLabels, guessTypes)
+    key = (size, tuple(attrDict.items()) if attrDict else (),
+           tuple(extraLabels), guessTypes)
+    tableSetters = _rowSetters.setdefault(table, {})
+    rowSetter = tableSetters.get(key)
+    if rowSetter is None:
+        rowSetter = tableSetters[key] = RowSetter(row, attrDict, extraLabels,
+                                                  guessTypes)
+    return rowSetter
+
+
 def rowToObject(row, obj, attrDict, extraLabels=[]):
     """ This function will convert from a XmippMdRow to an EMObject.
     Params:
@@ -623,19 +1194,7 @@ def rowToObject(row, obj, attrDict, extraLabels=[]):
             as properties with the label name such as: _rlnSomeThing
     """
     obj.setEnabled(row.get(RELIONCOLUMNS.rlnEnabled.value, 1) > 0)
-
-    for attr, label in attrDict.items():
-        value = row.get(label)
-        if not hasattr(obj, attr):
-            setattr(obj, attr, ObjectWrap(value))
-        else:
-            getattr(obj, attr).set(value)
-
-    attrLabels = attrDict.values()
-
-    for label in extraLabels:
-        if label not in attrLabels and row.hasColumn(label):
-            setattr(obj, '_' + label, ObjectWrap(row.get(label)))
+    getRowSetter(row, attrDict, extraLabels).setAttributes(obj, row)
 
 
 def setObjId(obj, mdRow, label=RELIONCOLUMNS.rlnImageId.value):
@@ -745,11 +1304,14 @@ def rowToAcquisition(acquisitionRow):
 
 def readSetOfParticles(filename, partSet, **kwargs):
     """read from Relion image meta
-        filename: The metadata filename where the images are.
+        filename: The metadata filename where the images are or an
+                  iterable of rows (e.g. the rows of a CsTable).
         imgSet: the SetOfParticles that will be populated.
         rowToParticle: this function will be used to convert the row to Object
     """
-    for imgRow in emtable.Table.iterRows(filename):
+    rows = (emtable.Table.iterRows(filename) if isinstance(filename, str)
+            else filename)
+    for imgRow in rows:
         img = rowToParticle(imgRow, **kwargs)
         partSet.append(img)
 
@@ -757,6 +1319,58 @@ def readSetOfParticles(filename, partSet, **kwargs):
     partSet.setAlignment(kwargs['alignType'])
 
 
+def iterItemsById(itemSet, ids, chunkSize=10000):
+    """ Iterate over the items of a set with the given ids, in the order
+    of the ids. If the ids are sorted the set is streamed (merge join),
+    otherwise the items are read (and cloned) by chunks of ids, so only
+    one chunk of items is kept in memory """
+    ids = np.asarray(ids, dtype=np.int64)
+    if not len(ids):
+        return
+    if np.all(ids[1:] >= ids[:-1]):
+        pos = 0
+        for item in itemSet.iterItems(where='id >= %d' % ids[0]):
+            itemId = item.getObjId()
+            while pos < len(ids) and ids[pos] < itemId:
+                pos += 1  # not in the set
+            while pos < len(ids) and ids[pos] == itemId:
+                yield item
+                pos += 1
+            if pos == len(ids):
+                break
+    else:
+        for start in range(0, len(ids), chunkSize):
+            chunk = ids[start:start + chunkSize]
+            where = 'id IN (%s)' % ','.join(map(str, np.unique(chunk).tolist()))
+            items = {item.getObjId(): item.clone()
+                     for item in itemSet.iterItems(where=where)}
+            for itemId in chunk.tolist():
+                if itemId in items:
+                    yield items[itemId]
+
+
+def appendParticlesFlex(partSet, particles, zValues, progName,
+                        commitEvery=100000):
+    """ Append to a SetOfParticlesFlex a copy of the particles with their
+    latent coordinates.
+    The same ParticleFlex is reused for all the particles and the set is
+    committed every commitEvery particles.
+        partSet: the SetOfParticlesFlex that will be populated.
+        particles: the input particles (e.g. a SetOfParticles)
+        zValues: (N, K) array with the latent coordinates of each particle
+        progName: name of the flexibility program
+    """
+    outParticle = ParticleFlex(progName=progName)
+    for i, (particle, zValue) in enumerate(zip(particles, zValues.tolist()), 1):
+        outParticle.copyInfo(particle)
+        outParticle.setObjId(None)
+        outParticle.getFlexInfo().setProgName(progName)
+        outParticle.setZFlex(zValue)
+        partSet.append(outParticle)
+        if i % commitEvery == 0:
+            partSet.write(properties=False)
+
+
 if __name__ == "__main__":
     parser = defineArgs()
     sys.exit(convertCs2Star(parser.parse_args()))
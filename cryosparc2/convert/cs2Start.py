@@ -28,7 +28,9 @@ def cs2Star(args):
 
     if args.input[0].endswith(".cs"):
         log.debug("Detected CryoSPARC 2+ .cs file")
-        cs = np.load(args.input[0], max_header_size=MAX_HEADER_SIZE)
+        # Memory-mapped: only the fields used by pyem are read
+        cs = np.load(args.input[0], mmap_mode='r',
+                     max_header_size=MAX_HEADER_SIZE)
         if args.first10k:
             cs = cs[:10000]
 
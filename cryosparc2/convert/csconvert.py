@@ -0,0 +1,935 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+In-process reader of cryoSPARC particle (.cs) files. The .cs record array is
+mapped to the Relion labels that the particles STAR file written by
+cs2Start.py (pyem) would contain, so the same row callbacks
+(createItemMatrix, rowToAlignment, rowToCtfModel, rowToParticle...) can be
+used without spawning the pyem environment and without an intermediate
+STAR file.
+
+The particles are also written as .cs files (writeSetOfParticlesCs), so
+they can be imported in cryoSPARC without parsing a STAR file.
+"""
+import collections
+import hashlib
+import logging
+import os
+import re
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import numpy.lib.format as npformat
+from pwem.constants import ALIGN_2D, ALIGN_PROJ
+
+from ..constants import RELIONCOLUMNS
+from .convert import (alignmentMatricesFromColumns, convertBinaryFiles,
+                      _rowHash)
+
+# see https://numpy.org/doc/stable/reference/generated/numpy.load.html
+# for an explanation of MAX_HEADER_SIZE
+MAX_HEADER_SIZE = 50000
+CS_CHUNK_SIZE = 100000  # particles per chunk when iterating a .cs file
+
+
+class CsFile:
+    """ Memory-mapped cryoSPARC .cs file (a NPY record array). Nothing is
+    read until a field is used, and the fields are returned as views of
+    the mapped file, so only the requested columns are loaded in memory.
+    """
+    def __init__(self, csFile):
+        self.fileName = csFile
+        with open(csFile, 'rb') as f:
+            version = npformat.read_magic(f)
+            readHeader = (npformat.read_array_header_1_0 if version == (1, 0)
+                          else npformat.read_array_header_2_0)
+            try:
+                shape, fortranOrder, dtype = readHeader(
+                    f, max_header_size=MAX_HEADER_SIZE)
+            except TypeError:  # numpy < 1.24 has not header size limit
+                shape, fortranOrder, dtype = readHeader(f)
+            offset = f.tell()
+        self.dtype = dtype
+        self.shape = shape
+        if shape and shape[0]:
+            self._array = np.memmap(csFile, dtype=dtype, mode='r',
+                                    offset=offset, shape=shape,
+                                    order='F' if fortranOrder else 'C')
+        else:  # an empty file can not be mapped
+            self._array = np.zeros(shape, dtype=dtype)
+
+    def __len__(self):
+        return self.shape[0] if self.shape else 0
+
+    def getNames(self, *prefixes):
+        """ Field names, all of them or those starting with any of the
+        given prefixes (e.g. 'alignments3D/') """
+        names = self.dtype.names
+        if prefixes:
+            names = [n for n in names if n.startswith(prefixes)]
+        return list(names)
+
+    def hasField(self, name):
+        return name in self.dtype.names
+
+    def getField(self, name):
+        """ Values of a field (a view of the mapped file) """
+        return self._array[name]
+
+    def getFields(self, *prefixes):
+        """ Dictionary with the values of the fields, all of them or those
+        starting with any of the given prefixes """
+        return {name: self._array[name] for name in self.getNames(*prefixes)}
+
+    def iterChunks(self, *prefixes, chunkSize=CS_CHUNK_SIZE):
+        """ Iterate over the file by chunks of particles. Each chunk is a
+        dictionary as the ones returned by getFields """
+        names = self.getNames(*prefixes)
+        for start in range(0, len(self), chunkSize):
+            chunk = self._array[start:start + chunkSize]
+            yield {name: chunk[name] for name in names}
+
+
+def loadCsFile(csFile):
+    """ Load a cryoSPARC .cs file as a (memory-mapped) numpy record array """
+    return CsFile(csFile)._array
+
+
+class _Passthrough:
+    """ Passthrough .cs file ready to be joined by particle uid """
+    def __init__(self, passthrough, prefixes=()):
+        self.fileName = passthrough
+        self.csFile = CsFile(passthrough)
+        self.names = [n for n in self.csFile.getNames(*prefixes) if n != 'uid']
+        self.uids = self.csFile.getField('uid')
+        self.order = np.argsort(self.uids, kind='stable')
+
+    def join(self, fields, csFile):
+        """ Add the passthrough fields to the fields of some particles.
+        The particles that are not in the passthrough are removed """
+        names = [n for n in self.names if n not in fields]
+        if not names:
+            return fields
+        pos = np.searchsorted(self.uids, fields['uid'], sorter=self.order)
+        pos = self.order[np.clip(pos, 0, len(self.order) - 1)]
+        found = self.uids[pos] == fields['uid']
+        if not found.all():
+            logger.warning("%d particles of %s are not in %s. They will be "
+                           "removed" % (np.count_nonzero(~found), csFile,
+                                        self.fileName))
+            fields = {name: values[found] for name, values in fields.items()}
+            pos = pos[found]
+        for name in names:
+            fields[name] = self.csFile.getField(name)[pos]
+        return fields
+
+
+def readCsFields(csFile, *passthroughs, prefixes=()):
+    """ Read a .cs file and its passthrough files (if any).
+    The passthrough fields are joined by particle uid, keeping only the
+    particles that are present in all files (as pyem does).
+    :param prefixes: read only the fields starting with these prefixes
+                     (all the fields by default)
+    :returns: a dictionary with the field name as key and the array of
+              values as value
+    """
+    cs = CsFile(csFile)
+    fields = cs.getFields(*prefixes)
+    fields['uid'] = cs.getField('uid')
+
+    for passthrough in passthroughs:
+        fields = _Passthrough(passthrough, prefixes).join(fields, csFile)
+
+    return fields
+
+
+def iterCsFields(csFile, *passthroughs, prefixes=(), chunkSize=CS_CHUNK_SIZE):
+    """ Same as readCsFields, but reading the particles by chunks """
+    cs = CsFile(csFile)
+    passthroughs = [_Passthrough(pt, prefixes) for pt in passthroughs]
+    for fields in cs.iterChunks('uid', *prefixes, chunkSize=chunkSize):
+        for passthrough in passthroughs:
+            fields = passthrough.join(fields, csFile)
+        yield fields
+
+
+# Latent coordinates of each particle in a 3D flex .cs file
+_CS_LATENT_FIELD = re.compile(r'^components_mode_(\d+)/value$')
+
+
+def readCsLatents(csFile):
+    """ Latent coordinates (3D flex) of the particles of a .cs file
+    :returns: a (N, K) float32 array, with the components in mode order
+    """
+    cs = CsFile(csFile)
+    modes = sorted((int(match.group(1)), name) for name in cs.getNames('components_mode_')
+                   for match in [_CS_LATENT_FIELD.match(name)] if match)
+    zValues = np.empty((len(cs), len(modes)), dtype=np.float32)
+    for k, (_, name) in enumerate(modes):
+        zValues[:, k] = cs.getField(name)
+    return zValues
+
+
+def _decode(values):
+    """ Decode an array of cryoSPARC (byte) strings, each different value
+    is decoded only once """
+    uniques, inverse = np.unique(values, return_inverse=True)
+    uniques = [v.decode() if isinstance(v, bytes) else str(v) for v in uniques]
+    return [uniques[i] for i in inverse.ravel()]
+
+
+def _expmap(e):
+    """ Rotation matrices from cryoSPARC rotation vectors (pyem geom.expmap) """
+    theta = np.linalg.norm(e, axis=1)
+    zero = theta == 0
+    w = e / np.where(zero, 1., theta)[:, None]
+    k = np.zeros((len(e), 3, 3))
+    k[:, 0, 1] = w[:, 2]
+    k[:, 0, 2] = -w[:, 1]
+    k[:, 1, 0] = -w[:, 2]
+    k[:, 1, 2] = w[:, 0]
+    k[:, 2, 0] = w[:, 1]
+    k[:, 2, 1] = -w[:, 0]
+    r = (np.eye(3) + np.sin(theta)[:, None, None] * k +
+         (1 - np.cos(theta))[:, None, None] * (k @ k))
+    r[zero] = np.eye(3)
+    return r
+
+
+def _logmap(r):
+    """ cryoSPARC rotation vectors from rotation matrices (inverse of
+    _expmap, pyem geom.logmap) """
+    cosTheta = np.clip((np.trace(r, axis1=1, axis2=2) - 1) / 2, -1, 1)
+    theta = np.arccos(cosTheta)
+    sinTheta = np.sin(theta)
+    # r - r^T = 2 sin(theta) k, with k as in _expmap
+    v = np.stack([r[:, 1, 2] - r[:, 2, 1],
+                  r[:, 2, 0] - r[:, 0, 2],
+                  r[:, 0, 1] - r[:, 1, 0]], axis=1)
+    e = np.zeros((len(r), 3))
+    regular = sinTheta > 1e-6
+    e[regular] = v[regular] * (theta[regular] / (2 * sinTheta[regular]))[:, None]
+
+    # Rotations of ~180 degrees: r = 2 w w^T - I (w up to its sign)
+    halfTurn = ~regular & (cosTheta < 0)
+    if halfTurn.any():
+        wwt = (r[halfTurn] + np.eye(3)) / 2
+        diagonal = np.diagonal(wwt, axis1=1, axis2=2)
+        j = np.argmax(diagonal, axis=1)
+        rows = np.arange(len(j))
+        w = wwt[rows, :, j] / np.sqrt(diagonal[rows, j])[:, None]
+        e[halfTurn] = w * theta[halfTurn, None]
+    return e
+
+
+def _rot2euler(r):
+    """ Decompose rotation matrices into Relion (ZYZ) euler angles in
+    radians, following Relion's Euler_matrix2angles """
+    eps = np.finfo(np.float32).eps
+    absSb = np.sqrt(r[:, 0, 2] ** 2 + r[:, 1, 2] ** 2)
+    cond = absSb > 16 * eps
+
+    gamma = np.arctan2(r[:, 1, 2], -r[:, 0, 2])
+    alpha = np.arctan2(r[:, 2, 1], r[:, 2, 0])
+    sinGamma = np.sin(gamma)
+    signSb = np.where(np.abs(sinGamma) < eps,
+                      np.sign(-r[:, 0, 2] / np.cos(gamma)),
+                      np.where(sinGamma > 0, np.sign(r[:, 1, 2]),
+                               -np.sign(r[:, 1, 2])))
+    beta = np.arctan2(signSb * absSb, r[:, 2, 2])
+
+    # Gimbal lock
+    positive = r[:, 2, 2] > 0
+    alpha = np.where(cond, alpha, 0)
+    beta = np.where(cond, beta, np.where(positive, 0, np.pi))
+    gamma = np.where(cond, gamma,
+                     np.where(positive, np.arctan2(-r[:, 1, 0], r[:, 0, 0]),
+                              np.arctan2(r[:, 1, 0], -r[:, 0, 0])))
+    return np.stack([alpha, beta, gamma], axis=1)
+
+
+def csFieldsToColumns(fields, swapxy=True, inverty=True):
+    """ Map the .cs fields to the Relion labels of the particles table
+    that cs2Start.py writes. Optics values (voltage, Cs, amplitude contrast
+    and pixel size) go to the optics table in that STAR file, so they are
+    not mapped here either.
+    :returns: a dictionary with the Relion label as key and the array of
+              values as value
+    """
+    columns = {}
+
+    if 'blob/idx' in fields and 'blob/path' in fields:
+        columns[RELIONCOLUMNS.rlnImageName.value] = [
+            "%06d@%s" % (index + 1, path) for index, path in
+            zip(fields['blob/idx'].tolist(), _decode(fields['blob/path']))]
+
+    if 'location/center_x_frac' in fields:
+        x = fields['location/center_x_frac'].astype(np.float64)
+        y = fields['location/center_y_frac'].astype(np.float64)
+        shape = fields['location/micrograph_shape']
+        if inverty:
+            y = 1 - y
+        if swapxy:
+            x, y = x * shape[:, 1], y * shape[:, 0]
+        else:
+            x, y = x * shape[:, 0], y * shape[:, 1]
+        columns[RELIONCOLUMNS.rlnCoordinateX.value] = x.astype(int)
+        columns[RELIONCOLUMNS.rlnCoordinateY.value] = y.astype(int)
+    if 'location/micrograph_path' in fields:
+        columns[RELIONCOLUMNS.rlnMicrographName.value] = _decode(
+            fields['location/micrograph_path'])
+
+    if 'ctf/df1_A' in fields:
+        columns[RELIONCOLUMNS.rlnDefocusU.value] = fields['ctf/df1_A']
+        columns[RELIONCOLUMNS.rlnDefocusV.value] = fields['ctf/df2_A']
+        columns[RELIONCOLUMNS.rlnDefocusAngle.value] = np.rad2deg(
+            fields['ctf/df_angle_rad'])
+    if 'ctf/phase_shift_rad' in fields:
+        columns[RELIONCOLUMNS.rlnPhaseShift.value] = np.rad2deg(
+            fields['ctf/phase_shift_rad'])
+
+    for alignment in ['alignments3D', 'alignments2D']:
+        pose = alignment + '/pose'
+        if pose not in fields:
+            continue
+        if alignment == 'alignments3D':
+            angles = np.rad2deg(_rot2euler(_expmap(
+                fields[pose].astype(np.float64))))
+            columns[RELIONCOLUMNS.rlnAngleRot.value] = angles[:, 0]
+            columns[RELIONCOLUMNS.rlnAngleTilt.value] = angles[:, 1]
+            psi = angles[:, 2]
+        else:
+            psi = np.rad2deg(fields[pose].astype(np.float64))
+        # NaN values denote erroneous coordinates
+        nanValues = np.isnan(psi)
+        if nanValues.any():
+            psi[nanValues] = 0
+            logger.warning("WARNING: %d particles contains erroneous "
+                           "coordinates. These coordinates are removed"
+                           % np.count_nonzero(nanValues))
+        columns[RELIONCOLUMNS.rlnAnglePsi.value] = psi
+
+        shift = fields[alignment + '/shift']
+        pixelSize = fields.get('blob/psize_A',
+                               fields.get(alignment + '/psize_A', 1.))
+        columns[RELIONCOLUMNS.rlnOriginXAngst.value] = shift[:, 0] * pixelSize
+        columns[RELIONCOLUMNS.rlnOriginYAngst.value] = shift[:, 1] * pixelSize
+
+        if alignment + '/split' in fields:
+            columns[RELIONCOLUMNS.rlnRandomSubset.value] = fields[alignment + '/split'] + 1
+        if alignment + '/class' in fields:
+            columns[RELIONCOLUMNS.rlnClassNumber.value] = fields[alignment + '/class'] + 1
+        break
+
+    return columns
+
+
+# Fields used by csFieldsToColumns
+CS_FIELDS_PREFIXES = ('uid', 'blob/', 'location/', 'ctf/', 'alignments3D/',
+                      'alignments2D/')
+
+
+class CsTable:
+    """ Particles table read from a cryoSPARC .cs file (and its
+    passthrough files) with the columns named by Relion labels. """
+    def __init__(self, csFile, *passthroughs, **kwargs):
+        fields = readCsFields(csFile, *passthroughs,
+                              prefixes=CS_FIELDS_PREFIXES)
+        self._setFields(fields, **kwargs)
+
+    @classmethod
+    def fromFields(cls, fields, **kwargs):
+        """ Create the table from the .cs fields (see readCsFields) """
+        table = cls.__new__(cls)
+        table._setFields(fields, **kwargs)
+        return table
+
+    def _setFields(self, fields, **kwargs):
+        columns = csFieldsToColumns(fields, **kwargs)
+        self._size = len(next(iter(fields.values()))) if fields else 0
+        self._arrays = columns
+        # Python values, as the ones returned by emtable rows
+        self._columns = {label: values.tolist()
+                         if isinstance(values, np.ndarray) else values
+                         for label, values in columns.items()}
+        self._matrices = {}
+
+    def __len__(self):
+        return self._size
+
+    def getColumnNames(self):
+        return list(self._columns.keys())
+
+    def hasColumn(self, label):
+        return label in self._columns
+
+    def getColumnValues(self, label):
+        return self._columns[label]
+
+    def getAlignmentMatrices(self, alignType, pixelSize=1.0):
+        """ Return the (N, 4, 4) transformation matrices of all rows.
+        They are computed at once and cached by alignment and pixel size """
+        key = (alignType, pixelSize)
+        if key not in self._matrices:
+            self._matrices[key] = alignmentMatricesFromColumns(
+                self._arrays, self._size, alignType, pixelSize)
+        return self._matrices[key]
+
+    def getRow(self, index):
+        return CsRow(self, index)
+
+    def iterRows(self):
+        for index in range(self._size):
+            yield CsRow(self, index)
+
+    __iter__ = iterRows
+
+
+class CsRow:
+    """ Row of a CsTable. It provides the same interface that the
+    emtable rows used by the convert functions. """
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def hasColumn(self, colName):
+        return colName in self._table._columns
+
+    hasLabel = hasColumn
+
+    def hasAnyColumn(self, colNames):
+        return any(self.hasColumn(c) for c in colNames)
+
+    def hasAllColumns(self, colNames):
+        return all(self.hasColumn(c) for c in colNames)
+
+    def get(self, key, default=None):
+        values = self._table._columns.get(key)
+        return default if values is None else values[self._index]
+
+    def getAlignmentMatrix(self, alignType, pixelSize=1.0):
+        return self._table.getAlignmentMatrices(alignType,
+                                                pixelSize)[self._index].copy()
+
+    def set(self, key, value):
+        table = self._table
+        columns = table._columns
+        if key not in columns:
+            columns[key] = [None] * len(table)
+        columns[key][self._index] = value
+        table._arrays[key] = columns[key]
+        table._matrices.clear()
+
+
+def iterCsRows(csFile, *passthroughs):
+    """ Iterate over the particles of a .cs file as rows with
+    Relion labels """
+    return CsTable(csFile, *passthroughs).iterRows()
+
+
+def iterCsTables(csFile, *passthroughs, chunkSize=CS_CHUNK_SIZE, **kwargs):
+    """ Iterate over the particles of a .cs file by chunks, as CsTables of
+    at most chunkSize particles. Only one chunk is kept in memory """
+    total = len(CsFile(csFile))
+    done = 0
+    for fields in iterCsFields(csFile, *passthroughs,
+                               prefixes=CS_FIELDS_PREFIXES,
+                               chunkSize=chunkSize):
+        table = CsTable.fromFields(fields, **kwargs)
+        yield table
+        done = min(done + chunkSize, total)
+        logger.info("%d of %d particles converted from %s"
+                    % (done, total, os.path.basename(csFile)))
+
+
+def iterCsChunkedRows(csFile, *passthroughs, chunkSize=CS_CHUNK_SIZE):
+    """ Iterate over the particles of a .cs file as rows with Relion
+    labels, converting the file by chunks (bounded memory) """
+    for table in iterCsTables(csFile, *passthroughs, chunkSize=chunkSize):
+        yield from table.iterRows()
+
+
+# Prefix that cryoSPARC adds to the name of the imported stacks
+_CS_STACK_PREFIX = re.compile(r'^\d+_')
+
+
+def _stackName(filename):
+    """ Stack base name without extension """
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def readCsLocations(csFile):
+    """ Location of the particles of a .cs file as integer arrays, without
+    converting the file.
+    :returns: the list of stacks (base names, as written by cryoSPARC),
+              the stack id of each particle (position in that list) and the
+              index of each particle (1-based, as in Scipion)
+    """
+    cs = CsFile(csFile)
+    stacks, stackIds = np.unique(cs.getField('blob/path'), return_inverse=True)
+    stacks = [_stackName(stack) for stack in _decode(stacks)]
+    indexes = cs.getField('blob/idx').astype(np.int64) + 1
+    return stacks, stackIds.ravel(), indexes
+
+
+class ParticlesJoin:
+    """ Join of the rows of an output table (STAR or .cs) with the input
+    particles by particle location: the stack (base name, without the
+    prefix that cryoSPARC adds on import) and the index in that stack.
+    The row positions are kept in one array per stack, indexed by the
+    particle index, so any particle is resolved in O(1) no matter the
+    order of the rows or how many particles cryoSPARC has removed.
+
+    Repeated locations (e.g. symmetry expanded particles) are assigned to
+    their rows in order: the n-th item with a location gets the n-th row
+    with that location. If the stacks can not be told apart by name (two
+    stacks with the same base name in different runs), the rows are paired
+    with the items by position, as they were written.
+    """
+    _REPEATED = -2  # position of the locations that have several rows
+
+    def __init__(self, rows, inputSet=None):
+        """
+        :param rows: CsTable or iterable of rows (e.g. emtable rows) with
+                     the rlnImageName column
+        :param inputSet: the input particles, used to detect input stacks
+                         with the same base name
+        """
+        label = RELIONCOLUMNS.rlnImageName.value
+        if isinstance(rows, CsTable):
+            self._getRow = rows.getRow
+            imageNames = rows.getColumnValues(label)
+        else:
+            rows = list(rows)
+            self._getRow = rows.__getitem__
+            imageNames = [row.get(label) for row in rows]
+        self._size = len(imageNames)
+
+        locations = [name.split('@', 1) for name in imageNames]
+        indexes = np.array([int(index) for index, _ in locations], dtype=np.int64)
+        stacks, stackIds = np.unique([fn for _, fn in locations],
+                                     return_inverse=True)
+        stackIds = stackIds.ravel()
+
+        # Row positions grouped by stack
+        order = np.argsort(stackIds, kind='stable')
+        bounds = np.searchsorted(stackIds[order], np.arange(len(stacks) + 1))
+
+        self._stackIds = {}  # stack name -> stack id
+        self._positions = []  # stack id -> row position of each index (or -1)
+        self._repeated = {}  # (stack id, index) -> row positions not used yet
+        importNames = {}  # stack name without the import prefix -> stack id
+        ambiguous = False
+        for stackId, stack in enumerate(stacks.tolist()):
+            name = _stackName(stack)
+            importName = _CS_STACK_PREFIX.sub('', name, count=1)
+            ambiguous |= importNames.setdefault(importName, stackId) != stackId
+            self._stackIds[name] = stackId
+            self._stackIds.setdefault(importName, stackId)
+            self._positions.append(self._indexPositions(
+                stackId, indexes, order[bounds[stackId]:bounds[stackId + 1]]))
+
+        if inputSet is not None:
+            inputNames = [_stackName(fn) for fn in inputSet.getFiles()]
+            ambiguous |= len(set(inputNames)) < len(inputNames)
+
+        self.positional = ambiguous
+        if self.positional:
+            logger.warning("There are particle stacks with the same name. The "
+                           "cryoSPARC output is joined with the input "
+                           "particles by position.")
+        self._nextPosition = 0
+        self._itemStacks = {}  # item file name -> stack id (or None)
+        self.missing = 0
+
+    def _indexPositions(self, stackId, indexes, rowPositions):
+        """ Row position of each particle index of a stack. The indexes with
+        several rows are kept, in order, in self._repeated """
+        stackIndexes = indexes[rowPositions]
+        positions = np.full(stackIndexes.max() + 1, -1, dtype=np.int64)
+        # rowPositions are sorted, so a stable sort keeps the rows in order
+        sorter = np.argsort(stackIndexes, kind='stable')
+        uniqueIndexes, starts, counts = np.unique(
+            stackIndexes[sorter], return_index=True, return_counts=True)
+        positions[uniqueIndexes] = rowPositions[sorter[starts]]
+        for index, start, count in zip(uniqueIndexes[counts > 1].tolist(),
+                                       starts[counts > 1].tolist(),
+                                       counts[counts > 1].tolist()):
+            positions[index] = self._REPEATED
+            self._repeated[(stackId, index)] = collections.deque(
+                rowPositions[sorter[start:start + count]].tolist())
+        return positions
+
+    def __len__(self):
+        return self._size
+
+    def getRowPosition(self, item):
+        """ Position of the row of an item (particle), or -1 if the item
+        is not in the table. The rows of repeated locations are consumed,
+        so each item must be resolved once """
+        if self.positional:
+            position = self._nextPosition
+            self._nextPosition += 1
+            return position if position < self._size else -1
+
+        index, filename = item.getLocation()
+        stackId = self._itemStacks.get(filename, -1)
+        if stackId == -1:
+            stackId = self._stackIds.get(_stackName(filename))
+            self._itemStacks[filename] = stackId
+        if stackId is None:
+            return -1
+        positions = self._positions[stackId]
+        index = index or 1
+        position = int(positions[index]) if index < len(positions) else -1
+        if position == self._REPEATED:
+            rowPositions = self._repeated[(stackId, index)]
+            position = rowPositions.popleft() if rowPositions else -1
+        return position
+
+    def getRow(self, item):
+        """ Row of an item (particle), None if the item is not in the table """
+        position = self.getRowPosition(item)
+        return None if position < 0 else self._getRow(position)
+
+    def updateItemCallback(self, callback):
+        """ Wrap an update callback for copyItems/classifyItems (used with
+        itemDataIterator=None) that receives the row of each item. Items
+        without row are not added to the output set """
+        def updateItem(item, row):
+            row = self.getRow(item)
+            if row is None:
+                if not self.missing:
+                    logger.warning("Particle %s@%s not found in the cryoSPARC "
+                                   "output. The particles that are not in the "
+                                   "output are discarded."
+                                   % (item.getIndex(), item.getFileName()))
+                self.missing += 1
+                item._appendItem = False
+            else:
+                callback(item, row)
+        return updateItem
+
+
+class ParticlesIndex:
+    """ Integer value (e.g. a class or a row position) of the particles,
+    indexed by particle location. The stack names are interned (stack
+    name -> stack id) and each location is packed in a single int64 key
+    (stack id and index), so the index is a pair of sorted integer arrays
+    searched with numpy, no matter how many particles there are.
+    As in ParticlesJoin, the stacks are found by their base name or by
+    their base name without the prefix that cryoSPARC adds on import.
+    """
+    _INDEX_BITS = 32
+
+    def __init__(self):
+        self._stackIds = {}  # stack name -> stack id
+        self._itemStacks = {}  # item file name -> stack id (or -1)
+        self._newKeys = []
+        self._newValues = []
+        self._keys = np.empty(0, dtype=np.int64)
+        self._values = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        self._build()
+        return len(self._keys)
+
+    def _internStack(self, stack):
+        stackId = self._stackIds.setdefault(stack, len(self._stackIds))
+        self._stackIds.setdefault(_CS_STACK_PREFIX.sub('', stack, count=1), stackId)
+        return stackId
+
+    def addParticles(self, stacks, stackIds, indexes, values):
+        """ Add some particles, given as in readCsLocations, with their
+        values (one for all of them or one per particle). If a particle
+        is added twice, the last value is kept """
+        ids = np.array([self._internStack(stack) for stack in stacks],
+                       dtype=np.int64)
+        keys = ((ids[np.asarray(stackIds)] << self._INDEX_BITS) |
+                np.asarray(indexes, dtype=np.int64))
+        self._newKeys.append(keys)
+        self._newValues.append(np.broadcast_to(np.asarray(values, dtype=np.int64),
+                                               keys.shape))
+
+    def addCsFile(self, csFile, values):
+        """ Add the particles of a .cs file """
+        self.addParticles(*readCsLocations(csFile), values)
+
+    def _build(self):
+        if not self._newKeys:
+            return
+        keys = np.concatenate([self._keys] + self._newKeys)
+        values = np.concatenate([self._values] + self._newValues)
+        # The stable sort keeps the insertion order of repeated keys
+        order = np.argsort(keys, kind='stable')
+        keys, values = keys[order], values[order]
+        last = np.append(keys[1:] != keys[:-1], True)
+        self._keys, self._values = keys[last], values[last]
+        self._newKeys, self._newValues = [], []
+
+    def _getStackId(self, filename):
+        stackId = self._itemStacks.get(filename)
+        if stackId is None:
+            stackId = self._stackIds.get(_stackName(filename), -1)
+            self._itemStacks[filename] = stackId
+        return stackId
+
+    def getValues(self, filenames, indexes, default=0):
+        """ Value of several particles given their stack file names and
+        (1-based) indexes. The particles that are not in the index get
+        the default value """
+        self._build()
+        stackIds = np.array([self._getStackId(fn) for fn in filenames],
+                            dtype=np.int64)
+        keys = (stackIds << self._INDEX_BITS) | np.asarray(indexes, dtype=np.int64)
+        values = np.full(len(keys), default, dtype=np.int64)
+        if len(self._keys):
+            pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+            found = (stackIds >= 0) & (self._keys[pos] == keys)
+            values[found] = self._values[pos[found]]
+        return values
+
+    def getValue(self, item, default=0):
+        """ Value of an item (particle), or the default value if the
+        particle is not in the index """
+        self._build()
+        index, filename = item.getLocation()
+        stackId = self._getStackId(filename)
+        if stackId < 0:
+            return default
+        key = (stackId << self._INDEX_BITS) | (index or 1)
+        pos = int(np.searchsorted(self._keys, key))
+        if pos < len(self._keys) and self._keys[pos] == key:
+            return int(self._values[pos])
+        return default
+
+
+class ParticlesClassIndex(ParticlesIndex):
+    """ Class of the particles, indexed by particle location """
+    def getClasses(self, filenames, indexes):
+        """ Class of several particles, 0 for the particles without class """
+        return self.getValues(filenames, indexes)
+
+    def getClass(self, item):
+        """ Class of an item (particle), 0 if the particle has no class """
+        return self.getValue(item)
+
+
+def particlesToCsFields(imgSet, filesDict=None, alignType=None):
+    """
+    Walk a set of particles once into the arrays of the cryoSPARC particle
+    fields (blob, ctf, location and alignments), the inverse of
+    csFieldsToColumns. The alignment is converted for all the particles at
+    once from their transformation matrices.
+    :param filesDict: stacks file mapping (see convertBinaryFiles)
+    :param alignType: alignment to write (the set alignment by default)
+    :return: a dictionary with the field name as key and the array of
+             values as value
+    """
+    filesDict = filesDict or {}
+    if alignType is None:
+        alignType = imgSet.getAlignment()
+    hasCtf = imgSet.hasCTF()
+    hasAlignment = alignType in (ALIGN_2D, ALIGN_PROJ)
+    size = imgSet.getSize()
+
+    stacks = {}
+    stackIds = np.empty(size, dtype=np.int64)
+    indexes = np.empty(size, dtype=np.int64)
+    objIds = np.empty(size, dtype=np.int64)
+    splits = np.full(size, -1, dtype=np.int64)
+    micIds = np.zeros(size, dtype=np.uint64)
+    micNames = [''] * size
+    ctfValues = np.zeros((size, 4)) if hasCtf else None
+    matrices = np.empty((size, 4, 4)) if hasAlignment else None
+
+    n = 0
+    for part in imgSet.iterItems():
+        index, fn = part.getLocation()
+        fn = filesDict.get(fn, fn)
+        stackIds[n] = stacks.setdefault(fn, len(stacks))
+        indexes[n] = index
+        objIds[n] = part.getObjId()
+        if part.hasMicId():
+            micIds[n] = part.getMicId()
+            micNames[n] = 'fake_micrograph_%06d.mrc' % part.getMicId()
+        coord = part.getCoordinate()
+        if coord is not None and coord.getMicName():
+            micNames[n] = coord.getMicName().replace(" ", "")
+        if hasCtf:
+            ctf = part.getCTF()
+            ctfValues[n] = (ctf.getDefocusU(), ctf.getDefocusV(),
+                            ctf.getDefocusAngle(), ctf.getPhaseShift() or 0)
+        if hasAlignment:
+            matrices[n] = part.getTransform().getMatrix()
+        if part.hasAttribute('_rlnRandomSubset'):
+            splits[n] = int(part._rlnRandomSubset.get()) - 1
+        n += 1
+
+    pixelSize = imgSet.getSamplingRate()
+    xdim, ydim, _ = imgSet.getDimensions()
+    paths = np.array([fn.encode() for fn in stacks])
+    fields = {
+        'blob/path': paths[stackIds[:n]],
+        # Scipion indexes start at 1, single images have no index (0)
+        'blob/idx': np.maximum(indexes[:n] - 1, 0).astype(np.uint32),
+        'blob/shape': np.tile(np.array([ydim, xdim], dtype=np.uint32), (n, 1)),
+        'blob/psize_A': np.full(n, pixelSize, dtype=np.float32),
+        'blob/sign': np.full(n, -1, dtype=np.float32),
+    }
+
+    if any(micNames[:n]):
+        fields['location/micrograph_uid'] = micIds[:n]
+        fields['location/micrograph_path'] = np.array(
+            [name.encode() for name in micNames[:n]])
+
+    if hasCtf:
+        acquisition = imgSet.getAcquisition()
+        fields.update({
+            'ctf/type': np.full(n, b'imported'),
+            'ctf/exp_group_id': np.zeros(n, dtype=np.uint32),
+            'ctf/accel_kv': np.full(n, acquisition.getVoltage(), dtype=np.float32),
+            'ctf/cs_mm': np.full(n, acquisition.getSphericalAberration(),
+                                 dtype=np.float32),
+            'ctf/amp_contrast': np.full(n, acquisition.getAmplitudeContrast(),
+                                        dtype=np.float32),
+            'ctf/df1_A': ctfValues[:n, 0].astype(np.float32),
+            'ctf/df2_A': ctfValues[:n, 1].astype(np.float32),
+            'ctf/df_angle_rad': np.deg2rad(ctfValues[:n, 2]).astype(np.float32),
+            'ctf/phase_shift_rad': np.deg2rad(ctfValues[:n, 3]).astype(np.float32),
+            'ctf/scale': np.ones(n, dtype=np.float32),
+        })
+
+    if hasAlignment:
+        matrices = matrices[:n]
+        if alignType == ALIGN_PROJ:
+            # Projection matrices are [R^T | R^T * shifts], with R the
+            # Relion rotation (see matricesFromGeometry)
+            rotations = np.transpose(matrices[:, :3, :3], (0, 2, 1))
+            shifts = np.einsum('nij,nj->ni', rotations, matrices[:, :3, 3])
+            alignment = 'alignments3D'
+            pose = _logmap(rotations)
+            # Same halves as addRandomSubset when the particles have none
+            splits = np.where(splits[:n] < 0, objIds[:n] % 2, splits[:n])
+            fields[alignment + '/split'] = splits.astype(np.uint32)
+        else:
+            shifts = matrices[:, :3, 3]
+            alignment = 'alignments2D'
+            pose = np.arctan2(matrices[:, 1, 0], matrices[:, 0, 0])
+        fields.update({
+            alignment + '/pose': pose.astype(np.float32),
+            alignment + '/shift': shifts[:, :2].astype(np.float32),
+            alignment + '/psize_A': np.full(n, pixelSize, dtype=np.float32),
+            alignment + '/class_posterior': np.ones(n, dtype=np.float32),
+            alignment + '/class': np.zeros(n, dtype=np.uint32),
+        })
+
+    return fields
+
+
+def writeCsFile(csFile, fields, uids=None):
+    """ Write a .cs file (NPY record array) with the given fields. The
+    particles get new random uids, as cryoSPARC does, unless given """
+    size = len(next(iter(fields.values())))
+    if uids is None:
+        uids = np.random.default_rng().integers(
+            0, np.iinfo(np.uint64).max, size, dtype=np.uint64, endpoint=True)
+    fields = dict(uid=np.asarray(uids, dtype=np.uint64), **fields)
+    array = np.empty(size, dtype=[(name, values.dtype, values.shape[1:])
+                                  for name, values in fields.items()])
+    for name, values in fields.items():
+        array[name] = values
+    with open(csFile, 'wb') as f:
+        np.save(f, array)
+
+
+def writeSetOfParticlesCs(imgSet, csFile, outputDir, **kwargs):
+    """ Write the particles as a cryoSPARC .cs file (see
+    particlesToCsFields), the counterpart of cryosPARCwriteSetOfParticles
+    without an intermediate STAR file. The stacks are converted or linked
+    in outputDir. """
+    filesDict = convertBinaryFiles(imgSet, outputDir,
+                                   cacheDir=kwargs.get('cacheDir'),
+                                   numberOfWorkers=kwargs.get('numberOfWorkers', 1))
+    fields = particlesToCsFields(imgSet, filesDict=filesDict,
+                                 alignType=kwargs.get('alignType'))
+    writeCsFile(csFile, fields)
+
+
+def readCsRowHashes(csFile, strip=''):
+    """
+    Identify the rows of a .cs file by a 64 bits hash of their content
+    (all the fields but the uid), like readStarRowHashes. The strings
+    (e.g. the stack paths) are hashed by value, not by their padded bytes.
+    :param strip: path removed from the strings (e.g. the run folder)
+    :return: a hash of the header (field names and types) and an uint64
+             array with the hash of each row, in the file order
+    """
+    cs = CsFile(csFile)
+    size = len(cs)
+    names = [name for name in cs.getNames() if name != 'uid']
+    strings = [name for name in names if cs.dtype[name].kind in 'SUO']
+    header = hashlib.sha1(''.join(
+        '%s\n' % name if name in strings else '%s %s\n' % (name, cs.dtype[name])
+        for name in names).encode())
+
+    values = np.empty(size, dtype=[(name, np.uint64 if name in strings
+                                    else cs.dtype[name]) for name in names])
+    for name in names:
+        if name in strings:
+            uniques, inverse = np.unique(cs.getField(name), return_inverse=True)
+            hashes = np.array([_rowHash(value.replace(strip, ''))
+                               for value in _decode(uniques)], dtype=np.uint64)
+            values[name] = hashes[inverse.ravel()]
+        else:
+            values[name] = cs.getField(name)
+    return header.hexdigest(), _hashRows(values.view(np.uint8).reshape(
+        size, values.dtype.itemsize))
+
+
+def _mix64(hashes):
+    """ murmur3 finalizer: mix the bits of an uint64 array """
+    hashes = hashes ^ (hashes >> np.uint64(33))
+    hashes = hashes * np.uint64(0xff51afd7ed558ccd)
+    hashes = hashes ^ (hashes >> np.uint64(33))
+    hashes = hashes * np.uint64(0xc4ceb9fe1a85ec53)
+    return hashes ^ (hashes >> np.uint64(33))
+
+
+def _hashRows(rowBytes):
+    """ 64 bits hash of each row of a (rows, bytes) uint8 array. The rows
+    are read as 64 bits words and hashed one word column at a time, for
+    all the rows at once """
+    size, width = rowBytes.shape
+    words = np.zeros((size, -(-width // 8) * 8), dtype=np.uint8)
+    words[:, :width] = rowBytes
+    hashes = np.full(size, width, dtype=np.uint64)
+    for column in words.view('<u8').T:
+        hashes = _mix64(hashes ^ column)
+    return hashes
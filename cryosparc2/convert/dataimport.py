@@ -18,6 +18,10 @@ class cryoSPARCImport:
     def __init__(self, protocol, csFile):
         self.protocol = protocol
         self._csFile = csFile
+        # Directory listings and images paths already resolved. Particles
+        # share a few stacks, so the folders are listed once per import
+        self._dirListings = {}
+        self._imagesPaths = {}
         self._createFilenameTemplates()
 
     def _createFilenameTemplates(self):
@@ -154,39 +158,53 @@ class cryoSPARCImport:
                                   % self.outputStarFn)
         return row
 
+    def _listDir(self, path):
+        """ Return the content of a folder (None if it does not exist),
+        listing it only once per import """
+        if path not in self._dirListings:
+            self._dirListings[path] = (os.listdir(path)
+                                       if os.path.exists(path) else None)
+        return self._dirListings[path]
+
     def findImagesFrom(self, referenceFile, searchFile):
         separador = os.path.sep
         dirParticlesPath = os.path.dirname(os.path.abspath(referenceFile))
         dirProject = separador.join(dirParticlesPath.split(separador)[:-1])
         imageName = os.path.basename(searchFile)
         imageFolder = os.path.dirname(searchFile)
-        realdataPath = dirParticlesPath
+        filesPath = dirParticlesPath
+        filesPath2 = os.path.join(dirProject, imageFolder)
+
+        key = (filesPath, filesPath2, imageName)
+        if key not in self._imagesPaths:
+            self._imagesPaths[key] = self._findImagesFrom(filesPath,
+                                                          filesPath2,
+                                                          imageName)
+        return self._imagesPaths[key]
+
+    def _findImagesFrom(self, filesPath, filesPath2, imageName):
+        realdataPath = filesPath
         folderContent = []
 
         # Case in which the binaries associated to the .cs file are in the same
         # folder of the .cs file
-        filesPath = dirParticlesPath
-        if os.path.exists(filesPath):
-            folderContent += os.listdir(filesPath)
+        content = self._listDir(filesPath)
+        if content is not None:
+            folderContent += content
 
         # Case in which the binaries associated to the .cs file are located in
         # the cryoSPARC folders format
-        filesPath2 = os.path.join(dirProject, imageFolder)
-        if os.path.exists(filesPath2):
-            folderContent += os.listdir(filesPath2)
+        content = self._listDir(filesPath2)
+        if content is not None:
+            folderContent += content
             realdataPath = filesPath2
 
-        matchFile = [f for f in folderContent if f.endswith(imageName)]
-        if matchFile:
-            file = os.path.join(realdataPath, matchFile[0])
+        matchFile = next((f for f in folderContent if f.endswith(imageName)),
+                         None)
+        if matchFile is not None:
+            file = os.path.join(realdataPath, matchFile)
             return file
         else:
             raise Exception("The images were expected to be found in one of "
                             "these locations: (%s) or (%s)" % (filesPath,
                                                                filesPath2))
-
-
-
-
-
-
@@ -24,11 +24,13 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import glob
+import hashlib
 import itertools
 import os
-import ast
 import time
 
+import numpy as np
 import requests
 import logging
 logger = logging.getLogger(__name__)
@@ -40,13 +42,19 @@ import pyworkflow.object as pwobj
 import pyworkflow.utils as pwutils
 from pwem.objects import FSC
 
-from ..constants import V3_3_1, excludedFSCValues, fscValues, V4_0_0, V4_1_0, RELIONCOLUMNS
-from ..convert import convertBinaryVol, writeSetOfParticles, ImageHandler
+from ..constants import (V3_3_1, excludedFSCValues, fscValues, V4_0_0, V4_1_0, RELIONCOLUMNS,
+                         STACK_CACHE_DIR, IMPORT_REGISTRY_FILE, PARTICLES_ROWS_DIR)
+from ..convert import (convertBinaryVol, writeSetOfParticles, ImageHandler,
+                       JsonIndex, CsFile, readStarRowHashes, matchRows,
+                       writeSetOfParticlesCs, readCsRowHashes)
 from ..utils import (getProjectPath, createEmptyProject,
                      createEmptyWorkSpace, getProjectName,
                      getCryosparcProjectsDir, createProjectContainerDir,
-                     doImportParticlesStar, doImportVolumes, killJob, clearJob,
-                     get_job_streamlog, getSystemInfo, getJobStatus,
+                     doImportParticlesStar, doImportParticlesCs, canUseCryosparcTools,
+                     doImportVolumes, killJob, clearJob,
+                     JobStreamLog, getSystemInfo, getFilesHash, getJobStatus,
+                     STATUS_COMPLETED, IMPORT_FAILURE_MESSAGE, waitForCryosparcJobs,
+                     getJobOutputGroup, getJobOutputFile, createParticlesSubset,
                      STOP_STATUSES, getCryosparcVersion, getProjectInformation,
                      getCryosparcProjectId, _getLicenceFromFile, doImportMicrographs, getCryosparcProjectsList,
                      getCryosparcWorkSpaces)
@@ -60,6 +68,12 @@ class ProtCryosparcBase(pw.EMProtocol):
     _className = ""
     _fscColumns = 6
     _logLastLine = 0
+    # cryoSPARC output group of the protocol outputs that downstream
+    # cryoSPARC jobs can connect to directly (see _getUpstreamOutput) and
+    # the attribute with the uid of the job that produced them. Only the
+    # outputs that mirror the group 1:1 (not modified after cryoSPARC)
+    _csOutputGroups = {}
+    _csJobAttr = None
 
     def _initializeCryosparcProject(self):
         """
@@ -94,6 +108,7 @@ class ProtCryosparcBase(pw.EMProtocol):
 
         self._store(self)
         self.currenJob = pwobj.String()
+        self.importJobs = pwobj.CsvList()
         self._store(self)
 
     def _initializeUtilsVariables(self):
@@ -106,16 +121,117 @@ class ProtCryosparcBase(pw.EMProtocol):
                                         self.projectDirName)
         self.projectContainerDir = createProjectContainerDir(self.projectPath)[1]
 
+    def _getSharedPath(self, *paths):
+        """ Path to files shared by all the protocols of the Scipion
+        project (next to the cryoSPARC project) """
+        return os.path.join(getCryosparcProjectsDir(),
+                            getProjectName(self.getProject().getShortName()),
+                            *paths)
+
+    def _getStackCacheDir(self):
+        """ Folder where the converted particle stacks are shared by all
+        the protocols of the Scipion project """
+        return self._getSharedPath(STACK_CACHE_DIR)
+
+    def _doImport(self, key, importFunc, what, source=None):
+        """ Reuse the cryoSPARC job that imported the same input before
+        (see IMPORT_REGISTRY_FILE), or import it calling importFunc.
+        The new import jobs are not waited for here, but all together at
+        the end of convertInputStep (see _waitForImports).
+        Params:
+            key: hash of the input files and import parameters
+            importFunc: function that queues the import job (without
+                waiting for it) and returns its uid
+            what: what is imported, for the failure message
+            source: file or folder that cryoSPARC keeps referencing after
+                the import (e.g. the particle stacks, not the STAR file of
+                the run Tmp folder). The job is not reused if it no longer
+                exists.
+        """
+        projectName = self.projectName.get()
+        key = '%s|%s' % (projectName, key)
+        registry = JsonIndex(self._getSharedPath(IMPORT_REGISTRY_FILE))
+        entry = registry.read().get(key)
+
+        if entry is not None and self._importSourceExists(entry['source']):
+            try:
+                if getJobStatus(projectName, entry['job']) == STATUS_COMPLETED:
+                    self.info("Inputs already imported by cryoSPARC job %s, "
+                              "reusing it" % entry['job'])
+                    return pwobj.String(entry['job'])
+            except Exception as e:
+                logger.debug("Can't reuse job %s: %s" % (entry['job'], e))
+
+        importJob = importFunc()
+        self._addImportJob(importJob, what)
+        registry.update({key: {'job': importJob.get(),
+                               'source': source}})
+        return importJob
+
+    @staticmethod
+    def _importSourceExists(source):
+        """ Whether the files referenced by an import job still exist
+        (see the source of _doImport) """
+        return source is None or os.path.exists(source)
+
+    def _getUpstreamOutput(self, pointer):
+        """ Output group ('Jxx.group') of the cryoSPARC job that produced an
+        input, when the input is an unchanged output of another cryoSPARC
+        protocol of the same project (see _csOutputGroups). The job can be
+        connected to it instead of importing the input again. Returns None
+        if the input has to be imported (e.g. it was edited in Scipion)
+        """
+        if pointer is None or not pointer.hasValue() or not pointer.hasExtended():
+            return None
+        upstream = pointer.getObjValue()
+        groupName = getattr(upstream, '_csOutputGroups', {}).get(pointer.getExtended())
+        if (groupName is None or
+                upstream.getAttributeValue('projectName') != self.projectName.get()):
+            return None
+        jobId = upstream.getAttributeValue(upstream._csJobAttr)
+        if not jobId:
+            return None
+        try:
+            group = getJobOutputGroup(self.projectName.get(), jobId, groupName)
+        except Exception as e:
+            logger.debug("Can't get the output %s of job %s: %s" % (groupName, jobId, e))
+            return None
+        output = pointer.get()
+        size = output.getSize() if hasattr(output, 'getSize') else 1
+        # Any particle removed in Scipion makes the group a different input
+        if group is None or group.get('num_items') != size:
+            return None
+        self.info("Connecting the output %s of cryoSPARC job %s (%s)"
+                  % (groupName, jobId, upstream.getObjLabel()))
+        return '%s.%s' % (jobId, groupName)
+
+    def _addImportJob(self, importJob, what):
+        """ Queued import job to wait for in _waitForImports. The queued
+        jobs are stored, so they are killed if the protocol is aborted """
+        self._importJobs[importJob.get()] = IMPORT_FAILURE_MESSAGE % what
+        self.importJobs.set(list(self._importJobs))
+        self._store(self.importJobs)
+
+    def _waitForImports(self):
+        """ Wait for all the import jobs queued by convertInputStep. They
+        are independent, so cryoSPARC runs them at the same time """
+        importJobs, self._importJobs = self._importJobs, {}
+        waitForCryosparcJobs(self.projectName.get(), importJobs)
+        self.importJobs.set([])
+        self._store(self.importJobs)
+
     def convertInputStep(self):
-        """ Create the input file in STAR format as expected by Relion.
-        If the input particles comes from Relion, just link the file.
+        """ Import the inputs in cryoSPARC, or connect them to the outputs
+        of the cryoSPARC jobs that produced them.
         """
+        self._importJobs = {}
         imgSet = self._getInputParticles()
         if imgSet is not None:
-            # Create links to binary files and write the relion .star file
-            writeSetOfParticles(imgSet, self._getFileName('input_particles'),
-                                self._getPath())
-            self._importParticles()
+            upstreamParticles = self._getUpstreamOutput(self._getInputParticlesPointer())
+            if upstreamParticles is not None:
+                self.particles = pwobj.String(upstreamParticles)
+            else:
+                self._importParticles()
 
         volume = self._getInputVolume()
         if volume is not None:
@@ -137,6 +253,7 @@ class ProtCryosparcBase(pw.EMProtocol):
         if micrographs is not None:
             self._importMicrographs()
 
+        self._waitForImports()
         self._store(self)
 
     def _getScaledAveragesFile(self, csAveragesFile, force=False):
@@ -248,20 +365,41 @@ class ProtCryosparcBase(pw.EMProtocol):
     def _importVolume(self):
         vol = self._getInputVolume()
         self._initializeVolumeSuffix()
+        upstreamVolume = self._getUpstreamOutput(
+            self.refVolume if self.hasAttribute('refVolume') else None)
+        if upstreamVolume is not None:
+            self.volume = pwobj.String(upstreamVolume)
+            if vol.hasHalfMaps():
+                self.importVolumeHalfA = pwobj.String(upstreamVolume + '.map_half_A')
+                self.importVolumeHalfB = pwobj.String(upstreamVolume + '.map_half_B')
+            return
+
         vol_fn = os.path.join(os.getcwd(), convertBinaryVol(vol, self._getTmpPath()))
-        importVolumeJob = doImportVolumes(self, vol_fn, vol, 'map', 'Importing volume...')
+        importVolumeJob = self._doImport(
+            getFilesHash([vol.getFileName()], 'map', vol.getSamplingRate()),
+            lambda: doImportVolumes(self, vol_fn, vol, 'map', 'Importing volume...',
+                                    wait=False),
+            'volume')
         self.volume = pwobj.String(str(importVolumeJob.get()) + self.outputVolumeSuffix)
 
         if vol.hasHalfMaps():
             halfMaps = vol.getHalfMaps().split(",")
             map_half_A_fn = os.path.abspath(halfMaps[0].split(':mrc')[0])
-            importVolumeHalfAJob = doImportVolumes(self, map_half_A_fn, vol,
-                                                   'map_half_A', 'Importing half volume A...')
+            importVolumeHalfAJob = self._doImport(
+                getFilesHash([map_half_A_fn], 'map_half_A', vol.getSamplingRate()),
+                lambda: doImportVolumes(self, map_half_A_fn, vol,
+                                        'map_half_A', 'Importing half volume A...',
+                                        wait=False),
+                'half volume A')
             self.importVolumeHalfA = pwobj.String(str(importVolumeHalfAJob.get()) + self.outputVolumeHalf_A)
 
             map_half_B_fn = os.path.abspath(halfMaps[1].split(':mrc')[0])
-            importVolumeHalfBJob = doImportVolumes(self, map_half_B_fn, vol,
-                                                   'map_half_B', 'Importing half volume B...')
+            importVolumeHalfBJob = self._doImport(
+                getFilesHash([map_half_B_fn], 'map_half_B', vol.getSamplingRate()),
+                lambda: doImportVolumes(self, map_half_B_fn, vol,
+                                        'map_half_B', 'Importing half volume B...',
+                                        wait=False),
+                'half volume B')
             self.importVolumeHalfB = pwobj.String(str(importVolumeHalfBJob.get()) + self.outputVolumeHalf_B)
 
         self.currenJob.set(importVolumeJob.get())
@@ -271,8 +409,12 @@ class ProtCryosparcBase(pw.EMProtocol):
         maskFn = os.path.join(os.getcwd(), convertBinaryVol(self._getInputMask(),
                                                             self._getTmpPath()))
 
-        importMaskJob = doImportVolumes(self, maskFn, self._getInputMask(),
-                                        'mask', 'Importing mask... ')
+        mask = self._getInputMask()
+        importMaskJob = self._doImport(
+            getFilesHash([mask.getFileName()], 'mask', mask.getSamplingRate()),
+            lambda: doImportVolumes(self, maskFn, mask, 'mask', 'Importing mask... ',
+                                    wait=False),
+            'mask')
         self.currenJob.set(importMaskJob.get())
         self.mask = pwobj.String(str(importMaskJob.get()) + self.outputMaskSuffix)
 
@@ -281,37 +423,192 @@ class ProtCryosparcBase(pw.EMProtocol):
         maskFn = os.path.join(os.getcwd(), convertBinaryVol(self._getInputFocusMask(),
                                                             self._getTmpPath()))
 
-        importFocusMaskJob = doImportVolumes(self, maskFn, self._getInputFocusMask(),
-                                             'mask', 'Importing focus mask... ')
+        focusMask = self._getInputFocusMask()
+        importFocusMaskJob = self._doImport(
+            getFilesHash([focusMask.getFileName()], 'mask', focusMask.getSamplingRate()),
+            lambda: doImportVolumes(self, maskFn, focusMask, 'mask',
+                                    'Importing focus mask... ', wait=False),
+            'focus mask')
         self.currenJob.set(importFocusMaskJob.get())
         self.focusMask = pwobj.String(str(importFocusMaskJob.get()) + self.outputMaskSuffix)
 
     def _importParticles(self):
-        # import_particles_star
-        importedParticlesJob = doImportParticlesStar(self)
+        """ Write the particles as a .cs file and import it in an external
+        job, so cryoSPARC does not parse them. Without cryosparc-tools
+        credentials (or if that import fails), the particles are written
+        in a STAR file and imported by import_particles """
+        imgSet = self._getInputParticles()
+        if canUseCryosparcTools():
+            csFile = self._getInputParticlesCsFile()
+            writeSetOfParticlesCs(imgSet, csFile, self._getPath(),
+                                  cacheDir=self._getStackCacheDir(),
+                                  numberOfWorkers=self.numberOfThreads.get())
+            try:
+                self._importParticlesFile(csFile, readCsRowHashes,
+                                          lambda: doImportParticlesCs(self, csFile),
+                                          source=self._getParticleStacksPath())
+                return
+            except Exception as e:
+                logger.warning("Can't import the particles with an external "
+                               "job, importing them from a STAR file: %s" % e)
+
+        # Create links to binary files and write the relion .star file
+        writeSetOfParticles(imgSet, self._getFileName('input_particles'),
+                            self._getPath(),
+                            cacheDir=self._getStackCacheDir(),
+                            numberOfWorkers=self.numberOfThreads.get())
+        self._importParticlesFile(os.path.abspath(self._getFileName('input_particles')),
+                                  readStarRowHashes,
+                                  lambda: doImportParticlesStar(self, wait=False),
+                                  source=self._getParticleStacksPath())
+
+    def _getInputParticlesCsFile(self):
+        return pwutils.replaceExt(self._getFileName('input_particles'), 'cs')
+
+    def _getParticleStacksPath(self):
+        """ Folder of the particle stacks written for cryoSPARC: the links
+        or converted stacks of the run input folder (see convertBinaryFiles)
+        or, if the stacks are used as they are, their common folder """
+        inputPath = self._getPath('input')
+        if not os.path.lexists(inputPath):
+            inputPath = pwutils.commonPath(list(self._getInputParticles().getFiles()))
+        return os.path.abspath(inputPath)
+
+    def _importParticlesFile(self, fileName, readRowHashes, importFunc,
+                             source=None):
+        """ Import the particles written in fileName (.cs or STAR file),
+        reusing the particles imported before when possible
+        Params:
+            readRowHashes: function that identifies the rows of the file
+                (readCsRowHashes or readStarRowHashes)
+            importFunc: function that imports the file and returns the job
+            source: file or folder that cryoSPARC keeps referencing after
+                the import (see _doImport)
+        """
+        header, rows = readRowHashes(fileName, strip=self._getPath())
+        subsetJob = self._createParticlesSubset(header, rows)
+        if subsetJob is not None:
+            self.currenJob = pwobj.String(subsetJob)
+            self.particles = pwobj.String(subsetJob + '.particles')
+            return
+
+        importedParticlesJob = self._doImport(self._getParticlesImportKey(header, rows),
+                                              importFunc, 'particles',
+                                              source=source)
+        self._saveParticlesRows(importedParticlesJob.get(), header, rows,
+                                source)
         self.currenJob = pwobj.String(str(importedParticlesJob.get()))
         self.particles = pwobj.String(str(importedParticlesJob.get()) +
                                       '.imported_particles')
 
+    def _getParticlesRowsFile(self, jobId):
+        return self._getSharedPath(PARTICLES_ROWS_DIR,
+                                   '%s_%s.npz' % (self.projectName.get(), jobId))
+
+    def _saveParticlesRows(self, jobId, header, rows, source=None):
+        """ Keep the rows (see readCsRowHashes) imported by a
+        cryoSPARC job, in the order of its output, so the subsets of those
+        particles can be selected from it (see _createParticlesSubset).
+        The source of the import (see _doImport) is kept with them """
+        rowsFile = self._getParticlesRowsFile(jobId)
+        if os.path.exists(rowsFile):
+            return
+        os.makedirs(os.path.dirname(rowsFile), exist_ok=True)
+        tmpFile = '%s.%d.tmp' % (rowsFile, os.getpid())
+        with open(tmpFile, 'wb') as f:
+            np.savez(f, header=np.array(header), rows=rows,
+                     source=np.array(source or ''))
+        os.replace(tmpFile, rowsFile)
+
+    def _createParticlesSubset(self, header, rows):
+        """ When all the input particles (same image, CTF and alignment)
+        were imported before by a larger import job, e.g. the input is a
+        subset of good classes, select them by uid from that job output
+        instead of importing them again. Returns the uid of the cryoSPARC
+        job with the subset or None if the particles have to be imported
+        """
+        projectName = self.projectName.get()
+        pattern = self._getParticlesRowsFile('J*')
+        # The smallest import job that contains the particles is used
+        for rowsFile in sorted(glob.glob(pattern), key=os.path.getsize):
+            with np.load(rowsFile) as imported:
+                # The rows saved without their source can't be checked
+                if (str(imported['header']) != header or
+                        'source' not in imported.files):
+                    continue
+                source = str(imported['source']) or None
+                sourceRows = imported['rows']
+            if len(sourceRows) <= len(rows) or not self._importSourceExists(source):
+                continue
+            positions = matchRows(sourceRows, rows)
+            if positions is None:
+                continue
+
+            jobId = os.path.basename(rowsFile)[len(projectName) + 1:-len('.npz')]
+            try:
+                if getJobStatus(projectName, jobId) != STATUS_COMPLETED:
+                    continue
+                csFile = getJobOutputFile(projectName, jobId, 'imported_particles')
+                csFile = CsFile(os.path.join(self.projectDir.get(), csFile))
+                # The stacks of the selected particles must still exist
+                stacks = np.unique(csFile.getField('blob/path')[positions])
+                stacks = [stack.decode() if isinstance(stack, bytes) else str(stack)
+                          for stack in stacks]
+                missing = [stack for stack in stacks if not os.path.exists(
+                    os.path.join(self.projectDir.get(), stack))]
+                if missing:
+                    logger.debug("Can't select the particles from job %s, "
+                                 "missing stacks: %s" % (jobId, missing[0]))
+                    continue
+                uids = csFile.getField('uid')[positions]
+                subsetJob = createParticlesSubset(projectName,
+                                                  self.workSpaceName.get(),
+                                                  '%s.imported_particles' % jobId,
+                                                  uids)
+            except Exception as e:
+                logger.debug("Can't select the particles from job %s: %s" % (jobId, e))
+                continue
+            self.info("Particles selected (%d of %d) from the ones imported by "
+                      "cryoSPARC job %s in job %s"
+                      % (len(rows), len(sourceRows), jobId, subsetJob))
+            return subsetJob
+        return None
+
+    def _getParticlesImportKey(self, header, rows):
+        """ Hash of the particles rows (without the paths of this run, see
+        readCsRowHashes) and of the particle stacks """
+        imgSet = self._getInputParticles()
+        return getFilesHash(imgSet.getFiles(), header,
+                            hashlib.sha1(rows.tobytes()).hexdigest(),
+                            imgSet.getSamplingRate())
+
     def _importMicrographs(self):
-        importedMicrographsJob = doImportMicrographs(self)
+        importedMicrographsJob = doImportMicrographs(self, wait=False)
+        self._addImportJob(importedMicrographsJob, 'micrographs')
         self.currenJob = pwobj.String(str(importedMicrographsJob.get()))
         self.micrographs = pwobj.String(str(importedMicrographsJob.get()) +
                                       '.imported_micrographs')
 
     def setAborted(self):
-        """ Set the status to aborted and updated the endTime. """
+        """ Set the status to aborted and updated the endTime. The current
+        cryoSPARC job and the queued import jobs are killed """
         pw.EMProtocol.setAborted(self)
-        if hasattr(self, 'projectName') and hasattr(self, 'currenJob') and self.currenJob.get() is not None:
-            job = str(self.currenJob.get())
-            project = str(self.projectName.get())
-            status = getJobStatus(project, job)
-            if status not in STOP_STATUSES:
-                try:
+        if not hasattr(self, 'projectName'):
+            return
+        jobs = list(self.importJobs) if hasattr(self, 'importJobs') else []
+        if hasattr(self, 'currenJob') and self.currenJob.get() is not None:
+            jobs.append(str(self.currenJob.get()))
+        project = str(self.projectName.get())
+        for job in dict.fromkeys(jobs):
+            try:
+                status = getJobStatus(project, job)
+                if status not in STOP_STATUSES:
                     killJob(project, job)
                     clearJob(project, job)
-                except Exception as e:
-                    logger.error("Can't kill job %s from project %s" % (job, project), exc_info=e)
+            except Exception as e:
+                logger.error("Can't kill job %s from project %s" % (job, project), exc_info=e)
+        if hasattr(self, 'importJobs'):
+            self.importJobs.set([])
 
     def createFSC(self, idd, imgSet, vol):
         # Need to get the cryosparc master address
@@ -393,40 +690,49 @@ class ProtCryosparcBase(pw.EMProtocol):
         return fsc
 
     def findLastIteration(self, jobName):
-        get_job_streamlog(self.projectName.get(),
-                          jobName,
-                          self._getFileName('stream_log'))
-
-        # Get the metadata information from stream.log
-        with open(self._getFileName('stream_log')) as f:
-            data = f.readlines()
-
-        x = ast.literal_eval(data[0])
-
-        # Find the ID of last iteration and the map resolution
-        for y in x:
-            if 'text' in y:
-                z = str(y['text'])
-
-                if z.startswith('FSC Iteration') or z.startswith('FSC iIteration'):
-                    for imgfile in y['imgfiles']:
-                        if imgfile['filetype'] == 'txt':
-                            idd = imgfile['fileid']
-                            break
-                    itera = z.split(',')[0][-3:]
-                    self._store(self)
-                elif 'Using Filter Radius' in z:
-                    nomRes = str(y['text']).split('(')[1].split(')')[
-                        0].replace(
-                        'A', 'Å')
-                    self.mapResolution = pwobj.String(nomRes)
-                    self._store(self)
-                elif 'Estimated Bfactor' in z:
-                    estBFactor = str(y['text']).split(':')[1].replace('\n',
-                                                                      '')
-                    self.estBFactor = pwobj.String(estBFactor)
-                    self._store(self)
-        return idd, itera
+        index = self._readJobStreamLog(jobName)
+
+        # The ID of last iteration and the map resolution
+        if 'mapResolution' in index:
+            self.mapResolution = pwobj.String(index['mapResolution'])
+        if 'estBFactor' in index:
+            self.estBFactor = pwobj.String(index['estBFactor'])
+        self._store(self)
+        return index.get('fscFileId'), index.get('fscIteration')
+
+    def _readJobStreamLog(self, jobName):
+        """ Read the new events of the job and return its stream log index """
+        streamLog = self.getJobStreamLog(jobName)
+        streamLog.update()
+        return streamLog.index
+
+    def getJobStreamLog(self, jobName):
+        """ Return the (incremental) stream log reader of a job """
+        if not hasattr(self, '_jobStreamLogs'):
+            self._jobStreamLogs = {}
+        if jobName not in self._jobStreamLogs:
+            self._jobStreamLogs[jobName] = JobStreamLog(self.projectName.get(),
+                                                        jobName,
+                                                        self._indexStreamLogEvent)
+        return self._jobStreamLogs[jobName]
+
+    def _indexStreamLogEvent(self, event, index):
+        """ Keep in the index the information of a stream log event that
+        is used to create the outputs """
+        if 'text' in event:
+            z = str(event['text'])
+
+            if z.startswith('FSC Iteration') or z.startswith('FSC iIteration'):
+                for imgfile in event['imgfiles']:
+                    if imgfile['filetype'] == 'txt':
+                        index['fscFileId'] = imgfile['fileid']
+                        break
+                index['fscIteration'] = z.split(',')[0][-3:]
+            elif 'Using Filter Radius' in z:
+                index['mapResolution'] = z.split('(')[1].split(')')[
+                    0].replace('A', 'Å')
+            elif 'Estimated Bfactor' in z:
+                index['estBFactor'] = z.split(':')[1].replace('\n', '')
 
     def _createModelFile(self):
         pass
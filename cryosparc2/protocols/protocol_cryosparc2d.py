@@ -38,7 +38,8 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam, IntParam,
 import pyworkflow.utils as pwutils
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (rowToAlignment, convertCs2Star, cryosparcToLocation)
+from ..convert import (rowToAlignment, convertCs2Star, cryosparcToLocation,
+                       ParticlesJoin)
 from ..utils import (addComputeSectionParams, cryosparcValidate, gpusValidate,
                      enqueueJob, waitForCryosparc, clearIntermediateResults,
                      copyFiles, getOutputPreffix, isCryosparcStandalone)
@@ -283,7 +284,8 @@ class ProtCryo2D(ProtCryosparcBase, pwprot.ProtClassify2D):
         # Copy the CS output to extra folder
         copyFiles(csOutputFolder, self._getExtraPath(), files=[csParticlesName,
                                                                csClassAveragesName,
-                                                               mrcFileName])
+                                                               mrcFileName],
+                  numberOfWorkers=self.numberOfThreads.get())
 
         csPartFile = os.path.join(self._getExtraPath(), csParticlesName)
         outputStarFn = self._getFileName('out_particles')
@@ -360,12 +362,11 @@ class ProtCryo2D(ProtCryosparcBase, pwprot.ProtClassify2D):
         # the particle with orientation parameters (all_parameters)
         xmpMd = 'particles@' + self._getFileName("out_particles")
 
-        clsSet.classifyItems(updateItemCallback=self._updateParticle,
-                             updateClassCallback=self._updateClass,
-                             itemDataIterator=emtable.Table.iterRows(
-                                 xmpMd),
-                             raiseOnNextFailure=False,
-                             cancelNextWhenAppendIsFalse=True)  # relion style
+        join = ParticlesJoin(emtable.Table.iterRows(xmpMd),
+                             self._getInputParticles())
+        clsSet.classifyItems(updateItemCallback=join.updateItemCallback(
+                                 self._updateParticle),
+                             updateClassCallback=self._updateClass)
 
     def _updateParticle(self, item, row):
         item.setClassId(row.get(RELIONCOLUMNS.rlnClassNumber.value))
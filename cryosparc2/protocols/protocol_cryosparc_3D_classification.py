@@ -37,12 +37,14 @@ from pyworkflow.protocol.params import (FloatParam, LEVEL_ADVANCED,
 
 from .protocol_base import ProtCryosparcBase
 from ..convert import (convertBinaryVol, convertCs2Star,
-                       rowToAlignment, ALIGN_PROJ, cryosparcToLocation)
+                       rowToAlignment, ALIGN_PROJ, cryosparcToLocation,
+                       ParticlesJoin)
 from ..utils import (addSymmetryParam, addComputeSectionParams, doImportVolumes,
-                     get_job_streamlog, calculateNewSamplingRate,
+                     calculateNewSamplingRate,
                      cryosparcValidate, gpusValidate, getSymmetry, enqueueJob,
                      waitForCryosparc, clearIntermediateResults, fixVolume,
-                     copyFiles, getOutputPreffix, matchItemRow)
+                     copyFiles, getOutputPreffix,
+                     getFilesHash)
 from ..constants import *
 
 
@@ -253,8 +255,11 @@ class ProtCryoSparc3DClassification(ProtCryosparcBase):
                                        convertBinaryVol(
                                            vol,
                                            self._getTmpPath()))
-            self.importVolume = doImportVolumes(self, self.vol_fn, vol, 'map',
-                                                'Importing volume...')
+            self.importVolume = self._doImport(
+                getFilesHash([vol.getFileName()], 'map', vol.getSamplingRate()),
+                lambda: doImportVolumes(self, self.vol_fn, vol, 'map',
+                                        'Importing volume...', wait=False),
+                'volume')
             self.importVolumes.append(self.importVolume.get())
             self.currenJob.set(self.importVolume.get())
 
@@ -329,19 +334,16 @@ class ProtCryoSparc3DClassification(ProtCryosparcBase):
         """ Create the SetOfClasses3D """
         xmpMd = 'micrographs@' + filename
         self._loadClassesInfo(self._getFileName('out_class'))
-        clsSet.classifyItems(updateItemCallback=self._updateParticle,
-                             updateClassCallback=self._updateClass,
-                             itemDataIterator=emtable.Table.iterRows(xmpMd),
-                             raiseOnNextFailure=False,
-                             cancelNextWhenAppendIsFalse=True)
+        join = ParticlesJoin(emtable.Table.iterRows(xmpMd),
+                             self._getInputParticles())
+        clsSet.classifyItems(updateItemCallback=join.updateItemCallback(
+                                 self._updateParticle),
+                             updateClassCallback=self._updateClass)
 
     def _updateParticle(self, item, row):
-        if matchItemRow(item, row):
-            item.setClassId(row.get(RELIONCOLUMNS.rlnClassNumber.value))
-            samplingRate = item.getSamplingRate()
-            item.setTransform(rowToAlignment(row, ALIGN_PROJ, samplingRate))
-        else:
-            item._appendItem = False
+        item.setClassId(row.get(RELIONCOLUMNS.rlnClassNumber.value))
+        samplingRate = item.getSamplingRate()
+        item.setTransform(rowToAlignment(row, ALIGN_PROJ, samplingRate))
 
     def _updateClass(self, item):
         classId = item.getObjId()
@@ -379,25 +381,13 @@ class ProtCryoSparc3DClassification(ProtCryosparcBase):
                 output_file.write(row)
 
     def findLastIteration(self, jobName):
-        import ast
-        get_job_streamlog(self.projectName.get(),
-                          jobName,
-                          self._getFileName('stream_log'))
-
-        # Get the metadata information from stream.log
-        with open(self._getFileName('stream_log')) as f:
-            data = f.readlines()
-
-        x = ast.literal_eval(data[0])
-
-        # Find the ID of last iteration and the map resolution
-        for y in x:
-            if 'text' in y:
-                z = str(y['text'])
-                if z.startswith('Done iteration'):
-                    itera = z.split(' ')[2]
+        return self._readJobStreamLog(jobName).get('iteration')
 
-        return itera
+    def _indexStreamLogEvent(self, event, index):
+        if 'text' in event:
+            z = str(event['text'])
+            if z.startswith('Done iteration'):
+                index['iteration'] = z.split(' ')[2]
 
     # --------------------------- INFO functions -------------------------------
     def _validate(self):
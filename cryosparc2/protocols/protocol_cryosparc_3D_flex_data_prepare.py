@@ -128,34 +128,27 @@ class ProtCryoSparc3DFlexDataPrepare(ProtCryosparcBase):
         """
         self.info(pwutils.yellowStr("Creating the output..."))
         self._initializeUtilsVariables()
-        outputStarFn = self._getFileName('out_particles')
-        self.info(pwutils.yellowStr("outputStarFn: %s " % outputStarFn))
         csOutputFolder = os.path.join(self.projectDir.get(), self.run3DFlexDataPrepJob.get())
         self.info("csOutputFolder: %s " % csOutputFolder)
         # csFileName = "subtracted_particles.cs"
         csFileName = "%s_passthrough_particles.cs" % self.run3DFlexDataPrepJob.get()
         self.info("csFileName: %s " % csOutputFolder)
         # Create the output folder
-        copyFiles(csOutputFolder,  os.path.join(self._getExtraPath(), self.run3DFlexDataPrepJob.get()))
+        csMapName = "%s_map.mrc" % self.run3DFlexDataPrepJob.get()
+        copyFiles(csOutputFolder,  os.path.join(self._getExtraPath(), self.run3DFlexDataPrepJob.get()),
+                  files=[csFileName, csMapName],
+                  numberOfWorkers=self.numberOfThreads.get())
         self.info("copyFolder: src-> dst %s %s" % (csOutputFolder, os.path.join(self._getExtraPath(), self.run3DFlexDataPrepJob.get())))
         csFile = os.path.join(self._getExtraPath(), self.run3DFlexDataPrepJob.get(), csFileName)
         self.info("csFile (metadata): %s " % csFile)
-        argsList = [csFile, outputStarFn]
-        self.info("starFile: %s " % outputStarFn)
-        convertCs2Star(argsList)
-        self.info("Convert to star done.")
         self.info("Creating the particles output")
         imgSet = self._getInputParticles()
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
         outImgSet.setSamplingRate(imgSet.getSamplingRate())
-        imgSetDict = {}
-        for img in imgSet.iterItems():
-            imgSetDict[str(img.getIndex()) + '@' + os.path.basename(img.getFileName())] = img.clone()
-        self._fillDataFromIter(outImgSet, imgSetDict)
+        self._fillDataFromIter(outImgSet, imgSet, csFile)
         self.info("Creating the consensus volume  output")
 
-        csMapName = "%s_map.mrc" % self.run3DFlexDataPrepJob.get()
         fnVol = os.path.join(self._getExtraPath(), self.run3DFlexDataPrepJob.get(), csMapName)
         vol = Volume()
         fixVolume(fnVol)
@@ -170,15 +163,21 @@ class ProtCryoSparc3DFlexDataPrepare(ProtCryosparcBase):
 
     # ------------------------- Utils methods ----------------------------------
 
-    def _fillDataFromIter(self, outImgSet, imgSetDict):
-        filename = 'particles@' + self._getFileName('out_particles')
-        for imgRow in emtable.Table.iterRows(filename):
-            fileName = imgRow.get(RELIONCOLUMNS.rlnImageName.value)
-            splitFileName = fileName.split('@')
-            key = str(int(splitFileName[0])) + '@' + '_'.join(splitFileName[1].split('_')[1:])
-            if key in imgSetDict:
-                img = imgSetDict[key]
-                outImgSet.append(img)
+    def _fillDataFromIter(self, outImgSet, imgSet, csFile):
+        """ Add the input particles that are in the .cs file, in the order
+        of the file. Only the ids of the input particles are kept in
+        memory while joining them with the .cs rows """
+        rowsIndex = ParticlesIndex()
+        numberOfRows = len(CsFile(csFile))
+        rowsIndex.addCsFile(csFile, np.arange(1, numberOfRows + 1))
+        rowIds = np.zeros(numberOfRows, dtype=np.int64)
+        for img in imgSet.iterItems():
+            row = rowsIndex.getValue(img)
+            if row:
+                rowIds[row - 1] = img.getObjId()
+
+        for img in iterItemsById(imgSet, rowIds[rowIds > 0]):
+            outImgSet.append(img)
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=ALIGN_PROJ)
@@ -25,7 +25,6 @@
 # *
 # **************************************************************************
 import os.path
-import zipfile
 
 from pwem import getMatchingFiles
 from pwem.protocols import ProtFlexBase
@@ -86,16 +85,11 @@ class ProtCryoSparc3DFlexGenerator(ProtCryosparcBase, ProtFlexBase):
 
         pattern = csOutputFolder + '/%s_series_*.zip' % self.run3DGeneratorJob.get()
         csSeries = getMatchingFiles(pattern, True)
-        fileNameList = [os.path.basename(fileName) for fileName in csSeries]
-        copyFiles(csOutputFolder, self._getExtraPath(), files=fileNameList)
-        outputFolder = self._getExtraPath()
-        for fileName in fileNameList:
-            filePath = os.path.join(outputFolder, fileName)
-            with zipfile.ZipFile(filePath, 'r') as fileZip:
-                extractFolder = os.path.join(outputFolder, os.path.splitext(fileName)[0])
-                os.mkdir(extractFolder)
-                fileZip.extractall(extractFolder)
-            os.remove(filePath)
+        # The series are extracted straight from the cryoSPARC job folder
+        archives = [SeriesArchive(fileName,
+                                  self._getExtraPath(os.path.splitext(os.path.basename(fileName))[0]))
+                    for fileName in csSeries]
+        extractArchives(archives, numberOfWorkers=self.numberOfThreads.get())
 
     def _validate(self):
         validateMsgs = cryosparcValidate()
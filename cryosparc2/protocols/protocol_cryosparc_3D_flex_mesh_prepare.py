@@ -219,9 +219,11 @@ class ProtCryoSparc3DFlexMeshPrepare(ProtCryosparcBase):
     def _fillDataFromIter(self, imgSet):
         outImgsFn = 'particles@' + self._getFileName('out_particles')
         imgSet.setAlignmentProj()
+        join = ParticlesJoin(emtable.Table.iterRows(fileName=outImgsFn),
+                             self._getInputParticles())
         imgSet.copyItems(self._getInputParticles(),
-                         updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(fileName=outImgsFn))
+                         updateItemCallback=join.updateItemCallback(
+                             self._createItemMatrix))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=ALIGN_PROJ)
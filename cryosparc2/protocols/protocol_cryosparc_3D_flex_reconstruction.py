@@ -134,7 +134,8 @@ class ProtCryoSparc3DFlexReconstruction(ProtCryosparcBase):
 
         # Copy the CS output volume and half to extra folder
         copyFiles(csOutputFolder, self._getExtraPath(), files=[fnFlexVolName, flexHalf1Name, flexHalf2Name,
-                                                               fnNoFlexVolName, flexNoHalf1Name, flexNoHalf2Name])
+                                                               fnNoFlexVolName, flexNoHalf1Name, flexNoHalf2Name],
+                  numberOfWorkers=self.numberOfThreads.get())
 
         fnVol = os.path.join(self._getExtraPath(), fnFlexVolName)
         half1 = os.path.join(self._getExtraPath(), flexHalf1Name)
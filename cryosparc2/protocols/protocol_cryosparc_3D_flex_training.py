@@ -207,12 +207,13 @@ class ProtCryoSparc3DFlexTraining(ProtCryosparcBase, ProtFlexBase):
 
 
         # Copy the CS output particles to extra folder
-        copyFiles(csOutputFolder, self._getExtraPath(), files=[csParticlesName, trainModelRar, trainModelCs])
+        copyFiles(csOutputFolder, self._getExtraPath(), files=[csParticlesName, trainModelRar, trainModelCs],
+                  numberOfWorkers=self.numberOfThreads.get())
         csPartFile = os.path.join(self._getExtraPath(), csParticlesName)
 
-        # Taking the zvalues from the .cs file using numpy
-        arr = np.load(csPartFile)
-        zValues = [[arr[i][j] for j in range(2, len(arr[i]), 2)] for i in range(len(arr))]
+        # Taking the zvalues from the .cs file (only the latent fields
+        # are read)
+        zValues = readCsLatents(csPartFile)
 
         inputSet = self.input3DFlexDataPrepareProt.get()._getInputParticles()
         outImgSet = SetOfParticlesFlex.create(self._getPath(), suffix='', progName=CRYOSPARCFLEX)
@@ -225,14 +226,7 @@ class ProtCryoSparc3DFlexTraining(ProtCryosparcBase, ProtFlexBase):
         outImgSet.getFlexInfo().setAttr('trainJobId', str(self.run3DFlexTrainJob.get()))
         outImgSet.getFlexInfo().setAttr('projectPath', self.projectDir.get())
 
-        for particle, zValue in zip(inputSet, zValues):
-            outParticle = ParticleFlex(progName=CRYOSPARCFLEX)
-            outParticle.copyInfo(particle)
-            outParticle.getFlexInfo().setProgName(CRYOSPARCFLEX)
-
-            outParticle.setZFlex(list(zValue))
-
-            outImgSet.append(outParticle)
+        appendParticlesFlex(outImgSet, inputSet, zValues, CRYOSPARCFLEX)
 
         self._defineOutputs(**{outputs.Particles.name: outImgSet})
         self._defineSourceRelation(inputSet, outImgSet)
@@ -178,11 +178,6 @@ class ProtCryoSparc3DVariability(ProtCryosparcBase, ProtRefine3D):
         os.system("cp -r " + csFile + " " + self._getExtraPath())
         csFile = os.path.join(self._getExtraPath(), csParticlesName)
 
-        outputStarFn = self._getFileName('out_particles')
-        argsList = [csFile, outputStarFn]
-
-        convertCs2Star(argsList)
-
         fnVolName = (getOutputPreffix(self.projectName.get()) +
                      self.run3DVariability.get() + "_map.mrc")
 
@@ -200,7 +195,7 @@ class ProtCryoSparc3DVariability(ProtCryosparcBase, ProtRefine3D):
                                                      imgSet.getDim()))
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputVolume=vol)
         self._defineSourceRelation(self.inputParticles.get(), vol)
@@ -251,13 +246,12 @@ class ProtCryoSparc3DVariability(ProtCryosparcBase, ProtRefine3D):
 
     # -------------------------- UTILS functions ------------------------------
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.setAlignmentProj()
+        join = ParticlesJoin(CsTable(csFile), self._getInputParticles())
         imgSet.copyItems(self._getInputParticles(),
-                         updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(
-                             fileName=outImgsFn))
+                         updateItemCallback=join.updateItemCallback(
+                             self._createItemMatrix))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=ALIGN_PROJ)
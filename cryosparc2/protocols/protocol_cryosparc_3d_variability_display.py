@@ -50,7 +50,6 @@ class ProtCryoSparc3DVariabilityDisplay(ProtCryosparcBase, ProtRefine3D):
     """
     _label = '3D variability Display'
     _devStatus = BETA
-    partClassDict = NestedDict(depth=2)
 
     def _initialize(self):
         self._defineFileNames()
@@ -213,67 +212,36 @@ class ProtCryoSparc3DVariabilityDisplay(ProtCryosparcBase, ProtRefine3D):
         self.info(pwutils.yellowStr("Copying files from CS to Scipion folder..."))
         csOutputFolder = os.path.join(self.projectDir.get(),
                                       self.run3DVariabilityDisplay.get())
+        self.partClassDict = ParticlesClassIndex()
         if self.var_output_mode.get() == 0:  # Cluster mode
 
             # Copy the CS output to extra folder
             outputFolder = os.path.join(self._getExtraPath(), 'outputs')
             pwutils.cleanPath(outputFolder)
-            copyFiles(csOutputFolder, outputFolder)
+            copyFiles(csOutputFolder, outputFolder, files=['*.cs', '*_cluster_*.mrc'],
+                      numberOfWorkers=self.numberOfThreads.get())
 
-            # Creating the folder where .star files will be created
-            starFilesPath = os.path.join(outputFolder, 'clustersFiles')
-            os.makedirs(starFilesPath)
-
-            # Generating the .star file por all clusters
-            allClusterSeries = '%s%s_series_all_clusters.cs' % (getOutputPreffix(self.projectName.get()),
-                                                             self.run3DVariabilityDisplay.get())
-            allClusterSeriesStar = '%s%s_series_all_clusters.star' % (getOutputPreffix(self.projectName.get()),
-                                                             self.run3DVariabilityDisplay.get())
-
-            filePath = os.path.join(outputFolder, allClusterSeries)
-            outputStarFn = os.path.join(starFilesPath, allClusterSeriesStar)
-            argsList = [filePath, outputStarFn]
-            convertCs2Star(argsList)
-
-            # Creating the .star cluster per cluster
+            # The class of each particle is read from the cluster .cs files
             numOfClusters = self.var_num_frames.get()
-            self.info(pwutils.yellowStr("Generating .star files for all clusters"))
             for i in range(numOfClusters):
-                self.info(pwutils.yellowStr("Processing cluster %d ..." % i))
-
                 clusterParticlesPattern = '%s%s_cluster_%03d_particles.cs' % (getOutputPreffix(self.projectName.get()),
                                                                               self.run3DVariabilityDisplay.get(), i)
-
-
-                passthroughParticlesPattern = '%s%s_passthrough_particles_cluster_%d.cs' % (getOutputPreffix(self.projectName.get()),
-                                                                                            self.run3DVariabilityDisplay.get(), i)
-                patterns = [clusterParticlesPattern, passthroughParticlesPattern]
-                outputs = ['output_cluster_particle%03d.star' % i,
-                           'output_passthrough_particle%03d.star' % i]
-                # Generating .star files
-                for j in range(len(patterns)):
-                    filePath = os.path.join(outputFolder, patterns[j])
-                    outputStarFn = os.path.join(starFilesPath, outputs[j])
-                    argsList = [filePath, outputStarFn]
-                    convertCs2Star(argsList)
-                self._partClassDict(os.path.join(starFilesPath, outputs[0]), i)
+                self._partClassDict(os.path.join(outputFolder, clusterParticlesPattern), i)
         else:
             # Copy the CS output to extra folder
             outputFolder = self._getExtraPath()
             pwutils.cleanPath(outputFolder)
-            copyFiles(csOutputFolder, outputFolder)
+            copyFiles(csOutputFolder, outputFolder, files=['*_component_*.zip'],
+                      numberOfWorkers=self.numberOfThreads.get())
+            if self.var_output_mode.get() == 2 and self.var_intermediate_output_frame_particles.get():
+                copyFiles(csOutputFolder, outputFolder, files=['*_particles_series_*_frame_*.cs'],
+                          numberOfWorkers=self.numberOfThreads.get())
             # Creating the .star cluster particles
             numOfComponets = int(self.input3DVariablityAnalisysProt.get().var_K)
 
-            for i in range(numOfComponets):
-                self.info(pwutils.yellowStr("Extracting component %d ..." % i))
-                # Creating the folder where clusters will be unzipped
-                componetFilesPath = self._getExtraPath('component%03d' % i)
-                os.makedirs(componetFilesPath)
-                componentPattern = "%s%s_component_%03d.zip" % (getOutputPreffix(self.projectName.get()),
-                                                                self.run3DVariabilityDisplay.get(), i)
-                cmd = "unzip %s -d %s" % (self._getExtraPath(componentPattern), componetFilesPath)
-                os.system(cmd)
+            self.info(pwutils.yellowStr("Extracting %d components ..." % numOfComponets))
+            extractArchives([self._getComponentArchive(i) for i in range(numOfComponets)],
+                            numberOfWorkers=self.numberOfThreads.get())
 
             if self.var_output_mode.get() == 2 and self.var_intermediate_output_frame_particles.get():
                 clusterNumber = self.var_num_frames.get()
@@ -286,16 +254,7 @@ class ProtCryoSparc3DVariabilityDisplay(ProtCryosparcBase, ProtRefine3D):
                     componentCSParticlesPattern = '%s%s_particles_series_%d_frame_%d.cs' % (getOutputPreffix(self.projectName.get()),
                                                                                           self.run3DVariabilityDisplay.get(),
                                                                                           component, i)
-                    componentStarPattern = '%s%s_particles_series_%d_frame_%d.star' % (getOutputPreffix(self.projectName.get()),
-                                                                                       self.run3DVariabilityDisplay.get(),
-                                                                                       component, i)
-                    outputStarPath = os.path.join(componetFilesPath, componentStarPattern)
-
-                    filePath = os.path.join(outputFolder, componentCSParticlesPattern)
-                    argsList = [filePath, outputStarPath]
-                    convertCs2Star(argsList)
-
-                    self._partClassDict(outputStarPath, i)
+                    self._partClassDict(os.path.join(outputFolder, componentCSParticlesPattern), i)
 
     def createOutputStep(self):
         self._initializeUtilsVariables()
@@ -380,8 +339,7 @@ class ProtCryoSparc3DVariabilityDisplay(ProtCryosparcBase, ProtRefine3D):
                              itemDataIterator=None)
 
     def _updateParticle(self, item, row):
-        classNumber = self.partClassDict.search([os.path.splitext(os.path.basename(item.getFileName()))[0],
-                                                 item.getIndex()])
+        classNumber = self.partClassDict.getClass(item)
         if not classNumber:
             setattr(item, '_appendItem', False)
         else:
@@ -400,6 +358,13 @@ class ProtCryoSparc3DVariabilityDisplay(ProtCryosparcBase, ProtRefine3D):
                                                          imgSet.getSamplingRate(),
                                                          imgSet.getDim()))
 
+    def _getComponentArchive(self, component):
+        """ Archive with the volume series of a component """
+        componentPattern = "%s%s_component_%03d.zip" % (getOutputPreffix(self.projectName.get()),
+                                                        self.run3DVariabilityDisplay.get(), component)
+        return SeriesArchive(self._getExtraPath(componentPattern),
+                             self._getExtraPath('component%03d' % component))
+
     def _create3DModelFile(self, volumesPath):
         # Create model files for 3D classification
         with open(self._getFileName('out_class'), 'w') as output_file:
@@ -434,33 +399,9 @@ class ProtCryoSparc3DVariabilityDisplay(ProtCryosparcBase, ProtRefine3D):
                 row = ("%05d@%s/%s\n" % (i+1, filePath, csVolName))
                 output_file.write(row)
 
-    def _partClassDict(self, fileName, classNumber):
-        with open(os.path.abspath(fileName), 'r') as _file:
-            rawLine = _file.readline()
-
-            # Find data_particle block
-            while rawLine:
-                if rawLine.startswith('data_particles'):
-                    break
-                rawLine = _file.readline()
-
-            # Find metadatada labels
-            while rawLine:
-                if rawLine.startswith('loop_'):
-                    break
-                rawLine = _file.readline()
-
-            rawLine = _file.readline()
-            while rawLine.startswith('_'):
-                rawLine = _file.readline()
-
-            # Taking the particles ids
-            while rawLine:
-                line = rawLine.strip().split()[0].split('@')
-                partId = int(line[0])
-                imageName = '_'.join(line[1].split('_')[1:]).split('.')[0]
-                self.partClassDict.insert([imageName, partId], classNumber + 1)
-                rawLine = _file.readline()
+    def _partClassDict(self, csFile, classNumber):
+        """ Store the class of the particles of a cluster .cs file """
+        self.partClassDict.addCsFile(csFile, classNumber + 1)
 
     def _defineParamsName(self):
         """ Define a list with all protocol parameters names"""
@@ -39,13 +39,13 @@ from pwem.protocols import ProtInitialVolume, ProtClassify3D
 
 from .protocol_base import ProtCryosparcBase
 from ..convert import (convertCs2Star, cryosparcToLocation,
-                       rowToAlignment)
+                       rowToAlignment, ParticlesJoin)
 
 from ..utils import (addSymmetryParam, addComputeSectionParams,
                      cryosparcValidate, gpusValidate, getSymmetry, enqueueJob,
                      calculateNewSamplingRate, waitForCryosparc,
                      clearIntermediateResults, fixVolume, copyFiles,
-                     getOutputPreffix, matchItemRow)
+                     getOutputPreffix)
 from ..constants import *
 
 
@@ -320,8 +320,10 @@ class ProtCryoSparcInitialModel(ProtCryosparcBase, ProtInitialVolume,
 
         outputFolder = os.path.join(self._getExtraPath(), self.runAbinit.get())
 
-        # Copy the CS output to extra folder
-        copyFiles(csOutputFolder, outputFolder)
+        # Copy the CS output particles and volumes to extra folder
+        copyFiles(csOutputFolder, outputFolder,
+                  files=[csFileName, '*_class_*_final_volume.mrc'],
+                  numberOfWorkers=self.numberOfThreads.get())
 
         csFile = os.path.join(outputFolder, csFileName)
         outputClassFn = self._getFileName('out_particles')
@@ -407,22 +409,19 @@ class ProtCryoSparcInitialModel(ProtCryosparcBase, ProtInitialVolume,
         """ Create the SetOfClasses3D """
         outImgsFn = 'particles@' + filename
         self._loadClassesInfo(self._getFileName('out_class'))
-        clsSet.classifyItems(updateItemCallback=self._updateParticle,
-                             updateClassCallback=self._updateClass,
-                             itemDataIterator=emtable.Table.iterRows(outImgsFn),
-                             raiseOnNextFailure=False,
-                             cancelNextWhenAppendIsFalse=True)
+        join = ParticlesJoin(emtable.Table.iterRows(outImgsFn),
+                             self._getInputParticles())
+        clsSet.classifyItems(updateItemCallback=join.updateItemCallback(
+                                 self._updateParticle),
+                             updateClassCallback=self._updateClass)
 
     def _updateParticle(self, item, row):
-        if row is not None and matchItemRow(item, row):
-            if row.hasColumn(RELIONCOLUMNS.rlnClassNumber.value):
-                item.setClassId(row.get(RELIONCOLUMNS.rlnClassNumber.value))
-            else:
-                item.setClassId(1)
-            samplingRate = item.getSamplingRate()
-            item.setTransform(rowToAlignment(row, ALIGN_PROJ, samplingRate))
+        if row.hasColumn(RELIONCOLUMNS.rlnClassNumber.value):
+            item.setClassId(row.get(RELIONCOLUMNS.rlnClassNumber.value))
         else:
-            item._appendItem = False
+            item.setClassId(1)
+        samplingRate = item.getSamplingRate()
+        item.setTransform(rowToAlignment(row, ALIGN_PROJ, samplingRate))
 
     def _updateClass(self, item):
         classId = item.getObjId()
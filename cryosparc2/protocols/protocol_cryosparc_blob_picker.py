@@ -147,8 +147,8 @@ class ProtCryoSparcBlobPicker(ProtCryosparcBase):
                                       self.runBlobPicker.get())
         # Copy the CS output coordinates to extra folder
         outputPath = os.path.join(self._getExtraPath(), self.runBlobPicker.get())
-        copyFiles(csOutputFolder, outputPath)
         csPickedParticlesName = 'picked_particles.cs'
+        copyFiles(csOutputFolder, outputPath, files=[csPickedParticlesName])
 
         csFile = os.path.join(outputPath, csPickedParticlesName)
         outputStarFn = self._getExtraPath('output_coordinates.star')
@@ -162,9 +162,8 @@ class ProtCryoSparcBlobPicker(ProtCryosparcBase):
             csOutputFolder = os.path.join(self.projectDir.get(),
                                           self.runPatchCTF.get())
             outputPath = os.path.join(self._getExtraPath(), self.runPatchCTF.get())
-            copyFiles(csOutputFolder, outputPath)
-
             ctfEstimatedFileName = 'exposures_ctf_estimated.cs'
+            copyFiles(csOutputFolder, outputPath, files=[ctfEstimatedFileName])
             csFile = os.path.join(outputPath, ctfEstimatedFileName)
             outputStarFn = self._getExtraPath('ctf.star')
             argsList = [csFile, outputStarFn]
@@ -26,7 +26,6 @@
 # **************************************************************************
 import os
 
-import emtable
 from pkg_resources import parse_version
 
 from pwem import ALIGN_PROJ
@@ -39,7 +38,7 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam, IntParam,
                                         EnumParam)
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertCs2Star, createItemMatrix,
+from ..convert import (CsTable, ParticlesJoin, createItemMatrix,
                        setCryosparcAttributes)
 from ..utils import (addComputeSectionParams, cryosparcValidate, gpusValidate,
                      enqueueJob, waitForCryosparc, copyFiles,
@@ -55,6 +54,8 @@ class ProtCryoSparcGlobalCtfRefinement(ProtCryosparcBase, pwprot.ProtParticles):
     aberrations, against a given 3D reference
     """
     _label = 'global ctf refinement'
+    _csOutputGroups = {'outputParticles': 'particles'}
+    _csJobAttr = 'runGlobalCtfRefinement'
     _className = "ctf_refine_global"
     _protCompatibility = [V3_3_1, V3_3_2, V4_0_0, V4_0_1, V4_0_2, V4_0_3, V4_1_0,
                           V4_1_1, V4_1_2, V4_2_0, V4_2_1, V4_3_1, V4_4_0, V4_4_1, V4_5_1,
@@ -228,7 +229,6 @@ class ProtCryoSparcGlobalCtfRefinement(ProtCryosparcBase, pwprot.ProtParticles):
         Create the protocol output. Convert cryosparc file to Relion file
         """
         self._initializeUtilsVariables()
-        outputStarFn = self._getFileName('out_particles')
         csOutputFolder = os.path.join(self.projectDir.get(),
                                       self.runGlobalCtfRefinement.get())
         csFileName = "particles.cs"
@@ -238,25 +238,21 @@ class ProtCryoSparcGlobalCtfRefinement(ProtCryosparcBase, pwprot.ProtParticles):
 
         csFile = os.path.join(self._getExtraPath(), csFileName)
 
-        argsList = [csFile, outputStarFn]
-
-        convertCs2Star(argsList)
-
         imgSet = self._getInputParticles()
 
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputParticles=outImgSet)
         self._defineTransformRelation(imgSet, outImgSet)
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.setAlignmentProj()
+        join = ParticlesJoin(CsTable(csFile), self._getInputParticles())
         imgSet.copyItems(self._getInputParticles(),
-                         updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(outImgsFn))
+                         updateItemCallback=join.updateItemCallback(
+                             self._createItemMatrix))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=ALIGN_PROJ)
@@ -24,10 +24,8 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-import ast
 import os
 
-import emtable
 from pkg_resources import parse_version
 
 from pwem import ALIGN_PROJ
@@ -40,13 +38,13 @@ from pyworkflow.protocol.params import (PointerParam, LEVEL_ADVANCED, IntParam,
 from pwem.objects import Volume
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertCs2Star, createItemMatrix,
+from ..convert import (CsTable, ParticlesJoin, createItemMatrix,
                        setCryosparcAttributes)
 from ..utils import (addComputeSectionParams, calculateNewSamplingRate,
                      cryosparcValidate, gpusValidate, enqueueJob,
                      waitForCryosparc, clearIntermediateResults, fixVolume,
                      copyFiles, addSymmetryParam, getSymmetry,
-                     getCryosparcVersion, get_job_streamlog, getOutputPreffix)
+                     getCryosparcVersion, getOutputPreffix)
 from ..constants import *
 
 
@@ -54,6 +52,8 @@ class ProtCryoSparcHomogeneousReconstruct(ProtCryosparcBase):
     """ Create a 3D reconstruction from input particles that already have alignments in 3D.
     """
     _label = 'homogeneous reconstruction'
+    _csOutputGroups = {'outputParticles': 'particles', 'outputVolume': 'volume'}
+    _csJobAttr = 'runHomogeneousReconstruction'
     _className = "homo_reconstruct"
     _devStatus = NEW
     _fscColumns = 6
@@ -282,12 +282,10 @@ class ProtCryoSparcHomogeneousReconstruct(ProtCryosparcBase):
         copyFiles(csOutputFolder, self._getExtraPath(), files=[csParticlesName,
                                                                fnVolName,
                                                                half1Name,
-                                                               half2Name])
+                                                               half2Name],
+                  numberOfWorkers=self.numberOfThreads.get())
 
         csFile = os.path.join(self._getExtraPath(), csParticlesName)
-        outputStarFn = self._getFileName('out_particles')
-        argsList = [csFile, outputStarFn]
-        convertCs2Star(argsList)
 
         fnVol = os.path.join(self._getExtraPath(), fnVolName)
         half1 = os.path.join(self._getExtraPath(), half1Name)
@@ -303,7 +301,7 @@ class ProtCryoSparcHomogeneousReconstruct(ProtCryosparcBase):
 
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputVolume=vol)
         self._defineSourceRelation(self.inputParticles, vol)
@@ -311,12 +309,12 @@ class ProtCryoSparcHomogeneousReconstruct(ProtCryosparcBase):
         self._defineTransformRelation(self.inputParticles, outImgSet)
         self.createFSC(idd, imgSet, vol)
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.setAlignmentProj()
+        join = ParticlesJoin(CsTable(csFile), self._getInputParticles())
         imgSet.copyItems(self._getInputParticles(),
-                         updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(outImgsFn))
+                         updateItemCallback=join.updateItemCallback(
+                             self._createItemMatrix))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=ALIGN_PROJ)
@@ -324,25 +322,14 @@ class ProtCryoSparcHomogeneousReconstruct(ProtCryosparcBase):
                                RELIONCOLUMNS.rlnRandomSubset.value)
 
     def findLastIteration(self, jobName):
-        get_job_streamlog(self.projectName.get(),
-                          jobName,
-                          self._getFileName('stream_log'))
+        return self._readJobStreamLog(jobName).get('fscFileId')
 
-        # Get the metadata information from stream.log
-        with open(self._getFileName('stream_log')) as f:
-            data = f.readlines()
+    def _indexStreamLogEvent(self, event, index):
+        if 'text' in event:
+            z = str(event['text'])
 
-        x = ast.literal_eval(data[0])
-
-        # Find the ID of last iteration and the map resolution
-        for y in x:
-            if 'text' in y:
-                z = str(y['text'])
-
-                if z.startswith('FSC, after mask auto-tightening'):
-                    idd = y['imgfiles'][2]['fileid']
-
-        return idd
+            if z.startswith('FSC, after mask auto-tightening'):
+                index['fscFileId'] = event['imgfiles'][2]['fileid']
 
     # --------------------------- INFO functions -------------------------------
     def _validate(self):
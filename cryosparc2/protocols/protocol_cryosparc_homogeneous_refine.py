@@ -25,7 +25,6 @@
 # *
 # **************************************************************************
 import os
-import emtable
 from pkg_resources import parse_version
 
 import pwem.objects as pwobj
@@ -35,7 +34,7 @@ from pwem.convert.symmetry import moveParticleInsideUnitCell
 from pyworkflow.protocol.params import *
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertCs2Star, createItemMatrix,
+from ..convert import (CsTable, ParticlesJoin, createItemMatrix,
                        setCryosparcAttributes)
 from ..utils import (addSymmetryParam, addComputeSectionParams,
                      calculateNewSamplingRate,
@@ -55,6 +54,9 @@ class ProtCryoSparc3DHomogeneousRefine(ProtCryosparcBase):
         the fly.
     """
     _label = '3D homogeneous refinement'
+    # The output particles are moved inside the unit cell after cryoSPARC
+    _csOutputGroups = {'outputVolume': 'volume'}
+    _csJobAttr = 'runRefine'
     _fscColumns = 6
     _className = "homo_refine_new"
     ewsParamsName = []
@@ -464,15 +466,11 @@ class ProtCryoSparc3DHomogeneousRefine(ProtCryosparcBase):
         copyFiles(csOutputFolder, self._getExtraPath(), files=[csParticlesName,
                                                                fnVolName,
                                                                half1Name,
-                                                               half2Name])
+                                                               half2Name],
+                  numberOfWorkers=self.numberOfThreads.get())
 
         csFile = os.path.join(self._getExtraPath(), csParticlesName)
 
-        outputStarFn = self._getFileName('out_particles')
-        argsList = [csFile, outputStarFn]
-
-        convertCs2Star(argsList)
-
         fnVol = os.path.join(self._getExtraPath(), fnVolName)
         half1 = os.path.join(self._getExtraPath(), half1Name)
         half2 = os.path.join(self._getExtraPath(), half2Name)
@@ -489,7 +487,7 @@ class ProtCryoSparc3DHomogeneousRefine(ProtCryosparcBase):
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
         self._getUnitCellMatricesAndPlanes()
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         # if self.symmetryGroup.get() == SYM_DIHEDRAL_Y:
         #     from pwem.convert.symmetry import Dihedral
@@ -580,13 +578,12 @@ class ProtCryoSparc3DHomogeneousRefine(ProtCryosparcBase):
                                                  n=self.symmetryOrder.get(),
                                                  generalize=False)
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.setAlignmentProj()
+        join = ParticlesJoin(CsTable(csFile), self._getInputParticles())
         imgSet.copyItems(self._getInputParticles(),
-                         updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(
-                             fileName=outImgsFn))
+                         updateItemCallback=join.updateItemCallback(
+                             self._createItemMatrix))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=pwobj.ALIGN_PROJ)
@@ -26,8 +26,6 @@
 # **************************************************************************
 import os
 
-import emtable
-
 from pwem import ALIGN_PROJ
 from pwem.protocols import ProtParticles
 import pyworkflow.utils as pwutils
@@ -37,7 +35,7 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam,
 
 from .protocol_base import ProtCryosparcBase
 from .. import RELIONCOLUMNS
-from ..convert import (convertCs2Star, createItemMatrix,
+from ..convert import (CsTable, ParticlesJoin, createItemMatrix,
                        setCryosparcAttributes)
 from ..utils import (addComputeSectionParams, cryosparcValidate, gpusValidate,
                      enqueueJob, waitForCryosparc, copyFiles)
@@ -50,6 +48,8 @@ class ProtCryoSparcLocalCtfRefinement(ProtCryosparcBase, ProtParticles):
     against a given 3D reference structure.
     """
     _label = 'local ctf refinement'
+    _csOutputGroups = {'outputParticles': 'particles'}
+    _csJobAttr = 'runLocalCtfRefinement'
     _className = "ctf_refine_local"
 
     def _initialize(self):
@@ -163,7 +163,6 @@ class ProtCryoSparcLocalCtfRefinement(ProtCryosparcBase, ProtParticles):
         Create the protocol output. Convert cryosparc file to Relion file
         """
         self._initializeUtilsVariables()
-        outputStarFn = self._getFileName('out_particles')
         csOutputFolder = os.path.join(self.projectDir.get(),
                                       self.runLocalCtfRefinement.get())
         csFileName = "particles.cs"
@@ -173,25 +172,21 @@ class ProtCryoSparcLocalCtfRefinement(ProtCryosparcBase, ProtParticles):
 
         csFile = os.path.join(self._getExtraPath(), csFileName)
 
-        argsList = [csFile, outputStarFn]
-
-        convertCs2Star(argsList)
-
         imgSet = self._getInputParticles()
 
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputParticles=outImgSet)
         self._defineTransformRelation(imgSet, outImgSet)
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.setAlignmentProj()
+        join = ParticlesJoin(CsTable(csFile), self._getInputParticles())
         imgSet.copyItems(self._getInputParticles(),
-                         updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(outImgsFn))
+                         updateItemCallback=join.updateItemCallback(
+                             self._createItemMatrix))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=ALIGN_PROJ)
@@ -40,12 +40,14 @@ from pyworkflow.protocol.params import (FloatParam, LEVEL_ADVANCED,
 
 from .protocol_base import ProtCryosparcBase
 from ..convert import (convertBinaryVol, convertCs2Star,
-                       rowToAlignment, ALIGN_PROJ, cryosparcToLocation)
+                       rowToAlignment, ALIGN_PROJ, cryosparcToLocation,
+                       ParticlesJoin)
 from ..utils import (addComputeSectionParams, doImportVolumes,
-                     get_job_streamlog, calculateNewSamplingRate,
+                     calculateNewSamplingRate,
                      cryosparcValidate, gpusValidate, enqueueJob,
                      waitForCryosparc, clearIntermediateResults, fixVolume,
-                     copyFiles, getCryosparcVersion, getOutputPreffix, matchItemRow)
+                     copyFiles, getCryosparcVersion, getOutputPreffix,
+                     getFilesHash)
 from ..constants import *
 
 
@@ -352,7 +354,8 @@ class ProtCryoSparcNew3DClassification(ProtCryosparcBase):
 
         # Copy the CS output particles to extra folder
         copyFiles(csOutputFolder, self._getExtraPath(), files=[csParticlesName,
-                                                               csPassParticles])
+                                                               csPassParticles],
+                  numberOfWorkers=self.numberOfThreads.get())
 
         csFile = os.path.join(self._getExtraPath(), csParticlesName)
 
@@ -432,19 +435,16 @@ class ProtCryoSparcNew3DClassification(ProtCryosparcBase):
         """ Create the SetOfClasses3D """
         xmpMd = 'micrographs@' + filename
         self._loadClassesInfo(self._getFileName('out_class'))
-        clsSet.classifyItems(updateItemCallback=self._updateParticle,
-                             updateClassCallback=self._updateClass,
-                             itemDataIterator=emtable.Table.iterRows(xmpMd),
-                             raiseOnNextFailure=False,
-                             cancelNextWhenAppendIsFalse=True)
+        join = ParticlesJoin(emtable.Table.iterRows(xmpMd),
+                             self._getInputParticles())
+        clsSet.classifyItems(updateItemCallback=join.updateItemCallback(
+                                 self._updateParticle),
+                             updateClassCallback=self._updateClass)
 
     def _updateParticle(self, item, row):
-        if matchItemRow(item, row):
-            item.setClassId(row.get(RELIONCOLUMNS.rlnClassNumber.value))
-            # samplingRate = item.getSamplingRate()
-            # item.setTransform(rowToAlignment(row, ALIGN_PROJ, samplingRate))
-        else:
-            item._appendItem = False
+        item.setClassId(row.get(RELIONCOLUMNS.rlnClassNumber.value))
+        # samplingRate = item.getSamplingRate()
+        # item.setTransform(rowToAlignment(row, ALIGN_PROJ, samplingRate))
 
     def _updateClass(self, item):
         classId = item.getObjId()
@@ -483,36 +483,25 @@ class ProtCryoSparcNew3DClassification(ProtCryosparcBase):
                 output_file.write(row)
 
     def findLastIteration(self, jobName):
-        import ast
-        get_job_streamlog(self.projectName.get(),
-                          jobName,
-                          self._getFileName('stream_log'))
-
-        # Get the metadata information from stream.log
-        with open(self._getFileName('stream_log')) as f:
-            data = f.readlines()
-
-        x = ast.literal_eval(data[0])
-        it = None
+        it = self._readJobStreamLog(jobName).get('iteration')
         itera = None
 
-        # Find the ID of last iteration and the map resolution
-        for y in x:
-            if 'text' in y:
-                z = str(y['text'])
-                if z.startswith('Batch Class Distribution (Iteration:'):
-                    it = z.split(': ')[1].split(')')[0]
-                elif z.startswith('Viewing Direction Distribution (Iteration'):
-                    it = z.split(' ')[4].split(')')[0]
-
-                if it is not None:
-                    if int(it) > 99:
-                        itera = it
-                    else:
-                        itera = '0' + it if int(it) >= 10 else '00' + it
+        if it is not None:
+            if int(it) > 99:
+                itera = it
+            else:
+                itera = '0' + it if int(it) >= 10 else '00' + it
 
         return itera
 
+    def _indexStreamLogEvent(self, event, index):
+        if 'text' in event:
+            z = str(event['text'])
+            if z.startswith('Batch Class Distribution (Iteration:'):
+                index['iteration'] = z.split(': ')[1].split(')')[0]
+            elif z.startswith('Viewing Direction Distribution (Iteration'):
+                index['iteration'] = z.split(' ')[4].split(')')[0]
+
     # --------------------------- INFO functions -------------------------------
 
     def _validate(self):
@@ -564,9 +553,11 @@ class ProtCryoSparcNew3DClassification(ProtCryosparcBase):
                                        convertBinaryVol(
                                            vol,
                                            self._getTmpPath()))
-            self.importVolume = doImportVolumes(self, self.vol_fn, vol,
-                                                'map',
-                                                'Importing volume...')
+            self.importVolume = self._doImport(
+                getFilesHash([vol.getFileName()], 'map', vol.getSamplingRate()),
+                lambda: doImportVolumes(self, self.vol_fn, vol, 'map',
+                                        'Importing volume...', wait=False),
+                'volume')
             self.importVolumes.append(self.importVolume.get())
             self.currenJob.set(self.importVolume.get())
 
@@ -25,7 +25,8 @@
 # *
 # **************************************************************************
 import os
-import emtable
+
+import numpy as np
 
 from pwem import ALIGN_PROJ
 from pwem.protocols import ProtOperateParticles
@@ -36,7 +37,8 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam,
                                         LEVEL_ADVANCED, Positive, BooleanParam)
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertCs2Star, cryosparcToLocation, rowToCtfModel, rowToAlignment)
+from ..convert import (iterCsRows, cryosparcToLocation, rowToCtfModel, rowToAlignment,
+                       CsFile)
 from ..utils import (addComputeSectionParams, calculateNewSamplingRate,
                      cryosparcValidate, gpusValidate, enqueueJob,
                      waitForCryosparc, clearIntermediateResults, copyFiles)
@@ -48,6 +50,8 @@ class ProtCryoSparcSubtract(ProtCryosparcBase, ProtOperateParticles):
         Subtract projections of a masked volume from particles.
         """
     _label = 'subtract projection'
+    _csOutputGroups = {'outputParticles': 'particles'}
+    _csJobAttr = 'runPartStract'
     _className = "particle_subtract"
 
     def _initialize(self):
@@ -159,34 +163,37 @@ class ProtCryoSparcSubtract(ProtCryosparcBase, ProtOperateParticles):
         Create the protocol output. Convert cryosparc file to Relion file
         """
         self._initializeUtilsVariables()
-        outputStarFn = self._getFileName('out_particles')
         csOutputFolder = os.path.join(self.projectDir.get(),
                                       self.runPartStract.get())
         csFileName = "subtracted_particles.cs"
 
         # Create the output folder
         copyFiles(csOutputFolder, os.path.join(self._getExtraPath(),
-                                               self.runPartStract.get()))
+                                               self.runPartStract.get()),
+                  files=[csFileName])
 
         csFile = os.path.join(self._getExtraPath(), self.runPartStract.get(),
                               csFileName)
-        argsList = [csFile, outputStarFn]
-        convertCs2Star(argsList)
+
+        # Harvest only the subtracted stacks used by the particles (their
+        # paths are relative to the cryoSPARC project)
+        stacks = np.unique(CsFile(csFile).getField('blob/path'))
+        copyFiles(self.projectDir.get(), self._getExtraPath(),
+                  files=[stack.decode() for stack in stacks],
+                  numberOfWorkers=self.numberOfThreads.get())
 
         imgSet = self._getInputParticles()
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputParticles=outImgSet)
         self._defineTransformRelation(imgSet, outImgSet)
 
-    def _fillDataFromIter(self, imgSet):
-
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.copyItems(self._getInputParticles(),
                          updateItemCallback=self._updateItem,
-                         itemDataIterator=emtable.Table.iterRows(outImgsFn))
+                         itemDataIterator=iterCsRows(csFile))
 
     def _updateItem(self, item, row):
         newFn = row.get(RELIONCOLUMNS.rlnImageName.value)
@@ -137,9 +137,8 @@ class ProtCryoSparcPatchCTFEstimate(ProtCryosparcBase):
         csOutputFolder = os.path.join(self.projectDir.get(),
                                       self.runPatchCTF.get())
         outputPath = os.path.join(self._getExtraPath(), self.runPatchCTF.get())
-        copyFiles(csOutputFolder, outputPath)
-
         ctfEstimatedFileName = 'exposures_ctf_estimated.cs'
+        copyFiles(csOutputFolder, outputPath, files=[ctfEstimatedFileName])
         csFile = os.path.join(outputPath, ctfEstimatedFileName)
         outputStarFn = self._getExtraPath('ctf.star')
         argsList = [csFile, outputStarFn]
@@ -0,0 +1,752 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+import emtable
+import numpy as np
+
+from pwem.constants import ALIGN_PROJ, ALIGN_2D, ALIGN_NONE
+from pwem.objects import (Particle, SetOfParticles, SetOfParticlesFlex,
+                          CTFModel, Transform, Coordinate)
+from pyworkflow.object import Float, Integer, String
+from pwem.convert.transformations import euler_matrix
+
+from cryosparc2.constants import RELIONCOLUMNS
+from cryosparc2.convert import (cryoSPARCImport, CsFile, CsTable, iterCsRows,
+                                iterCsTables, iterCsChunkedRows, rowToAlignment,
+                                rowToCtfModel, matrixFromGeometry,
+                                matricesFromGeometry, StackCache, ParticlesJoin,
+                                readCsLocations, ParticlesClassIndex,
+                                readCsLatents, appendParticlesFlex,
+                                ParticlesIndex, iterItemsById,
+                                readStarRowHashes, matchRows,
+                                particlesToCsFields, writeCsFile,
+                                readCsRowHashes, cryosPARCwriteSetOfParticles,
+                                particlesToStarColumns, addRandomSubset,
+                                setCryosparcAttributes, getRowSetter)
+from cryosparc2.convert.convert import _writeParticlesRows
+from cryosparc2.convert.csconvert import (_expmap, _logmap, _hashRows,
+                                          csFieldsToColumns)
+
+
+def relionEulerMatrix(rot, tilt, psi):
+    """ Relion's Euler_angles2matrix (angles in degrees) """
+    a, b, g = np.deg2rad([rot, tilt, psi])
+    ca, sa, cb, sb, cg, sg = (np.cos(a), np.sin(a), np.cos(b), np.sin(b),
+                              np.cos(g), np.sin(g))
+    cc, cs, sc, ss = cb * ca, cb * sa, sb * ca, sb * sa
+    return np.array([[cg * cc - sg * sa, cg * cs + sg * ca, -cg * sb],
+                     [-sg * cc - cg * sa, -sg * cs + cg * ca, sg * sb],
+                     [sc, ss, cb]])
+
+
+class TestCsConvert(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.size = 5
+        dtype = [('uid', '<u8'), ('blob/path', 'S32'), ('blob/idx', '<u4'),
+                 ('blob/psize_A', '<f4'),
+                 ('ctf/df1_A', '<f4'), ('ctf/df2_A', '<f4'),
+                 ('ctf/df_angle_rad', '<f4'), ('ctf/phase_shift_rad', '<f4'),
+                 ('alignments3D/split', '<u4'),
+                 ('alignments3D/shift', '<f4', (2,)),
+                 ('alignments3D/pose', '<f4', (3,))]
+        cs = np.zeros(self.size, dtype=dtype)
+        cs['uid'] = np.arange(100, 100 + self.size)
+        cs['blob/path'] = [b'J1/imported/%d_stack.mrcs' % (i % 2)
+                           for i in range(self.size)]
+        cs['blob/idx'] = np.arange(self.size)
+        cs['blob/psize_A'] = 2.
+        cs['ctf/df1_A'] = 10000.
+        cs['ctf/df2_A'] = 12000.
+        cs['ctf/df_angle_rad'] = np.pi / 4
+        cs['alignments3D/split'] = np.arange(self.size) % 2
+        cs['alignments3D/shift'] = rng.uniform(-5, 5, (self.size, 2))
+        cs['alignments3D/pose'] = rng.uniform(-2, 2, (self.size, 3))
+        self.cs = cs
+        self.csFile = os.path.join(self.tmpDir, 'particles.cs')
+        with open(self.csFile, 'wb') as f:
+            np.save(f, cs)
+
+        # Passthrough without the first particle
+        pt = np.zeros(self.size - 1, dtype=[('uid', '<u8'),
+                                            ('location/micrograph_path', 'S32'),
+                                            ('location/center_x_frac', '<f4'),
+                                            ('location/center_y_frac', '<f4'),
+                                            ('location/micrograph_shape', '<u4', (2,))])
+        pt['uid'] = cs['uid'][1:][::-1]
+        pt['location/micrograph_path'] = b'mic.mrc'
+        pt['location/center_x_frac'] = 0.25
+        pt['location/center_y_frac'] = 0.25
+        pt['location/micrograph_shape'] = (400, 800)
+        self.ptFile = os.path.join(self.tmpDir, 'passthrough.cs')
+        with open(self.ptFile, 'wb') as f:
+            np.save(f, pt)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testColumns(self):
+        rows = list(iterCsRows(self.csFile))
+        self.assertEqual(len(rows), self.size)
+        row = rows[1]
+        self.assertEqual(row.get(RELIONCOLUMNS.rlnImageName.value),
+                         '000002@J1/imported/1_stack.mrcs')
+        self.assertEqual(row.get(RELIONCOLUMNS.rlnRandomSubset.value), 2)
+        self.assertIsInstance(row.get(RELIONCOLUMNS.rlnRandomSubset.value), int)
+        self.assertAlmostEqual(row.get(RELIONCOLUMNS.rlnDefocusAngle.value), 45, 4)
+        self.assertEqual(row.get(RELIONCOLUMNS.rlnPhaseShift.value), 0)
+        self.assertAlmostEqual(row.get(RELIONCOLUMNS.rlnOriginXAngst.value),
+                               2 * float(self.cs['alignments3D/shift'][1, 0]), 4)
+        self.assertFalse(row.hasColumn(RELIONCOLUMNS.rlnVoltage.value))
+        self.assertEqual(row.get(RELIONCOLUMNS.rlnVoltage.value, 300), 300)
+
+        # The euler angles describe the same rotation as the pose
+        poses = _expmap(self.cs['alignments3D/pose'].astype(np.float64))
+        for row, pose in zip(rows, poses):
+            angles = [row.get(RELIONCOLUMNS.rlnAngleRot.value),
+                      row.get(RELIONCOLUMNS.rlnAngleTilt.value),
+                      row.get(RELIONCOLUMNS.rlnAnglePsi.value)]
+            np.testing.assert_allclose(relionEulerMatrix(*angles), pose,
+                                       atol=1e-6)
+
+        ctfModel = rowToCtfModel(row)
+        # standardize() keeps defocusU >= defocusV
+        self.assertAlmostEqual(ctfModel.getDefocusU(), 12000)
+        self.assertAlmostEqual(ctfModel.getDefocusV(), 10000)
+        transform = rowToAlignment(row, ALIGN_PROJ, 2.)
+        self.assertEqual(transform.getMatrix().shape, (4, 4))
+
+    def testRowSetter(self):
+        label = RELIONCOLUMNS.rlnRandomSubset.value
+        table = CsTable(self.csFile)
+        rows = list(table.iterRows())
+        # The setter is resolved once and reused by all the rows of the table
+        self.assertIs(getRowSetter(rows[0], extraLabels=[label]),
+                      getRowSetter(rows[-1], extraLabels=[label]))
+        self.assertIsNot(getRowSetter(rows[0], extraLabels=[label]),
+                         getRowSetter(CsTable(self.csFile).getRow(0),
+                                      extraLabels=[label]))
+        for row, split in zip(rows, self.cs['alignments3D/split']):
+            particle = Particle()
+            setCryosparcAttributes(particle, row, label)
+            self.assertIsInstance(particle._rlnRandomSubset, Integer)
+            self.assertEqual(particle._rlnRandomSubset.get(), split + 1)
+
+        # STAR rows: the types are resolved from the first row
+        starFile = os.path.join(self.tmpDir, 'particles.star')
+        with open(starFile, 'w') as f:
+            f.write('\ndata_particles\n\nloop_\n_rlnImageName #1\n'
+                    '_rlnDefocusU #2\n_rlnRandomSubset #3\n')
+            for i in range(1, 4):
+                f.write('%06d@stack.mrcs %f %d\n' % (i, 1000.5 * i, i % 2 + 1))
+        for i, row in enumerate(emtable.Table.iterRows(starFile), 1):
+            particle = Particle()
+            setCryosparcAttributes(particle, row, label,
+                                   RELIONCOLUMNS.rlnDefocusU.value,
+                                   RELIONCOLUMNS.rlnImageName.value)
+            self.assertEqual(particle._rlnRandomSubset.get(), i % 2 + 1)
+            self.assertIsInstance(particle._rlnDefocusU, Float)
+            self.assertAlmostEqual(particle._rlnDefocusU.get(), 1000.5 * i)
+            self.assertIsInstance(particle._rlnImageName, String)
+            self.assertFalse(hasattr(particle, '_rlnVoltage'))
+
+    def testCsFile(self):
+        csFile = CsFile(self.csFile)
+        self.assertEqual(len(csFile), self.size)
+        self.assertEqual(csFile.getNames('alignments3D/'),
+                         ['alignments3D/split', 'alignments3D/shift',
+                          'alignments3D/pose'])
+        pose = csFile.getField('alignments3D/pose')
+        self.assertIsInstance(pose.base, np.memmap)
+        np.testing.assert_array_equal(pose, self.cs['alignments3D/pose'])
+
+        chunks = list(csFile.iterChunks('uid', 'ctf/df1_A', chunkSize=2))
+        self.assertEqual([len(c['uid']) for c in chunks], [2, 2, 1])
+        self.assertEqual(set(chunks[0]), {'uid', 'ctf/df1_A'})
+        np.testing.assert_array_equal(np.concatenate([c['uid'] for c in chunks]),
+                                      self.cs['uid'])
+
+        emptyFile = os.path.join(self.tmpDir, 'empty.cs')
+        with open(emptyFile, 'wb') as f:
+            np.save(f, self.cs[:0])
+        self.assertEqual(len(CsFile(emptyFile)), 0)
+        self.assertEqual(len(CsTable(emptyFile)), 0)
+
+    def testLocations(self):
+        stacks, stackIds, indexes = readCsLocations(self.csFile)
+        self.assertEqual(stacks, ['0_stack', '1_stack'])
+        self.assertEqual(stackIds.tolist(), [0, 1, 0, 1, 0])
+        self.assertEqual(indexes.dtype, np.int64)
+        self.assertEqual(indexes.tolist(), [1, 2, 3, 4, 5])
+
+    def testClassIndex(self):
+        index = ParticlesClassIndex()
+        index.addCsFile(self.csFile, 1)
+        index.addParticles(['other'], [0, 0], [1, 7], 2)
+        index.addParticles(['1_stack'], [0], [2], 3)  # last class is kept
+        self.assertEqual(len(index), 7)
+        classes = index.getClasses(['/data/stack.mrcs', '/data/1_stack.mrcs',
+                                    '/data/other.mrc', '/data/other.mrc',
+                                    '/data/unknown.mrc'], [1, 2, 7, 2, 1])
+        self.assertEqual(classes.tolist(), [1, 3, 2, 0, 0])
+        item = MagicMock()
+        item.getLocation.return_value = (5, '/data/stack.mrcs')
+        self.assertEqual(index.getClass(item), 1)
+        item.getLocation.return_value = (6, '/data/stack.mrcs')
+        self.assertEqual(index.getClass(item), 0)
+
+    def testParticlesIndex(self):
+        index = ParticlesIndex()
+        index.addCsFile(self.csFile, np.arange(1, self.size + 1) * 10)
+        self.assertEqual(index.getValues(['/data/stack.mrc'] * 2, [3, 9], default=-1).tolist(),
+                         [30, -1])
+        item = MagicMock()
+        item.getLocation.return_value = (2, 'other/1_stack.hdf')
+        self.assertEqual(index.getValue(item), 20)
+
+        # Stacks whose own name starts with digits and an underscore
+        index = ParticlesIndex()
+        index.addParticles(['0123_001_mic', '002_mic'], [0, 1], [1, 1], [1, 2])
+        self.assertEqual(index.getValues(['/data/001_mic.mrc', '/data/002_mic.mrc',
+                                          '/data/mic.mrc'], [1, 1, 1]).tolist(),
+                         [1, 2, 2])
+
+    def testChunks(self):
+        tables = list(iterCsTables(self.csFile, self.ptFile, chunkSize=2))
+        # The first particle is not in the passthrough file
+        self.assertEqual([len(t) for t in tables], [1, 2, 1])
+        label = RELIONCOLUMNS.rlnImageName.value
+        expected = CsTable(self.csFile, self.ptFile).getColumnValues(label)
+        self.assertEqual([v for t in tables for v in t.getColumnValues(label)],
+                         expected)
+        rows = iterCsChunkedRows(self.csFile, chunkSize=2)
+        self.assertEqual([row.get(RELIONCOLUMNS.rlnAngleRot.value) for row in rows],
+                         CsTable(self.csFile).getColumnValues(RELIONCOLUMNS.rlnAngleRot.value))
+
+    def testPassthrough(self):
+        table = CsTable(self.csFile, self.ptFile)
+        self.assertEqual(len(table), self.size - 1)
+        row = table.getRow(0)
+        self.assertEqual(row.get(RELIONCOLUMNS.rlnImageName.value),
+                         '000002@J1/imported/1_stack.mrcs')
+        self.assertEqual(row.get(RELIONCOLUMNS.rlnMicrographName.value), 'mic.mrc')
+        self.assertEqual(row.get(RELIONCOLUMNS.rlnCoordinateX.value), 200)
+        self.assertEqual(row.get(RELIONCOLUMNS.rlnCoordinateY.value), 300)
+
+    def testCoordinates(self):
+        # The coordinates are truncated, as pyem does
+        fields = {'location/center_x_frac': np.array([0.2509, 0.5], dtype=np.float32),
+                  'location/center_y_frac': np.array([0.2509, 0.001], dtype=np.float32),
+                  'location/micrograph_shape': np.array([(400, 800)] * 2, dtype=np.uint32)}
+        columns = csFieldsToColumns(fields)
+        self.assertEqual(columns[RELIONCOLUMNS.rlnCoordinateX.value].tolist(), [200, 400])
+        self.assertEqual(columns[RELIONCOLUMNS.rlnCoordinateY.value].tolist(), [299, 399])
+
+
+class TestBatchedGeometry(unittest.TestCase):
+
+    def testMatricesFromGeometry(self):
+        rng = np.random.default_rng(1)
+        angles = rng.uniform(-180, 180, (20, 3))
+        shifts = rng.uniform(-10, 10, (20, 3))
+
+        # Same rotation convention than euler_matrix
+        radAngles = -np.deg2rad(angles[0])
+        M = matricesFromGeometry(np.zeros((1, 3)), angles[:1], False)[0]
+        np.testing.assert_allclose(M, euler_matrix(*radAngles, 'szyz'),
+                                   atol=1e-12)
+
+        for inverse in [False, True]:
+            matrices = matricesFromGeometry(shifts, angles, inverse)
+            self.assertEqual(matrices.shape, (20, 4, 4))
+            for M, s, a in zip(matrices, shifts, angles):
+                np.testing.assert_allclose(M, matrixFromGeometry(s, a, inverse),
+                                           atol=1e-10)
+
+    def testRowsAlignment(self):
+        table = CsTable.__new__(CsTable)
+        table._size = 3
+        table._arrays = {RELIONCOLUMNS.rlnOriginXAngst.value: np.array([2., 4., -2.]),
+                         RELIONCOLUMNS.rlnAnglePsi.value: np.array([10., 20., 30.])}
+        table._columns = {k: v.tolist() for k, v in table._arrays.items()}
+        table._matrices = {}
+
+        for alignType in [ALIGN_2D, ALIGN_PROJ]:
+            for row in table.iterRows():
+                alignment = rowToAlignment(row, alignType, 2.)
+                shifts = [row.get(RELIONCOLUMNS.rlnOriginXAngst.value) / 2., 0, 0]
+                psi = row.get(RELIONCOLUMNS.rlnAnglePsi.value)
+                angles = [0, 0, -psi if alignType == ALIGN_2D else psi]
+                np.testing.assert_allclose(alignment.getMatrix(),
+                                           matrixFromGeometry(np.array(shifts),
+                                                              np.array(angles),
+                                                              alignType == ALIGN_PROJ),
+                                           atol=1e-10)
+        self.assertEqual(len(table._matrices), 2)
+
+
+class TestCryoSPARCImport(unittest.TestCase):
+
+    def testFindImagesFrom(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            jobDir = os.path.join(tmpDir, 'J2')
+            os.makedirs(os.path.join(tmpDir, 'J1', 'imported'))
+            os.makedirs(jobDir)
+            for i in range(3):
+                open(os.path.join(tmpDir, 'J1', 'imported',
+                                  '1234_stack%d.mrcs' % i), 'w').close()
+            csFile = os.path.join(jobDir, 'J2_particles.cs')
+
+            csImport = cryoSPARCImport(MagicMock(), csFile)
+            with patch('os.listdir', wraps=os.listdir) as listdir:
+                for _ in range(10):
+                    for i in range(3):
+                        path = csImport.findImagesFrom(csFile, 'J1/imported/stack%d.mrcs' % i)
+                        self.assertEqual(path, os.path.join(tmpDir, 'J1', 'imported',
+                                                            '1234_stack%d.mrcs' % i))
+                # Both folders are listed only once
+                self.assertEqual(listdir.call_count, 2)
+
+                with self.assertRaises(Exception):
+                    csImport.findImagesFrom(csFile, 'J1/imported/missing.mrcs')
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+class TestStackCache(unittest.TestCase):
+
+    def testGetStacks(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            files = []
+            for i in range(3):
+                fn = os.path.join(tmpDir, 'run%d' % i, 'particles.hdf')
+                os.makedirs(os.path.dirname(fn))
+                with open(fn, 'w') as f:
+                    f.write('stack %d' % i)
+                files.append(fn)
+
+            def convert(fn, newFn):
+                shutil.copy(fn, newFn)
+                return newFn
+
+            cacheDir = os.path.join(tmpDir, 'cache')
+            with patch('cryosparc2.convert.convert._convertStack',
+                       side_effect=convert) as convertStack:
+                stacks = StackCache(cacheDir).getStacks(files[:2], numberOfWorkers=1)
+                self.assertEqual(convertStack.call_count, 2)
+                # Same base name, different cached stacks
+                self.assertEqual(len(set(stacks.values())), 2)
+                for fn in files[:2]:
+                    self.assertTrue(stacks[fn].endswith('particles.mrc'))
+                    with open(stacks[fn]) as f, open(fn) as g:
+                        self.assertEqual(f.read(), g.read())
+
+                # Another run only converts the new stack
+                newStacks = StackCache(cacheDir).getStacks(files, numberOfWorkers=1)
+                self.assertEqual(convertStack.call_count, 3)
+                self.assertEqual(newStacks[files[0]], stacks[files[0]])
+
+                # A modified stack is converted again
+                with open(files[0], 'a') as f:
+                    f.write(' modified')
+                newStacks = StackCache(cacheDir).getStacks(files, numberOfWorkers=1)
+                self.assertEqual(convertStack.call_count, 4)
+                self.assertNotEqual(newStacks[files[0]], stacks[files[0]])
+                # ... and the stack of the old version is deleted
+                self.assertFalse(os.path.exists(stacks[files[0]]))
+
+                # The stacks of removed sources are deleted too
+                shutil.rmtree(os.path.dirname(files[2]))
+                cache = StackCache(cacheDir)
+                self.assertEqual(len(cache.clean()), 2)
+                self.assertEqual(len(cache.index.read()), 2)
+                self.assertFalse(os.path.exists(newStacks[files[2]]))
+                self.assertTrue(os.path.exists(newStacks[files[1]]))
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+class TestFlex(unittest.TestCase):
+
+    def testLatents(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            size = 4
+            cs = np.zeros(size, dtype=[('uid', '<u8'),
+                                       ('components_mode_1/component', '<u4'),
+                                       ('components_mode_1/value', '<f4'),
+                                       ('components_mode_0/component', '<u4'),
+                                       ('components_mode_0/value', '<f4')])
+            cs['components_mode_0/value'] = np.arange(size)
+            cs['components_mode_1/value'] = -np.arange(size) / 2
+            csFile = os.path.join(tmpDir, 'latents.cs')
+            with open(csFile, 'wb') as f:
+                np.save(f, cs)
+
+            zValues = readCsLatents(csFile)
+            self.assertEqual(zValues.dtype, np.float32)
+            np.testing.assert_array_equal(zValues[:, 0], cs['components_mode_0/value'])
+            np.testing.assert_array_equal(zValues[:, 1], cs['components_mode_1/value'])
+
+            particles = []
+            for i in range(size):
+                particle = Particle(location=(i + 1, 'particles.mrcs'))
+                particle.setObjId(10 + i)
+                particles.append(particle)
+            partSet = SetOfParticlesFlex.create(tmpDir, suffix='', progName='test')
+            appendParticlesFlex(partSet, particles, zValues, 'test', commitEvery=3)
+            partSet.write()
+            self.assertEqual(partSet.getSize(), size)
+            for i, particle in enumerate(partSet.iterItems(orderBy='id')):
+                self.assertEqual(particle.getObjId(), i + 1)
+                self.assertEqual(particle.getLocation(), (i + 1, 'particles.mrcs'))
+                np.testing.assert_allclose(particle.getZFlex(), zValues[i])
+            partSet.close()
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+class TestCsWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testLogmap(self):
+        rng = np.random.default_rng(2)
+        axes = rng.normal(size=(50, 3))
+        axes /= np.linalg.norm(axes, axis=1)[:, None]
+        angles = rng.uniform(0, np.pi, 50)
+        angles[:3] = [0, np.pi, np.pi - 1e-9]
+        e = axes * angles[:, None]
+        r = _expmap(e)
+        np.testing.assert_allclose(_expmap(_logmap(r)), r, atol=1e-7)
+        np.testing.assert_allclose(_logmap(r)[3:], e[3:], atol=1e-7)
+
+    def _createParticles(self, alignType, matrices):
+        partSet = SetOfParticles(filename=os.path.join(self.tmpDir, 'particles.sqlite'))
+        partSet.setSamplingRate(2.)
+        acquisition = partSet.getAcquisition()
+        acquisition.setVoltage(300.)
+        acquisition.setSphericalAberration(2.7)
+        acquisition.setAmplitudeContrast(0.1)
+        partSet.setHasCTF(True)
+        if alignType == ALIGN_PROJ:
+            partSet.setAlignmentProj()
+        else:
+            partSet.setAlignment2D()
+        for i, matrix in enumerate(matrices):
+            part = Particle(location=(i // 2 + 1, 'stack%d.mrcs' % (i % 2)))
+            part.setCTF(CTFModel(defocusU=10000. + i, defocusV=9000. + i,
+                                 defocusAngle=30.))
+            part.setTransform(Transform(matrix))
+            partSet.append(part)
+        return partSet
+
+    def _writeCs(self, partSet, fileName, **kwargs):
+        with patch.object(partSet, 'getDimensions', return_value=(64, 64, 1)):
+            fields = particlesToCsFields(partSet, **kwargs)
+        csFile = os.path.join(self.tmpDir, fileName)
+        writeCsFile(csFile, fields)
+        return csFile
+
+    def testWriteParticles(self):
+        rng = np.random.default_rng(3)
+        size = 6
+        angles = rng.uniform(-180, 180, (size, 3))
+        shifts = rng.uniform(-5, 5, (size, 3))
+        shifts[:, 2] = 0
+
+        for alignType in [ALIGN_PROJ, ALIGN_2D]:
+            if alignType == ALIGN_2D:
+                angles[:, :2] = 0
+            matrices = matricesFromGeometry(shifts, angles, alignType == ALIGN_PROJ)
+            partSet = self._createParticles(alignType, matrices)
+            csFile = self._writeCs(partSet, 'particles.cs')
+
+            cs = CsFile(csFile)
+            self.assertEqual(len(cs), size)
+            self.assertEqual(cs.getField('blob/shape')[0].tolist(), [64, 64])
+            table = CsTable(csFile)
+            self.assertEqual(table.getColumnValues(RELIONCOLUMNS.rlnImageName.value)[:3],
+                             ['000001@stack0.mrcs', '000001@stack1.mrcs',
+                              '000002@stack0.mrcs'])
+            np.testing.assert_allclose(
+                table.getColumnValues(RELIONCOLUMNS.rlnDefocusU.value),
+                10000. + np.arange(size))
+            np.testing.assert_allclose(cs.getField('ctf/df_angle_rad'),
+                                       np.deg2rad(30.), rtol=1e-6)
+            # The alignment read back is the same
+            np.testing.assert_allclose(table.getAlignmentMatrices(alignType, 2.),
+                                       matrices, atol=1e-4)
+            if alignType == ALIGN_PROJ:
+                self.assertEqual(cs.getField('alignments3D/split').tolist(),
+                                 [1, 0, 1, 0, 1, 0])
+            partSet.close()
+            os.remove(partSet.getFileName())
+
+    def testRowHashes(self):
+        matrices = matricesFromGeometry(np.zeros((4, 3)), np.zeros((4, 3)), True)
+        partSet = self._createParticles(ALIGN_PROJ, matrices)
+        filesDict = {'stack0.mrcs': 'Runs/000001_Import/input/stack0.mrcs',
+                     'stack1.mrcs': 'Runs/000001_Import/input/stack1.mrcs'}
+        csFile = self._writeCs(partSet, 'first.cs', filesDict=filesDict)
+        header, rows = readCsRowHashes(csFile, strip='Runs/000001_Import')
+
+        # Other uids and run folder (with a longer path) do not matter
+        longer = {k: v.replace('000001_Import', '000002_ImportParticles')
+                  for k, v in filesDict.items()}
+        otherFile = self._writeCs(partSet, 'second.cs', filesDict=longer)
+        otherHeader, otherRows = readCsRowHashes(otherFile,
+                                                 strip='Runs/000002_ImportParticles')
+        self.assertEqual(otherHeader, header)
+        np.testing.assert_array_equal(otherRows, rows)
+        self.assertEqual(len(set(rows.tolist())), 4)
+        partSet.close()
+
+        # Any byte of the row changes its hash, also in the last (partial) word
+        rowBytes = np.zeros((4, 13), dtype=np.uint8)
+        rowBytes[1, 0] = 1
+        rowBytes[2, 12] = 1
+        hashes = _hashRows(rowBytes)
+        self.assertEqual(hashes.dtype, np.uint64)
+        self.assertEqual(hashes[0], hashes[3])
+        self.assertEqual(len(set(hashes.tolist())), 3)
+
+class TestStarColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _createParticles(self, name, alignType, withCoords=True):
+        rng = np.random.default_rng(4)
+        size = 20
+        matrices = matricesFromGeometry(rng.uniform(-5, 5, (size, 3)),
+                                        rng.uniform(-180, 180, (size, 3)),
+                                        alignType == ALIGN_PROJ)
+        partSet = SetOfParticles(filename=os.path.join(self.tmpDir, name + '.sqlite'))
+        partSet.setSamplingRate(1.5)
+        acquisition = partSet.getAcquisition()
+        acquisition.setVoltage(300.)
+        acquisition.setSphericalAberration(2.7)
+        acquisition.setAmplitudeContrast(0.1)
+        acquisition.setMagnification(50000.)
+        partSet.setHasCTF(True)
+        partSet.setAlignment(alignType)
+        for i in range(size):
+            part = Particle(location=(i + 1, 'stack %d.mrcs' % (i % 3)))
+            part.setAcquisition(acquisition.clone())
+            ctf = CTFModel(defocusU=10000. + i * 13.37, defocusV=9000.,
+                           defocusAngle=rng.uniform(-90, 90))
+            ctf.setPhaseShift(rng.uniform(0, 0.002))
+            part.setCTF(ctf)
+            if alignType != ALIGN_NONE:
+                part.setTransform(Transform(matrices[i]))
+            if withCoords:
+                coord = Coordinate()
+                coord.setX(100 + i)
+                coord.setY(200)
+                coord.setMicName('mic %d.mrc' % (i % 2))
+                coord.setMicId(i % 2 + 1)
+                coord._rlnClassNumber = Integer(i % 4)
+                part.setCoordinate(coord)
+                part.setMicId(i % 2 + 1)
+            # Small values are written in scientific notation
+            part._rlnParticleSelectZScore = Float(rng.uniform(-0.01, 0.01))
+            partSet.append(part)
+        partSet.write()
+        return partSet
+
+    def _assertSameStar(self, partSet, **kwargs):
+        self.assertIsNotNone(particlesToStarColumns(partSet, **kwargs))
+        columnsFile = os.path.join(self.tmpDir, 'columns.star')
+        rowsFile = os.path.join(self.tmpDir, 'rows.star')
+        cryosPARCwriteSetOfParticles(partSet, columnsFile, None, **kwargs)
+        _writeParticlesRows(partSet, rowsFile, **kwargs)
+        with open(columnsFile) as f1, open(rowsFile) as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def testSameAsRows(self):
+        for alignType in [ALIGN_PROJ, ALIGN_2D, ALIGN_NONE]:
+            partSet = self._createParticles('particles%s' % alignType, alignType)
+            self._assertSameStar(partSet, fillMagnification=True,
+                                 fillRandomSubset=True,
+                                 postprocessImageRow=addRandomSubset)
+            self._assertSameStar(partSet, filesDict={'stack 0.mrcs': 'input/stack0.mrcs'},
+                                 blockName='images')
+            partSet.close()
+
+        partSet = self._createParticles('noCoords', ALIGN_PROJ, withCoords=False)
+        self._assertSameStar(partSet, writeCtf=False)
+        # Other row hooks can only be applied row by row
+        self.assertIsNone(particlesToStarColumns(partSet,
+                                                 preprocessImageRow=lambda img, row: None))
+        partSet.close()
+
+class TestItemsById(unittest.TestCase):
+
+    def testIterItemsById(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            partSet = SetOfParticles(filename=os.path.join(tmpDir, 'particles.sqlite'))
+            for i in range(1, 11):
+                partSet.append(Particle(location=(i, 'particles.mrcs')))
+            partSet.write()
+
+            def ids(rowIds, **kwargs):
+                return [(p.getObjId(), p.getIndex())
+                        for p in iterItemsById(partSet, rowIds, **kwargs)]
+
+            self.assertEqual(ids([2, 3, 3, 7]), [(2, 2), (3, 3), (3, 3), (7, 7)])
+            self.assertEqual(ids([9, 1, 5, 4], chunkSize=3), [(9, 9), (1, 1), (5, 5), (4, 4)])
+            self.assertEqual(ids([]), [])
+            partSet.close()
+
+            # Ids that are not in the set are skipped
+            partSet = SetOfParticles(filename=os.path.join(tmpDir, 'missing.sqlite'))
+            for i in [1, 2, 4, 6, 7]:
+                particle = Particle(location=(i, 'particles.mrcs'))
+                particle.setObjId(i)
+                partSet.append(particle)
+            partSet.write()
+            self.assertEqual(ids([2, 3, 5, 5, 6, 8]), [(2, 2), (6, 6)])
+            self.assertEqual(ids([6, 3, 1]), [(6, 6), (1, 1)])
+            partSet.close()
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+class TestParticlesJoin(unittest.TestCase):
+
+    def testJoin(self):
+        # Output rows shuffled, with the cryoSPARC import prefix and without
+        # some particles
+        locations = [(i, 'mic%d.mrcs' % m) for m in range(3) for i in range(1, 6)]
+        rng = np.random.default_rng(2)
+        rows = [{RELIONCOLUMNS.rlnImageName.value:
+                 '%06d@J1/imported/0123456_%s' % (i, fn), 'position': n}
+                for n, (i, fn) in enumerate(locations) if (i, fn) != (3, 'mic1.mrcs')]
+        rows = [rows[i] for i in rng.permutation(len(rows))]
+        join = ParticlesJoin(rows)
+        self.assertEqual(len(join), len(locations) - 1)
+
+        callback = MagicMock()
+        updateItem = join.updateItemCallback(callback)
+        for n, (i, fn) in enumerate(locations):
+            item = MagicMock()
+            item.getLocation.return_value = (i, '/data/Runs/000002_Extract/extra/' + fn)
+            updateItem(item, None)
+            if (i, fn) == (3, 'mic1.mrcs'):
+                self.assertFalse(item._appendItem)
+            else:
+                self.assertEqual(callback.call_args[0][1]['position'], n)
+        self.assertEqual(callback.call_count, len(locations) - 1)
+        self.assertEqual(join.missing, 1)
+
+        # Unknown stack and index out of the stack
+        item = MagicMock()
+        item.getLocation.return_value = (1, 'other.mrcs')
+        self.assertIsNone(join.getRow(item))
+        item.getLocation.return_value = (50, 'mic0.mrcs')
+        self.assertIsNone(join.getRow(item))
+
+    def _updateItems(self, join, locations):
+        """ Row position given by the join to each location """
+        callback = MagicMock()
+        updateItem = join.updateItemCallback(callback)
+        positions = []
+        for i, fn in locations:
+            item = MagicMock()
+            item.getLocation.return_value = (i, fn)
+            updateItem(item, None)
+            positions.append(callback.call_args[0][1]['position']
+                             if callback.called else None)
+            callback.reset_mock()
+        return positions
+
+    def testRepeatedLocations(self):
+        # Symmetry expanded particles: three copies of each location
+        locations = [(i, 'Runs/000002_Extract/extra/mic.mrcs')
+                     for i in (1, 2) for _ in range(3)]
+        rows = [{RELIONCOLUMNS.rlnImageName.value:
+                 '%06d@J1/imported/0123456_mic.mrcs' % i, 'position': n}
+                for n, (i, _) in enumerate(locations)]
+        join = ParticlesJoin(rows)
+        self.assertEqual(len(join), 6)
+        self.assertFalse(join.positional)
+        self.assertEqual(self._updateItems(join, locations), list(range(6)))
+        self.assertEqual(join.missing, 0)
+
+    def testSameStackNames(self):
+        # Stacks with the same base name in two runs, imported with a
+        # unique name (see convertBinaryFiles) or with the same name
+        locations = [(i, 'Runs/00000%d_Relion/extra/particles.mrcs' % r)
+                     for r in (2, 3) for i in (1, 2)]
+        inputSet = MagicMock()
+        inputSet.getFiles.return_value = {fn for _, fn in locations}
+        for names in [('particles', 'particles_00002'),
+                      ('particles', 'particles')]:
+            rows = [{RELIONCOLUMNS.rlnImageName.value:
+                     '%06d@J1/imported/%03d_%s.mrcs' % (i, n, names[n // 2]),
+                     'position': n}
+                    for n, (i, _) in enumerate(locations)]
+            join = ParticlesJoin(rows, inputSet)
+            self.assertTrue(join.positional)
+            self.assertEqual(self._updateItems(join, locations),
+                             list(range(4)))
+        # Without the input set, the stacks of the rows are ambiguous
+        self.assertTrue(ParticlesJoin(rows).positional)
+
+
+class TestStarRows(unittest.TestCase):
+
+    def _writeStar(self, fileName, runPath, indexes, defocus=10000.0):
+        with open(fileName, 'w') as f:
+            f.write('\ndata_particles\n\nloop_\n'
+                    '_rlnImageName #1\n_rlnDefocusU #2\n')
+            for i in indexes:
+                f.write('%06d@%s/stack.mrcs  %f\n' % (i, runPath, defocus + i))
+
+    def testSubsetRows(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            starFile = os.path.join(tmpDir, 'all.star')
+            subsetFile = os.path.join(tmpDir, 'subset.star')
+            editedFile = os.path.join(tmpDir, 'edited.star')
+            self._writeStar(starFile, 'Runs/000001_Import', range(1, 11))
+            self._writeStar(subsetFile, 'Runs/000002_Subset', [9, 2, 5])
+            self._writeStar(editedFile, 'Runs/000003_Edited', [2, 5],
+                            defocus=20000.0)
+
+            header, rows = readStarRowHashes(starFile, strip='Runs/000001_Import')
+            self.assertEqual(rows.dtype, np.uint64)
+            self.assertEqual(len(rows), 10)
+            self.assertEqual(len(set(rows.tolist())), 10)
+
+            # The same particles in another run have the same rows
+            subsetHeader, subsetRows = readStarRowHashes(subsetFile,
+                                                         strip='Runs/000002_Subset')
+            self.assertEqual(subsetHeader, header)
+            np.testing.assert_array_equal(matchRows(rows, subsetRows), [8, 1, 4])
+
+            # A particle with other CTF is a different one
+            _, editedRows = readStarRowHashes(editedFile, strip='Runs/000003_Edited')
+            self.assertIsNone(matchRows(rows, editedRows))
+            self.assertIsNone(matchRows(subsetRows, rows))
+        finally:
+            shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,31 @@
 import getpass
+import http.server
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch
+import zipfile
+from unittest.mock import patch, MagicMock
 
-from cryosparc2 import V_UNKNOWN, V3_0_0
+import requests
+from pwem.convert import Ccp4Header
+
+from cryosparc2 import V_UNKNOWN, V3_0_0, V4_1_0
 from cryosparc2.utils import (cryosparcValidate, cryosparcExists,
                               isCryosparcRunning, calculateNewSamplingRate,
-                              getProjectName, getCryosparcVersion)
+                              getProjectName, getCryosparcVersion,
+                              runCryosparcCmd, cryosparcCall, CommandClient,
+                              waitForCryosparc, JobStreamLog, STATUS_COMPLETED,
+                              getCryosparcEnvInformation, clearEnvCache,
+                              getFilesHash, enqueueJob, SeriesArchive,
+                              extractArchives, harvestFile, unshareFile,
+                              copyFiles, HARVEST_HARDLINK, HARVEST_SYMLINK,
+                              HARVEST_COPY, doImportVolumes, waitForCryosparcJobs,
+                              getJobOutputGroup,
+                              STATUS_RUNNING, STATUS_FAILED)
 
 import cryosparc2.utils as csutils
 
@@ -47,6 +67,7 @@ class TestUtils(unittest.TestCase):
 
     def testValidate(self):
 
+        clearEnvCache()
         with patch('cryosparc2.utils.cryosparcExists') as exists:
             # Case, CS not found
             exists.return_value = False
@@ -81,6 +102,7 @@ class TestUtils(unittest.TestCase):
                         # Higher version
                         highV = "100.1.1"
                         getVersion.return_value = highV
+                        clearEnvCache()  # the successful validation is cached
                         result = cryosparcValidate()
                         self.assertEqual(0, len(result), "Validation did not allows higher versions than supported.")
                         self.assertTrue(yellowStr.called, "Warning not printed when working with higher versions")
@@ -151,6 +173,514 @@ class TestUtils(unittest.TestCase):
                 getFromFile.assert_called_once()
                 getEnvInfo.assert_called_once()
 
+    def testCommandClient(self):
+
+        client = CommandClient("localhost", 39002, licenseId="xxx")
+        self.assertEqual(client.url, "http://localhost:39002/api")
+        self.assertEqual(client._session.headers['License-ID'], "xxx")
+
+        with patch.object(client._session, 'post') as post:
+            post.return_value.json.return_value = {'jsonrpc': '2.0', 'id': 0,
+                                                   'result': 'completed'}
+            self.assertEqual(client.call('get_job_status', 'P1', 'J1'), 'completed')
+            payload = post.call_args[1]['json']
+            self.assertEqual(payload['method'], 'get_job_status')
+            self.assertEqual(payload['params'], ['P1', 'J1'])
+
+            post.return_value.json.return_value = {'jsonrpc': '2.0', 'id': 1,
+                                                   'error': {'message': 'No job'}}
+            with self.assertRaises(Exception) as ctx:
+                client.call('get_job_status', 'P1', 'J2')
+            self.assertTrue('get_job_status("P1", "J2")' in str(ctx.exception))
+
+            # Batch requests
+            def answer(*args, **kwargs):
+                response = MagicMock()
+                response.json.return_value = [{'jsonrpc': '2.0', 'id': p['id'],
+                                               'result': p['params'][-1]}
+                                              for p in reversed(kwargs['json'])]
+                return response
+            post.side_effect = answer
+            self.assertEqual(client.callBatch([('job_connect_result', ('P1', 'J1.a', 'J2.a')),
+                                               ('enqueue_job', ('P1', 'J2', 'default'))]),
+                             ['J2.a', 'default'])
+            self.assertEqual(post.call_count, 3)
+
+            # The results of the calls that succeeded are kept
+            def failSecond(*args, **kwargs):
+                response = MagicMock()
+                first, second = kwargs['json']
+                response.json.return_value = [
+                    {'jsonrpc': '2.0', 'id': first['id'], 'result': True},
+                    {'jsonrpc': '2.0', 'id': second['id'],
+                     'error': {'message': 'No job'}}]
+                return response
+            post.side_effect = failSecond
+            with self.assertRaises(csutils.CommandBatchError) as ctx:
+                client.callBatch([('job_connect_result', ('P1', 'J1.a', 'J2.a')),
+                                  ('job_connect_result', ('P1', 'J1.b', 'J2.b'))])
+            self.assertEqual(ctx.exception.results, {0: True})
+            self.assertTrue('J1.b' in str(ctx.exception))
+
+            post.side_effect = None
+            post.return_value.json.return_value = {'jsonrpc': '2.0', 'id': None,
+                                                   'error': {'message': 'Invalid Request'}}
+            with self.assertRaises(ValueError):
+                client.callBatch([('enqueue_job', ('P1', 'J2', 'default'))])
+
+    def testCommandServer(self):
+        # A command_core stub that answers JSON-RPC over HTTP
+        requestsLog = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                requestsLog.append((self.client_address, self.headers.get('License-ID'),
+                                    payload))
+
+                def answer(request):
+                    if request['method'] == 'get_job_status':
+                        return {'jsonrpc': '2.0', 'id': request['id'],
+                                'result': {'J1': 'completed'}.get(request['params'][1])}
+                    return {'jsonrpc': '2.0', 'id': request['id'],
+                            'error': {'code': -32601, 'message': 'Method not found'}}
+
+                if isinstance(payload, list):
+                    body = [answer(request) for request in reversed(payload)]
+                else:
+                    body = answer(payload)
+                body = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        client = CommandClient('127.0.0.1', server.server_address[1], licenseId='xxx')
+        try:
+            self.assertEqual(client.call('get_job_status', 'P1', 'J1'), 'completed')
+            self.assertIsNone(client.call('get_job_status', 'P1', 'J2'))
+            with self.assertRaises(Exception) as ctx:
+                client.call('unknown_method', 'P1')
+            self.assertTrue('Method not found' in str(ctx.exception))
+            self.assertEqual(client.callBatch([('get_job_status', ('P1', 'J1')),
+                                               ('get_job_status', ('P1', 'J2'))]),
+                             ['completed', None])
+            with self.assertRaises(csutils.CommandBatchError) as ctx:
+                client.callBatch([('get_job_status', ('P1', 'J1')),
+                                  ('unknown_method', ('P1',))])
+            self.assertEqual(ctx.exception.results, {0: 'completed'})
+
+            # Through runCryosparcCmd
+            with patch('cryosparc2.utils.getCommandClient', return_value=client):
+                self.assertEqual(runCryosparcCmd('get_job_status', 'P1', 'J1'),
+                                 (0, 'completed'))
+
+            self.assertEqual(len(requestsLog), 6)
+            self.assertEqual({license for _, license, _ in requestsLog}, {'xxx'})
+            self.assertEqual(requestsLog[0][2], {'jsonrpc': '2.0', 'method': 'get_job_status',
+                                                 'params': ['P1', 'J1'], 'id': 0})
+            # All the requests go through the same (kept alive) connection
+            self.assertEqual(len({address for address, _, _ in requestsLog}), 1)
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+    def testRunCryosparcCmd(self):
+
+        # Through the command client
+        with patch('cryosparc2.utils.getCommandClient') as getClient:
+            client = MagicMock()
+            client.call.return_value = {'name': 'default'}
+            getClient.return_value = client
+
+            self.assertEqual(cryosparcCall('get_scheduler_lanes'), {'name': 'default'})
+            self.assertEqual(runCryosparcCmd('get_scheduler_lanes'), (0, "{'name': 'default'}"))
+            client.call.assert_called_with('get_scheduler_lanes')
+
+            # Only the calls of a batch that failed are run again
+            calls = [('job_connect_result', ('P1', 'J1.a', 'J2.a')),
+                     ('job_connect_result', ('P1', 'J1.b', 'J2.b'))]
+            client.callBatch.side_effect = csutils.CommandBatchError('failed', {0: 'a'})
+            with patch('cryosparc2.utils.cryosparcCall') as call:
+                call.return_value = 'b'
+                self.assertEqual(csutils.cryosparcBatch(calls), ['a', 'b'])
+                call.assert_called_once_with('job_connect_result', 'P1', 'J1.b',
+                                             'J2.b', printCmd=False)
+
+                # A request that may have reached command_core is not replayed
+                client.callBatch.side_effect = requests.ReadTimeout()
+                with patch('cryosparc2.utils.resetCommandClient'):
+                    with self.assertRaises(requests.ReadTimeout):
+                        csutils.cryosparcBatch(calls)
+                    client.callBatch.side_effect = requests.ConnectTimeout()
+                    self.assertEqual(csutils.cryosparcBatch(calls), ['b', 'b'])
+
+        # Falling back to cryosparcm cli
+        with patch('cryosparc2.utils.getCommandClient') as getClient:
+            getClient.return_value = None
+            with patch('cryosparc2.utils.getCryosparcProgram') as getProg:
+                getProg.return_value = "cryosparcm cli"
+                with patch('cryosparc2.utils.runCmd') as runCmd:
+                    runCmd.return_value = (0, "[1, 2]")
+                    self.assertEqual(cryosparcCall('enqueue_job', 'P1', 'J1', [0, 1], False), [1, 2])
+                    runCmd.assert_called_with('cryosparcm cli \'enqueue_job("P1", "J1", [0, 1], False)\'',
+                                              printCmd=False)
+
+    def testWaitForCryosparc(self):
+
+        with patch('cryosparc2.utils.getJobStatus') as getStatus, \
+                patch('cryosparc2.utils.waitJob') as waitJob, \
+                patch('time.sleep') as sleep:
+            getStatus.side_effect = [STATUS_RUNNING, STATUS_RUNNING, STATUS_COMPLETED]
+            self.assertEqual(waitForCryosparc('P1', 'J1', 'failed'), STATUS_COMPLETED)
+            self.assertEqual(waitJob.call_count, 2)
+            self.assertEqual(waitJob.call_args[1]['timeout'], csutils.WAIT_JOB_TIMEOUT)
+            sleep.assert_not_called()
+
+            # Errors are retried with a bounded and growing delay
+            getStatus.side_effect = [Exception('Connection refused')] * 8 + [STATUS_FAILED]
+            with self.assertRaises(Exception) as ctx:
+                waitForCryosparc('P1', 'J1', 'failed')
+            self.assertEqual(str(ctx.exception), 'failed')
+            delays = [c[0][0] for c in sleep.call_args_list]
+            self.assertEqual(len(delays), 8)
+            self.assertTrue(delays[0] <= csutils.WAIT_JOB_BACKOFF)
+            self.assertTrue(all(d <= csutils.WAIT_JOB_MAX_BACKOFF for d in delays))
+            self.assertTrue(delays[-1] >= csutils.WAIT_JOB_MAX_BACKOFF / 2)
+
+    def testJobStreamLog(self):
+
+        def indexer(event, index):
+            index['count'] = index.get('count', 0) + 1
+            index['last'] = event['text']
+
+        events = [{'_id': str(i), 'type': 'text', 'text': 'event %d' % i}
+                  for i in range(5)]
+        streamLog = JobStreamLog('P1', 'J1', indexer)
+
+        with patch('cryosparc2.utils.cryosparcCall') as call:
+            call.return_value = events[:2]
+            self.assertEqual(streamLog.update(), events[:2])
+            call.assert_called_with('get_job_streamlog', 'P1', 'J1')
+
+            # Only the new events are returned and indexed
+            call.return_value = events
+            self.assertEqual(streamLog.update(), events[2:])
+            self.assertEqual(streamLog.update(), [])
+            self.assertEqual(len(streamLog), 5)
+            self.assertEqual(streamLog.index, {'count': 5, 'last': 'event 4'})
+
+            # The log has been cleared and the job relaunched
+            call.return_value = [{'_id': 'new', 'type': 'text', 'text': 'restart'}]
+            self.assertEqual(streamLog.update(), call.return_value)
+            self.assertEqual(len(streamLog), 1)
+            self.assertEqual(streamLog.index, {'count': 1, 'last': 'restart'})
+
+    def testEnvCache(self):
+
+        clearEnvCache()
+        with patch('cryosparc2.utils.runCryosparcCmd') as runCmd:
+            runCmd.return_value = (0, "{'master_hostname': 'host', 'port_app': 39000}")
+            self.assertEqual(getCryosparcEnvInformation('master_hostname'), 'host')
+            self.assertEqual(getCryosparcEnvInformation('port_app'), '39000')
+            runCmd.assert_called_once_with('get_system_info')
+
+            # Invalidation
+            clearEnvCache('getSystemInfo', '_getSystemInfoDict')
+            runCmd.return_value = (0, "{'master_hostname': 'other'}")
+            self.assertEqual(getCryosparcEnvInformation('master_hostname'), 'other')
+            self.assertEqual(runCmd.call_count, 2)
+
+            # Expiration
+            with patch('time.time') as now:
+                now.return_value = csutils._envCache[('getSystemInfo',)][0] + 1
+                getCryosparcEnvInformation('master_hostname')
+            self.assertEqual(runCmd.call_count, 3)
+
+            # Errors are not cached
+            clearEnvCache()
+            runCmd.side_effect = Exception('Connection refused')
+            for _ in range(2):
+                with self.assertRaises(Exception):
+                    getCryosparcEnvInformation('master_hostname')
+            self.assertEqual(runCmd.call_count, 5)
+
+            # Negative lookups are not cached
+            runCmd.side_effect = None
+            runCmd.return_value = (0, 'False')
+            self.assertFalse(csutils.userExist('new@user.org'))
+            runCmd.return_value = (0, 'True')
+            self.assertTrue(csutils.userExist('new@user.org'))
+            self.assertTrue(csutils.userExist('new@user.org'))
+            self.assertEqual(runCmd.call_count, 7)
+
+        # Only a successful validation is cached
+        with patch('cryosparc2.utils.cryosparcExists') as exists, \
+                patch('cryosparc2.utils.isCryosparcRunning') as running, \
+                patch('cryosparc2.utils.getCryosparcVersion') as getVersion:
+            exists.return_value = True
+            getVersion.return_value = V3_0_0
+            running.return_value = False
+            self.assertEqual(len(cryosparcValidate()), 1)
+            running.return_value = True
+            self.assertEqual(cryosparcValidate(), [])
+            self.assertEqual(cryosparcValidate(), [])
+            self.assertEqual(running.call_count, 2)
+        clearEnvCache()
+
+    def testFilesHash(self):
+
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmpDir, 'volume.mrc')
+            with open(fn, 'w') as f:
+                f.write('volume')
+            link = os.path.join(tmpDir, 'link.mrc')
+            os.symlink(fn, link)
+
+            key = getFilesHash([fn], 'map', 1.5)
+            self.assertEqual(getFilesHash([link + ':mrc'], 'map', 1.5), key)
+            self.assertNotEqual(getFilesHash([fn], 'mask', 1.5), key)
+            self.assertNotEqual(getFilesHash([fn], 'map', 3.0), key)
+
+            with open(fn, 'a') as f:
+                f.write(' modified')
+            self.assertNotEqual(getFilesHash([fn], 'map', 1.5), key)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testSeriesArchive(self):
+
+        tmpDir = tempfile.mkdtemp()
+        try:
+            archives = []
+            for i in range(2):
+                zipFn = os.path.join(tmpDir, 'series_%d.zip' % i)
+                with zipfile.ZipFile(zipFn, 'w') as fileZip:
+                    for frame in range(3):
+                        fileZip.writestr('frame_%03d.mrc' % frame, 'frame %d' % frame * 10)
+                archives.append(SeriesArchive(zipFn, os.path.join(tmpDir, 'series_%d' % i)))
+
+            archive = archives[0]
+            self.assertFalse(archive.isExtracted('frame_001.mrc'))
+            path = archive.getFile('frame_001.mrc')
+            with open(path) as f:
+                self.assertEqual(f.read(), 'frame 1' * 10)
+            self.assertEqual(os.listdir(archive.extractFolder), ['frame_001.mrc'])
+
+            # Extracted files are not extracted again, partial ones are
+            os.utime(path, (0, 0))
+            with open(archive.getPath('frame_002.mrc'), 'w') as f:
+                f.write('frame')
+            paths = extractArchives(archives, numberOfWorkers=2)
+            self.assertEqual(len(paths), 6)
+            self.assertTrue(all(a.isExtracted(n) for a in archives for n in a.getNames()))
+            self.assertEqual(os.path.getmtime(path), 0)
+            self.assertEqual(sorted(os.listdir(archive.extractFolder)),
+                             ['frame_000.mrc', 'frame_001.mrc', 'frame_002.mrc'])
+
+            with self.assertRaises(ValueError):
+                archive.getPath('../frame.mrc')
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testHarvestFiles(self):
+
+        tmpDir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmpDir, 'J1')
+            os.makedirs(os.path.join(src, 'subtracted'))
+            for fn in ['J1_particles.cs', 'J1_volume.mrc', 'J1_plot.png',
+                       'subtracted/stack.mrc']:
+                with open(os.path.join(src, fn), 'w') as f:
+                    f.write(fn)
+            fn = os.path.join(src, 'J1_volume.mrc')
+            dst = os.path.join(tmpDir, 'volume.mrc')
+
+            self.assertEqual(harvestFile(fn, dst), HARVEST_HARDLINK)
+            self.assertTrue(os.path.samefile(fn, dst))
+            # A private copy is made before modifying a shared file
+            unshareFile(dst)
+            self.assertFalse(os.path.samefile(fn, dst))
+
+            with patch('os.link', side_effect=OSError), \
+                    patch('cryosparc2.utils._reflink', side_effect=OSError):
+                self.assertEqual(harvestFile(fn, dst, symlink=True), HARVEST_SYMLINK)
+                self.assertEqual(os.path.realpath(dst), fn)
+                self.assertEqual(harvestFile(fn, dst, symlink=False), HARVEST_COPY)
+                self.assertFalse(os.path.islink(dst))
+                with open(dst) as f:
+                    self.assertEqual(f.read(), 'J1_volume.mrc')
+
+            # Only the declared files are harvested
+            extra = os.path.join(tmpDir, 'extra')
+            copyFiles(src, extra, files=['*.cs', 'subtracted/stack.mrc'])
+            self.assertEqual(sorted(os.listdir(extra)), ['J1_particles.cs', 'subtracted'])
+            self.assertTrue(os.path.exists(os.path.join(extra, 'subtracted', 'stack.mrc')))
+            copyFiles(src, os.path.join(tmpDir, 'all'))
+            self.assertEqual(len(os.listdir(os.path.join(tmpDir, 'all'))), 4)
+
+            # A missing pattern does not prevent harvesting the rest
+            partial = os.path.join(tmpDir, 'partial')
+            copyFiles(src, partial, files=['J1_missing.mrc', 'J1_particles.cs'])
+            self.assertEqual(os.listdir(partial), ['J1_particles.cs'])
+            # ... but the harvest errors are not hidden
+            with patch('cryosparc2.utils.harvestFile', side_effect=OSError):
+                self.assertRaises(OSError, copyFiles, src, partial,
+                                  files=['J1_particles.cs'])
+
+            # Only the maps whose header is rewritten stop sharing the data
+            for ispg, shared in [(1, True), (0, False)]:
+                fn = os.path.join(src, 'J1_map_%d.mrc' % ispg)
+                with open(fn, 'wb') as f:
+                    f.write(struct.pack('<23i', *([0] * 22 + [ispg])).ljust(1024, b'\0'))
+                dst = os.path.join(tmpDir, 'map_%d.mrc' % ispg)
+                harvestFile(fn, dst)
+                csutils.fixVolume(dst)
+                self.assertEqual(os.path.samefile(fn, dst), shared)
+                self.assertEqual(Ccp4Header(dst, readHeader=True).getISPG(), 1)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testEnqueueJob(self):
+
+        with patch('cryosparc2.utils.getCryosparcVersion') as getVersion, \
+                patch('cryosparc2.utils.getCryosparcUser') as getUser, \
+                patch('cryosparc2.utils.isCryosparcStandalone') as standalone, \
+                patch('cryosparc2.utils.runCryosparcCmd') as runCmd, \
+                patch('cryosparc2.utils.getCommandClient') as getClient:
+            getUser.return_value = 'user'
+            standalone.return_value = False
+            runCmd.return_value = (0, 'J10')
+            client = MagicMock()
+            getClient.return_value = client
+
+            def enqueue():
+                return enqueueJob('class_3D', 'P1', 'W1', '{"param": 1}',
+                                  '{"particles": "J1.imported_particles"}',
+                                  'default',
+                                  group_connect={'volume': ['J2.imported_volume_1',
+                                                            'J3.imported_volume_1']},
+                                  result_connect={'particles.alignments3D':
+                                                  'J4.particles.alignments3D'})
+
+            # Groups go to make_job, the results in a single request and
+            # the job is queued once they are connected
+            getVersion.return_value = V4_1_0
+            self.assertEqual(enqueue().get(), 'J10')
+            self.assertEqual([c[0][0] for c in runCmd.call_args_list],
+                             ['make_job', 'enqueue_job'])
+            self.assertEqual(runCmd.call_args[0][1:], ('P1', 'J10', 'default', 'user'))
+            makeJobArgs = runCmd.call_args_list[0][0]
+            self.assertEqual(makeJobArgs[0], 'make_job')
+            self.assertEqual(makeJobArgs[8], {'particles': 'J1.imported_particles',
+                                              'volume': ['J2.imported_volume_1',
+                                                         'J3.imported_volume_1']})
+            calls = client.callBatch.call_args[0][0]
+            self.assertEqual(calls, [('job_connect_result',
+                                      ('P1', 'J4.particles.alignments3D',
+                                       'J10.particles.alignments3D'))])
+
+            # One command at a time in older versions
+            runCmd.reset_mock()
+            client.reset_mock()
+            getVersion.return_value = V3_0_0
+            self.assertEqual(enqueue().get(), 'J10')
+            client.callBatch.assert_not_called()
+            methods = [c[0][0] for c in runCmd.call_args_list]
+            self.assertEqual(methods, ['make_job', 'job_connect_group',
+                                       'job_connect_group', 'job_connect_result',
+                                       'enqueue_job'])
+            self.assertEqual(runCmd.call_args_list[0][0][8],
+                             {'particles': 'J1.imported_particles'})
+
+
+    def testConcurrentImports(self):
+
+        protocol = MagicMock()
+        protocol.projectName.get.return_value = 'P1'
+        volume = MagicMock()
+        volume.getSamplingRate.return_value = 1.5
+        with patch('cryosparc2.utils.enqueueJob') as enqueue, \
+                patch('cryosparc2.utils.waitForCryosparc') as wait:
+            enqueue.side_effect = [MagicMock(get=MagicMock(return_value=job))
+                                   for job in ['J2', 'J3']]
+            jobs = [doImportVolumes(protocol, '/vol.mrc', volume, volType, 'Importing',
+                                    wait=False).get()
+                    for volType in ['map', 'mask']]
+            # Both jobs are queued before waiting for any of them
+            self.assertEqual(enqueue.call_count, 2)
+            wait.assert_not_called()
+
+            waitForCryosparcJobs('P1', {job: 'Error %s' % job for job in jobs})
+            self.assertEqual([c[0][:3] for c in wait.call_args_list],
+                             [('P1', 'J2', 'Error J2'), ('P1', 'J3', 'Error J3')])
+
+    def testJobOutputGroup(self):
+
+        groups = [{'name': 'particles', 'type': 'particle', 'num_items': 100},
+                  {'name': 'volume', 'type': 'volume', 'num_items': 1}]
+        with patch('cryosparc2.utils.cryosparcCall') as call:
+            call.return_value = {'status': STATUS_COMPLETED,
+                                 'output_result_groups': groups}
+            self.assertEqual(getJobOutputGroup('P1', 'J5', 'particles'), groups[0])
+            self.assertEqual(call.call_args[0][:3], ('get_job', 'P1', 'J5'))
+            self.assertIsNone(getJobOutputGroup('P1', 'J5', 'mask'))
+
+            # The outputs of a cleared or running job can not be connected
+            call.return_value = {'status': STATUS_RUNNING,
+                                 'output_result_groups': groups}
+            self.assertIsNone(getJobOutputGroup('P1', 'J5', 'particles'))
+
+    def testImportReuse(self):
+        from cryosparc2.protocols import protocol_base
+
+        tmpDir = tempfile.mkdtemp()
+        try:
+            protocol = MagicMock()
+            protocol.projectName.get.return_value = 'P1'
+            protocol._getSharedPath.side_effect = lambda *p: os.path.join(tmpDir, *p)
+            protocol._importSourceExists = protocol_base.ProtCryosparcBase._importSourceExists
+            stacksPath = os.path.join(tmpDir, 'Runs', '000002_Refine', 'input')
+            os.makedirs(stacksPath)
+            protocol._getParticleStacksPath.return_value = stacksPath
+
+            # The .cs external import keeps the stacks of the run as source
+            with patch.object(protocol_base, 'canUseCryosparcTools', return_value=True), \
+                    patch.object(protocol_base, 'writeSetOfParticlesCs'):
+                protocol_base.ProtCryosparcBase._importParticles(protocol)
+            self.assertEqual(protocol._importParticlesFile.call_args[1]['source'],
+                             stacksPath)
+
+            importFunc = MagicMock(side_effect=[MagicMock(get=MagicMock(return_value=job))
+                                                for job in ['J2', 'J3']])
+
+            def doImport():
+                return protocol_base.ProtCryosparcBase._doImport(
+                    protocol, 'key', importFunc, 'particles', source=stacksPath).get()
+
+            with patch.object(protocol_base, 'getJobStatus',
+                              return_value=STATUS_COMPLETED):
+                self.assertEqual(doImport(), 'J2')
+                self.assertEqual(doImport(), 'J2')
+                self.assertEqual(importFunc.call_count, 1)
+
+                # The run with the stacks was deleted: the job is not reused
+                shutil.rmtree(os.path.dirname(stacksPath))
+                self.assertEqual(doImport(), 'J3')
+                self.assertEqual(importFunc.call_count, 2)
+        finally:
+            shutil.rmtree(tmpDir)
 
 if __name__ == '__main__':
     unittest.main()
@@ -25,13 +25,24 @@
 # *
 # **************************************************************************
 import ast
+import functools
 import getpass
+import glob
+import hashlib
+import itertools
 import logging
 import os
+import random
 import re
 import shutil
+import threading
 import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import requests
+import urllib3
 from pkg_resources import parse_version
 
 import pyworkflow.utils as pwutils
@@ -60,11 +71,59 @@ ACTIVE_STATUSES = [STATUS_QUEUED, STATUS_RUNNING, STATUS_STARTED,
 
 # Module variables
 _csVersion = None  # Lazy variable: never use it directly. Use getCryosparcVersion instead
+_commandClient = None  # Lazy variable: never use it directly. Use getCommandClient instead
+_commandClientRetry = 0  # Time after which a failed client creation is retried
+
+COMMAND_CLIENT_RETRY_DELAY = 60  # seconds
+COMMAND_CLIENT_TIMEOUT = 300  # seconds
+WAIT_JOB_TIMEOUT = 60  # seconds that cryoSPARC holds a wait_job_complete call
+WAIT_JOB_BACKOFF = 5  # seconds, first retry delay after an error
+WAIT_JOB_MAX_BACKOFF = 300  # seconds
+ENV_CACHE_TTL = 300  # seconds that the cryoSPARC environment queries are cached
+_envCache = {}  # (function name, args) -> (expiration time, value)
 
 # logging variable
 logger = logging.getLogger(__name__)
 
 
+def envCached(func=None, cacheIf=bool):
+    """ Cache the result of a cryoSPARC environment query (system info,
+    lanes, users, license...) for ENV_CACHE_TTL seconds. The cache is shared
+    by the whole process and can be dropped with clearEnvCache. Failed
+    queries (exceptions) and negative results (e.g. a user that does not
+    exist yet) are not cached: only the values for which cacheIf(value) is
+    true (non-empty values by default) """
+    if func is None:
+        return functools.partial(envCached, cacheIf=cacheIf)
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = (func.__name__,) + args
+        cached = _envCache.get(key)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+        value = func(*args)
+        if cacheIf(value):
+            _envCache[key] = (time.time() + ENV_CACHE_TTL, value)
+        return value
+    return wrapper
+
+
+def clearEnvCache(*names):
+    """ Drop the cached cryoSPARC environment queries, all of them or only
+    the ones of the given function names (e.g. 'getSystemInfo'). The
+    cryoSPARC version is read again as well """
+    global _csVersion
+    if not names:
+        _envCache.clear()
+        _csVersion = None
+    else:
+        for key in [k for k in _envCache if k[0] in names]:
+            del _envCache[key]
+        if 'getCryosparcVersion' in names:
+            _csVersion = None
+
+
 class NestedDict:
     def __init__(self, depth=1):
         self.data = {}
@@ -86,6 +145,131 @@ class NestedDict:
         return current
 
 
+class CommandBatchError(Exception):
+    """ Some calls of a batch request failed. The results of the calls
+    that succeeded are kept by position in results """
+    def __init__(self, message, results):
+        Exception.__init__(self, message)
+        self.results = results
+
+
+class CommandClient:
+    """
+    Long-lived JSON-RPC client to cryoSPARC's command_core. The HTTP session
+    is kept alive (and its connections pooled) between calls, so each command
+    costs a single request instead of a new `cryosparcm cli` process.
+    """
+    def __init__(self, host, port, licenseId=None, timeout=COMMAND_CLIENT_TIMEOUT):
+        self.url = "http://%s:%s/api" % (host, port)
+        self.timeout = timeout
+        self._ids = itertools.count()
+        self._session = requests.Session()
+        if licenseId:
+            self._session.headers.update({'License-ID': licenseId})
+
+    def call(self, method, *args):
+        """ Call a command_core method and return its (json decoded) result.
+        Transport problems are raised as requests.RequestException, while
+        errors reported by cryoSPARC are raised as a regular Exception """
+        payload = {'jsonrpc': '2.0',
+                   'method': method,
+                   'params': list(args),
+                   'id': next(self._ids)}
+        response = self._session.post(self.url, json=payload,
+                                      timeout=self.timeout)
+        response.raise_for_status()
+        answer = response.json()
+        if answer.get('error'):
+            raise Exception("%s failed --> %s" % (cliExpression(method, *args),
+                                                  answer['error']))
+        return answer.get('result')
+
+    def callBatch(self, calls):
+        """ Call several command_core methods in a single (JSON-RPC batch)
+        request. The server may run them in any order or concurrently, so
+        only independent calls can be sent together.
+        :param calls: list of (method, args) tuples
+        :returns: the list of results
+        :raises ValueError: if the server does not support batch requests
+        :raises CommandBatchError: if any of the calls failed
+        """
+        payload = [{'jsonrpc': '2.0',
+                    'method': method,
+                    'params': list(args),
+                    'id': next(self._ids)} for method, args in calls]
+        response = self._session.post(self.url, json=payload,
+                                      timeout=self.timeout)
+        response.raise_for_status()
+        answers = response.json()
+        if not isinstance(answers, list):
+            raise ValueError("Batch requests not supported: %s" % answers)
+
+        answers = {answer.get('id'): answer for answer in answers}
+        results = {}
+        errors = []
+        for position, (request, (method, args)) in enumerate(zip(payload, calls)):
+            answer = answers.get(request['id'], {})
+            if answer.get('error') or 'result' not in answer:
+                errors.append("%s failed --> %s" % (cliExpression(method, *args),
+                                                    answer.get('error')))
+            else:
+                results[position] = answer['result']
+        if errors:
+            raise CommandBatchError('\n'.join(errors), results)
+        return [results[position] for position in range(len(calls))]
+
+    def close(self):
+        self._session.close()
+
+
+class JobStreamLog:
+    """
+    Incremental reader of a job stream log (the job events). cryoSPARC
+    returns the whole event list on every get_job_streamlog call, so the
+    reader keeps a cursor (number of events read and id of the last one)
+    and every event is parsed and processed only once. A small index
+    derived from the events is kept by the indexer function
+    indexer(event, index), so the events themselves are not stored.
+    """
+    def __init__(self, projectName, jobId, indexer=None):
+        self.projectName = str(projectName)
+        self.jobId = str(jobId)
+        self.indexer = indexer
+        self.index = {}
+        self._count = 0
+        self._lastId = None
+
+    def __len__(self):
+        return self._count
+
+    def update(self):
+        """ Read the events produced since the last update.
+        command_core's get_job_streamlog has no cursor or timestamp
+        argument, so the whole event list is still transferred and decoded
+        on every call: only the processing of the events already read is
+        avoided. Poll it sparingly on jobs with long logs.
+        :returns: the list of new events """
+        events = cryosparcCall('get_job_streamlog', self.projectName,
+                               self.jobId)
+        if not isinstance(events, list):
+            return []
+
+        if self._count and (len(events) < self._count or
+                            events[self._count - 1].get('_id') != self._lastId):
+            # The log has been cleared (e.g. the job was cleared and relaunched)
+            self._count = 0
+            self.index = {}
+
+        newEvents = events[self._count:]
+        if newEvents:
+            self._count = len(events)
+            self._lastId = events[-1].get('_id')
+            if self.indexer is not None:
+                for event in newEvents:
+                    self.indexer(event, self.index)
+        return newEvents
+
+
 def getCryosparcDir(*paths):
     """
     Get the root directory where cryoSPARC code and dependencies are installed.
@@ -138,9 +322,12 @@ def isCryosparcRunning():
     return status == 0
 
 
+@envCached(cacheIf=lambda errors: not errors)
 def cryosparcValidate():
     """
-    Validates some cryo properties that must be satisfy
+    Validates some cryo properties that must be satisfy. A successful
+    validation is cached (see envCached), so cryoSPARC is not queried
+    again by every protocol
     """
     if not cryosparcExists():
         return ["cryoSPARC software not found at %s. Please, fill %s variable "
@@ -197,13 +384,16 @@ def getCryosparcEnvInformation(envVar=VERSION):
     """
     Get the cryosparc environment information
     """
-    import ast
-    system_info = getSystemInfo()
-    dictionary = ast.literal_eval(system_info[1])
-    envVariable = str(dictionary[envVar])
+    envVariable = str(_getSystemInfoDict()[envVar])
     return envVariable
 
 
+@envCached
+def _getSystemInfoDict():
+    """ System information as a dictionary (see getSystemInfo) """
+    return ast.literal_eval(getSystemInfo()[1])
+
+
 def getCryosparcVersion():
     """ Gets cryosparc version 1st, from a variable if populated,
      2nd from the version txt file, if fails, asks CS using getCryosparcEnvInformation"""
@@ -227,6 +417,7 @@ def _getCryosparcVersionFromFile():
         return fh.readline()
 
 
+@envCached
 def _getLicenceFromFile():
     configFile = getCryosparcDir(CRYOSPARC_MASTER, CRYOSPARC_CONFIG_FILE)
     with open(configFile, 'r') as f:
@@ -255,9 +446,7 @@ def getCryosparcProjectsList():
     Get list of all projects available
     :return: all projects available in the database
     """
-    projects_list_cmd = (getCryosparcProgram() + ' %slist_projects()%s ' % ("'", "'"))
-    cmd = runCmd(projects_list_cmd, printCmd=False)[1]
-    projectList = ast.literal_eval(cmd)
+    projectList = cryosparcCall('list_projects')
     return projectList
 
 
@@ -270,9 +459,7 @@ def getCryosparcWorkSpaces(projectId):
     :return: list of workpaces in a project or all projects if not specified
     :rtype: list
     """
-    workspace_list_cmd = (getCryosparcProgram() + ' %slist_workspaces("%s")%s ' % ("'", str(projectId), "'"))
-    cmd = runCmd(workspace_list_cmd, printCmd=False)[1]
-    workspacesList = ast.literal_eval(cmd)
+    workspacesList = cryosparcCall('list_workspaces', str(projectId))
     return workspacesList
 
 
@@ -354,12 +541,8 @@ def createEmptyProject(projectDir, projectTitle):
                             desc=None)
     """
 
-    create_empty_project_cmd = (getCryosparcProgram() +
-                                ' %screate_empty_project("%s", "%s", "%s")%s '
-                                % ("'", str(getCryosparcUser()),
-                                   str(projectDir), str(projectTitle), "'"))
-
-    return runCmd(create_empty_project_cmd, printCmd=False)
+    return runCryosparcCmd('create_empty_project', str(getCryosparcUser()),
+                           str(projectDir), str(projectTitle))
 
 
 def getProjectInformation(project_uid, info='project_dir'):
@@ -368,23 +551,12 @@ def getProjectInformation(project_uid, info='project_dir'):
     :param project_uid: the id of the project
     :return: the information related to the project that's stored in the database
     """
-    import ast
-    from cryosparc.tools import CryoSPARC
-    getProject_cmd = (getCryosparcProgram() +
-                                ' %sget_project("%s")%s '
-                                % ("'", str(project_uid), "'"))
-
-    project_info = runCmd(getProject_cmd, printCmd=False)
-    dictionary = ast.literal_eval(project_info[1])
+    dictionary = cryosparcCall('get_project', str(project_uid))
     return str(dictionary[info])
 
 
 def getUserToken(email):
-    get_user_cmd = (getCryosparcProgram() +
-                                ' %sGetUser("%s")%s '
-                                % ("'", str(email),"'"))
-
-    return runCmd(get_user_cmd, printCmd=False)
+    return runCryosparcCmd('GetUser', str(email))
 
 
 def updateProjectDirectory(project_uid, new_project_dir):
@@ -394,11 +566,8 @@ def updateProjectDirectory(project_uid, new_project_dir):
        :param project_uid: uid of the project to update
        :param new_project_dir_container: the new directory
        """
-    updateProjectDirectory_cmd = (getCryosparcProgram() +
-                      ' %supdate_project_directory("%s", "%s")%s '
-                      % ("'", str(project_uid), str(new_project_dir), "'"))
-
-    runCmd(updateProjectDirectory_cmd, printCmd=False)
+    runCryosparcCmd('update_project_directory', str(project_uid),
+                    str(new_project_dir))
 
 
 def getOutputPreffix(projectName):
@@ -417,10 +586,8 @@ def createProjectContainerDir(project_container_dir):
               still in the returned path (the path should be expanded every
               time it is used)
     """
-    create_project_dir_cmd = (getCryosparcProgram() +
-                              ' %scheck_or_create_project_container_dir("%s")%s '
-                              % ("'", project_container_dir, "'"))
-    return runCmd(create_project_dir_cmd, printCmd=False)
+    return runCryosparcCmd('check_or_create_project_container_dir',
+                           project_container_dir)
 
 
 def createEmptyWorkSpace(projectName, workspaceTitle, workspaceComment):
@@ -430,19 +597,35 @@ def createEmptyWorkSpace(projectName, workspaceTitle, workspaceComment):
                            title=None, desc=None)
     returns the new uid of the workspace that was created
     """
-    create_work_space_cmd = (getCryosparcProgram() +
-                             ' %screate_empty_workspace("%s", "%s", "%s", "%s", "%s")%s '
-                             % ("'", projectName, str(getCryosparcUser(userId=False)),
-                                "None", str(workspaceTitle),
-                                str(workspaceComment), "'"))
-    return runCmd(create_work_space_cmd, printCmd=False)
+    return runCryosparcCmd('create_empty_workspace', str(projectName),
+                           str(getCryosparcUser(userId=False)), "None",
+                           str(workspaceTitle), str(workspaceComment))
 
 
-def doImportParticlesStar(protocol):
+def getFilesHash(files, *params):
+    """ Hash that identifies the content of the given files (by real path,
+    size and modification time) together with some extra parameters """
+    sha = hashlib.sha1()
+    for fn in sorted(os.path.realpath(fn.split(':')[0]) for fn in files):
+        stat = os.stat(fn)
+        sha.update(('%s|%d|%d\n' % (fn, stat.st_size,
+                                    stat.st_mtime_ns)).encode())
+    for param in params:
+        sha.update(('%s\n' % param).encode())
+    return sha.hexdigest()
+
+
+IMPORT_FAILURE_MESSAGE = ("An error occurred importing the %s. "
+                          "Please, go to cryoSPARC software for more "
+                          "details.")
+
+
+def doImportParticlesStar(protocol, wait=True):
     """
     do_import_particles_star(puid, wuid, uuid, abs_star_path,
                              abs_blob_path=None, psize_A=None)
-    returns the new uid of the job that was created
+    returns the new uid of the job that was created. If wait is False,
+    the job is returned as soon as it is queued
     """
     print(pwutils.yellowStr("Importing particles..."), flush=True)
     className = "import_particles"
@@ -456,17 +639,62 @@ def doImportParticlesStar(protocol):
     import_particles = enqueueJob(className, protocol.projectName, protocol.workSpaceName,
                                   str(params).replace('\'', '"'), '{}', protocol.lane)
 
-    waitForCryosparc(protocol.projectName.get(), import_particles.get(),
-                     "An error occurred importing particles. "
-                     "Please, go to cryoSPARC software for more "
-                     "details.")
+    if wait:
+        waitForCryosparc(protocol.projectName.get(), import_particles.get(),
+                         IMPORT_FAILURE_MESSAGE % 'particles')
 
     return import_particles
 
 
-def doImportVolumes(protocol, refVolumePath, refVolume, volType, msg):
+def canUseCryosparcTools():
+    """ Whether the credentials used by cryosparc-tools (the user password)
+    are configured, so external jobs can be created """
+    return Plugin.getUser() is not None and Plugin.getUserPassword() is not None
+
+
+def doImportParticlesCs(protocol, csFile):
     """
-    :return:
+    Import the particles of a .cs file (see writeSetOfParticlesCs) as the
+    imported_particles output of an external job. Unlike import_particles
+    (doImportParticlesStar), cryoSPARC does not parse any file: the fields
+    are saved as they are, with new uids. The stack paths are relative to
+    the Scipion project.
+    :return: the job (already completed)
+    """
+    from cryosparc.dataset import Dataset
+    from pyworkflow.object import String
+
+    print(pwutils.yellowStr("Importing particles..."), flush=True)
+    particles = Dataset.load(csFile)
+    slots = sorted({field.split('/')[0] for field in particles.fields()
+                    if '/' in field})
+
+    project = getCryosparcTools().find_project(str(protocol.projectName))
+    job = project.create_external_job(str(protocol.workSpaceName),
+                                      "Import particles")
+    output = job.add_output(type="particle", name="imported_particles",
+                            slots=slots, title="Imported particles",
+                            alloc=len(particles))
+    outputFields = set(output.fields())
+    for field in particles.fields():
+        if field != 'uid' and field in outputFields:
+            output[field] = particles[field]
+    stacks, stackIds = np.unique(particles['blob/path'], return_inverse=True)
+    stacks = np.array([os.path.abspath(stack.decode() if isinstance(stack, bytes)
+                                       else stack) for stack in stacks],
+                      dtype=object)
+    output['blob/path'] = stacks[stackIds.ravel()]
+
+    with job.run():
+        job.save_output("imported_particles", output)
+
+    return String(job.uid)
+
+
+def doImportVolumes(protocol, refVolumePath, refVolume, volType, msg, wait=True):
+    """
+    :param wait: wait for the import job to finish
+    :return: the import job
     """
     logger.info(pwutils.yellowStr(msg))
     className = "import_volumes"
@@ -479,16 +707,14 @@ def doImportVolumes(protocol, refVolumePath, refVolume, volType, msg):
                                 str(params).replace('\'', '"'), '{}',
                                 protocol.lane)
 
-    waitForCryosparc(protocol.projectName.get(), importedVolume.get(),
-                     "An error occurred importing the volume. "
-                     "Please, go to cryoSPARC software for more "
-                     "details."
-                     )
+    if wait:
+        waitForCryosparc(protocol.projectName.get(), importedVolume.get(),
+                         IMPORT_FAILURE_MESSAGE % 'volume')
 
     return importedVolume
 
 
-def doImportMicrographs(protocol):
+def doImportMicrographs(protocol, wait=True):
     print(pwutils.yellowStr("Importing micrographs..."), flush=True)
     className = "import_micrographs"
     micrographs = protocol._getInputMicrographs()
@@ -515,25 +741,135 @@ def doImportMicrographs(protocol):
     import_particles = enqueueJob(className, protocol.projectName, protocol.workSpaceName,
                                   str(params).replace('\'', '"'), '{}', protocol.lane)
 
-    waitForCryosparc(protocol.projectName.get(), import_particles.get(),
-                     "An error occurred importing particles. "
-                     "Please, go to cryoSPARC software for more "
-                     "details.")
+    if wait:
+        waitForCryosparc(protocol.projectName.get(), import_particles.get(),
+                         IMPORT_FAILURE_MESSAGE % 'micrographs')
 
     return import_particles
 
 
+def _literal(value):
+    """ Commands params and connections are usually built as strings
+    (json like dictionaries), convert them into python objects """
+    if isinstance(value, str):
+        return ast.literal_eval(value)
+    return value
+
+
 def doJob(jobType, projectName, workSpaceName, params, input_group_connect):
     """
     do_job(job_type, puid='P1', wuid='W1', uuid='devuser', params={},
            input_group_connects={})
     """
-    do_job_cmd = (getCryosparcProgram() +
-                  ' %sdo_job("%s","%s","%s", "%s", %s, %s)%s' %
-                  ("'", jobType, projectName, workSpaceName, getCryosparcUser(),
-                   params, input_group_connect, "'"))
+    return runCryosparcCmd('do_job', jobType, str(projectName),
+                           str(workSpaceName), getCryosparcUser(),
+                           _literal(params), _literal(input_group_connect),
+                           printCmd=True)
+
+
+class JobBuilder:
+    """
+    Assemble a cryoSPARC job (params, input group and result connections,
+    lane and GPUs) and submit it. From cryoSPARC v4 the group connections
+    are passed to make_job and the result connections are sent together in
+    a single request. Older versions connect the inputs one command at a
+    time. The job is queued once all its inputs are connected.
+    """
+    def __init__(self, jobType, projectName, workSpaceName, params=None,
+                 input_group_connect=None, lane=None, gpusToUse=False):
+        self.jobType = jobType
+        self.projectName = str(projectName)
+        self.workSpaceName = str(workSpaceName)
+        self.params = _literal(params) or {}
+        self.inputGroups = _literal(input_group_connect) or {}
+        self.groups = {}
+        self.results = []
+        self.lane = lane
+        self.gpusToUse = gpusToUse
+
+    def connectGroup(self, group, sources):
+        """ Connect output groups (e.g. J12.imported_particles) to an
+        input group of the job """
+        if not isinstance(sources, (list, tuple)):
+            sources = [sources]
+        self.groups.setdefault(group, []).extend(str(s) for s in sources)
+        return self
+
+    def connectResult(self, result, source):
+        """ Connect an output result (e.g. J12.particles.alignments3D) to an
+        input slot (e.g. particles.alignments3D) of the job """
+        self.results.append((result, str(source)))
+        return self
+
+    def _makeJobArgs(self, user, input_group_connect):
+        cryosparcVersion = parse_version(getCryosparcVersion())
+        # Create a compatible job to versions >= v3.0.X < v4_3_1
+        if parse_version(V3_0_0) <= cryosparcVersion < parse_version(V4_3_1):
+            return (self.jobType, self.projectName, self.workSpaceName, user,
+                    "None", "None", self.params, input_group_connect, "False", 0)
+        # Create a compatible job to versions >= v4_3_1
+        return (self.jobType, self.projectName, self.workSpaceName, user,
+                "None", "None", "None", self.params, input_group_connect,
+                "False", 0)
+
+    def _enqueueJobArgs(self, jobId, user):
+        cryosparcVersion = parse_version(getCryosparcVersion())
+        no_check_inputs_ready = "False"
+        standaloneInstallation = isCryosparcStandalone()
+        if standaloneInstallation:
+            hostname = getCryosparcEnvInformation('master_hostname')
+        if cryosparcVersion <= parse_version(V3_3_2):
+            if standaloneInstallation:
+                return (self.projectName, jobId, self.lane, hostname,
+                        self.gpusToUse, no_check_inputs_ready)
+            return self.projectName, jobId, self.lane
+        if standaloneInstallation:
+            return (self.projectName, jobId, self.lane, user, hostname,
+                    self.gpusToUse, no_check_inputs_ready)
+        return self.projectName, jobId, self.lane, user
+
+    def submit(self):
+        """ Create, connect and queue the job
+        :returns: the job uid (as a String) """
+        from pyworkflow.object import String
+
+        user = getCryosparcUser()
+        batch = parse_version(getCryosparcVersion()) >= parse_version(V4_0_0)
+        groups = dict(self.inputGroups)
+        if batch:
+            for group, sources in self.groups.items():
+                inputSources = groups.get(group, [])
+                if not isinstance(inputSources, list):
+                    inputSources = [inputSources]
+                groups[group] = inputSources + sources
+
+        exitCode, cmdOutput = runCryosparcCmd('make_job',
+                                              *self._makeJobArgs(user, groups),
+                                              printCmd=True)
+        # Extract the jobId
+        jobId = cmdOutput.split()[-1]
+        logger.info(pwutils.greenStr("Got %s for JobId" % jobId))
+
+        calls = []
+        if not batch:
+            for group, sources in self.groups.items():
+                for source in sources:
+                    calls.append(('job_connect_group', (self.projectName, source,
+                                                        "%s.%s" % (jobId, group))))
+        for result, source in self.results:
+            calls.append(('job_connect_result', (self.projectName, source,
+                                                 "%s.%s" % (jobId, result))))
+        if batch:
+            cryosparcBatch(calls, printCmd=True)
+        else:
+            for method, args in calls:
+                runCryosparcCmd(method, *args, printCmd=True)
+
+        # Queue the job, not in the batch: its calls may run in any order
+        runCryosparcCmd('enqueue_job', *self._enqueueJobArgs(jobId, user),
+                        printCmd=True)
 
-    return runCmd(do_job_cmd)
+        return String(jobId)
 
 
 def enqueueJob(jobType, projectName, workSpaceName, params, input_group_connect,
@@ -542,126 +878,23 @@ def enqueueJob(jobType, projectName, workSpaceName, params, input_group_connect,
     make_job(job_type, project_uid, workspace_uid, user_id,
              created_by_job_uid=None, params={}, input_group_connects={})
     """
-    from pyworkflow.object import String
-
-    cryosparcVersion = getCryosparcVersion()
-    standaloneInstallation = isCryosparcStandalone()
-
-    # Create a compatible job to versions < v2.14.X                DEPRECATED
-    # make_job_cmd = (getCryosparcProgram() +
-    #                 ' %smake_job("%s","%s","%s", "%s", "None", %s, %s)%s' %
-    #                 ("'", jobType, projectName, workSpaceName, getCryosparcUser(),
-    #                  params, input_group_connect, "'"))
-
-    # Create a compatible job to versions >= v2.14.X               DEPRECATED
-    # if parse_version(cryosparcVersion) >= parse_version(V2_14_0):
-    #     make_job_cmd = (getCryosparcProgram() +
-    #                     ' %smake_job("%s","%s","%s", "%s", "None", "None", %s, %s)%s' %
-    #                     ("'", jobType, projectName, workSpaceName,
-    #                      getCryosparcUser(),
-    #                      params, input_group_connect, "'"))
-
-    # Create a compatible job to versions >= v3.0.X < v4_3_1
-    if parse_version(V3_0_0) <= parse_version(cryosparcVersion) < parse_version(V4_3_1):
-        make_job_cmd = (getCryosparcProgram() +
-                        ' %smake_job("%s","%s","%s", "%s", "None", "None", %s, %s, "False", 0)%s' %
-                        ("'", jobType, projectName, workSpaceName,
-                         getCryosparcUser(),
-                         params, input_group_connect, "'"))
-
-    # Create a compatible job to versions >= v4_3_1
-    elif parse_version(cryosparcVersion) >= parse_version(V4_3_1):
-        make_job_cmd = (getCryosparcProgram() +
-                        ' %smake_job("%s","%s","%s", "%s", "None", "None", "None", %s, %s, "False", 0)%s' %
-                        ("'", jobType, projectName, workSpaceName,
-                         getCryosparcUser(),
-                         params, input_group_connect, "'"))
-
-    exitCode, cmdOutput = runCmd(make_job_cmd)
-
-    # Extract the jobId
-    jobId = String(cmdOutput.split()[-1])
+    jobBuilder = JobBuilder(jobType, projectName, workSpaceName, params,
+                            input_group_connect, lane, gpusToUse)
 
     if group_connect is not None:
         for key, valuesList in group_connect.items():
-            for value in valuesList:
-                job_connect_group = (getCryosparcProgram() +
-                                     ' %sjob_connect_group("%s", "%s", "%s")%s' %
-                                     ("'", projectName, value, (str(jobId) + "." + key), "'"))
-                runCmd(job_connect_group, printCmd=False)
+            jobBuilder.connectGroup(key, valuesList)
 
     if result_connect is not None:
         for key, value in result_connect.items():
-            job_connect_group = (getCryosparcProgram() +
-                                 ' %sjob_connect_result("%s", "%s", "%s")%s' %
-                                 ("'", projectName, value, (str(jobId) + "." + key), "'"))
-            runCmd(job_connect_group, printCmd=True)
-
-    logger.info(pwutils.greenStr("Got %s for JobId" % jobId))
-
-    # Queue the job  DEPRECATED
-    # if parse_version(cryosparcVersion) < parse_version(V2_13_0):
-    #     enqueue_job_cmd = (getCryosparcProgram() +
-    #                        ' %senqueue_job("%s","%s","%s")%s' %
-    #                        ("'", projectName, jobId,
-    #                         lane, "'"))
-    #
-    # elif parse_version(cryosparcVersion) <= parse_version(V2_15_0):
-    #     if standaloneInstallation:
-    #         hostname = getCryosparcEnvInformation('master_hostname')
-    #         if gpusToUse:
-    #             gpusToUse = str(gpusToUse)
-    #         enqueue_job_cmd = (getCryosparcProgram() +
-    #                            ' %senqueue_job("%s","%s","%s", "%s", %s)%s' %
-    #                            ("'", projectName, jobId,
-    #                             lane, hostname, gpusToUse, "'"))
-    #     else:
-    #         enqueue_job_cmd = (getCryosparcProgram() +
-    #                            ' %senqueue_job("%s","%s","%s")%s' %
-    #                            ("'", projectName, jobId, lane, "'"))
-
-    if parse_version(cryosparcVersion) <= parse_version(V3_3_2):
-        if standaloneInstallation:
-            hostname = getCryosparcEnvInformation('master_hostname')
-            if gpusToUse:
-                gpusToUse = str(gpusToUse)
-            no_check_inputs_ready = False
-            enqueue_job_cmd = (getCryosparcProgram() +
-                               ' %senqueue_job("%s","%s","%s", "%s", %s, "%s")%s' %
-                               ("'", projectName, jobId,
-                                lane, hostname, gpusToUse,
-                                no_check_inputs_ready, "'"))
-        else:
-            enqueue_job_cmd = (getCryosparcProgram() +
-                               ' %senqueue_job("%s","%s","%s")%s' %
-                               ("'", projectName, jobId,
-                                lane, "'"))
-    elif parse_version(cryosparcVersion) >= parse_version(V4_0_0):
-        user = getCryosparcUser()
-        if standaloneInstallation:
-            hostname = getCryosparcEnvInformation('master_hostname')
-            if gpusToUse:
-                gpusToUse = str(gpusToUse)
-            no_check_inputs_ready = False
-            enqueue_job_cmd = (getCryosparcProgram() +
-                               ' %senqueue_job("%s","%s","%s", "%s", "%s", %s, "%s")%s' %
-                               ("'", projectName, jobId,
-                                lane, user, hostname, gpusToUse,
-                                no_check_inputs_ready, "'"))
-        else:
-            enqueue_job_cmd = (getCryosparcProgram() +
-                               ' %senqueue_job("%s","%s","%s","%s")%s' %
-                               ("'", projectName, jobId,
-                                lane, user, "'"))
-    runCmd(enqueue_job_cmd)
+            jobBuilder.connectResult(key, value)
 
-    return jobId
+    return jobBuilder.submit()
 
 
-def customLatentTrajectory(latentsPoints, projectId, workspaceId, trainingJobId):
-    """Output the trajectory as a new output in CryoSPARC.
-       The resulting trajectory may be used as input to the 3D Flex Generator job
-       to generate a volume series along the trajectory."""
+def getCryosparcTools():
+    """ cryosparc-tools client of the cryoSPARC instance, used to create
+    external jobs """
     from cryosparc.tools import CryoSPARC
 
     credentials = _getCredentials()
@@ -670,13 +903,46 @@ def customLatentTrajectory(latentsPoints, projectId, workspaceId, trainingJobId)
         raise Exception("Error obtaining cryoSPARC's credentials: %s" % credentials[1])
 
     credentials = credentials[1]
-    cs = CryoSPARC(license=credentials['license'],
-                   host=credentials['host'],
-                   base_port=int(credentials['base_port']),
-                   email=credentials['email'],
-                   password=credentials['password'])
+    return CryoSPARC(license=credentials['license'],
+                     host=credentials['host'],
+                     base_port=int(credentials['base_port']),
+                     email=credentials['email'],
+                     password=credentials['password'])
+
+
+def createParticlesSubset(projectName, workSpaceName, sourceGroup, uids,
+                          title="Scipion subset"):
+    """
+    Create a subset of the particles of an output group in cryoSPARC,
+    without importing them again. The subset is the 'particles' output of
+    an external job, that only stores the uids of the selected particles:
+    the rest of their fields are passed through from the source group.
+    :param sourceGroup: output group with the particles ('Jxx.group')
+    :param uids: cryoSPARC uids of the selected particles
+    :return: the uid of the external job
+    """
+    from cryosparc.dataset import Dataset
+
+    sourceJob, sourceOutput = sourceGroup.split('.', 1)
+    project = getCryosparcTools().find_project(str(projectName))
+    job = project.create_external_job(str(workSpaceName), title)
+    job.connect("particles", sourceJob, sourceOutput)
+    job.add_output(type="particle", name="particles", slots=[],
+                   passthrough="particles", title="Particles")
+
+    subset = Dataset.allocate(len(uids))
+    subset['uid'] = uids
+    with job.run():
+        job.save_output("particles", subset)
 
-    project = cs.find_project(projectId)
+    return job.uid
+
+
+def customLatentTrajectory(latentsPoints, projectId, workspaceId, trainingJobId):
+    """Output the trajectory as a new output in CryoSPARC.
+       The resulting trajectory may be used as input to the 3D Flex Generator job
+       to generate a volume series along the trajectory."""
+    project = getCryosparcTools().find_project(projectId)
     particles = project.find_job(trainingJobId).load_output("particles")
     numComponents = int(len([x for x in particles.fields() if "components_mode" in x]) / 2)
     slot_spec = [{"dtype": "components", "prefix": f"components_mode_{k}", "required": True} for k in
@@ -771,6 +1037,147 @@ def runCmd(cmd, printCmd=True):
     return exitCode, cmdOutput.split('\n')[-1]
 
 
+def getCommandClient():
+    """ Get the shared command_core client. It is built from the host and
+    port that get_system_info reports. Returns None when the client can not
+    be created, in that case the commands go through `cryosparcm cli` """
+    global _commandClient, _commandClientRetry
+    if _commandClient is None and time.time() >= _commandClientRetry:
+        try:
+            systemInfo = ast.literal_eval(
+                runCmd(getCryosparcProgram() + " 'get_system_info()'",
+                       printCmd=False)[1])
+            _commandClient = CommandClient(systemInfo['master_hostname'],
+                                           systemInfo['port_command_core'],
+                                           _getLicenceFromFile())
+        except Exception as e:
+            logger.debug("Couldn't create the cryoSPARC command client, "
+                         "falling back to cryosparcm cli: %s" % e)
+            _commandClientRetry = time.time() + COMMAND_CLIENT_RETRY_DELAY
+    return _commandClient
+
+
+def resetCommandClient():
+    """ Drop the shared command_core client. It will be created again
+    on the next command """
+    global _commandClient, _commandClientRetry
+    if _commandClient is not None:
+        _commandClient.close()
+    _commandClient = None
+    _commandClientRetry = 0
+    # cryoSPARC may have been restarted
+    clearEnvCache()
+
+
+def _formatCliArg(value):
+    """ Format a command argument the way `cryosparcm cli` expects it """
+    if isinstance(value, str):
+        return '"%s"' % value
+    if isinstance(value, (dict, list, tuple)):
+        return str(value).replace('\'', '"')
+    return str(value)
+
+
+def cliExpression(method, *args):
+    """ Return the python expression that `cryosparcm cli` evaluates to
+    run a command_core method """
+    return '%s(%s)' % (method, ', '.join(_formatCliArg(arg) for arg in args))
+
+
+def _callCommandClient(method, args, printCmd):
+    """ Try to run the command through the shared command client.
+    Returns a tuple (done, result) """
+    client = getCommandClient()
+    if client is None:
+        return False, None
+
+    msg = "Running: %s" % cliExpression(method, *args)
+    if printCmd:
+        logger.info(pwutils.greenStr(msg))
+    else:
+        logger.debug(pwutils.greenStr(msg))
+
+    try:
+        return True, client.call(method, *args)
+    except requests.RequestException as e:
+        logger.warning("cryoSPARC command client failed (%s), retrying "
+                       "with cryosparcm cli" % e)
+        resetCommandClient()
+        return False, None
+
+
+def runCryosparcCmd(method, *args, printCmd=False):
+    """ Run a cryoSPARC command_core method. The persistent command client
+    is used when available, `cryosparcm cli` otherwise.
+    :returns: a tuple (exitCode, output) as runCmd does, where output is
+              the result printed the same way `cryosparcm cli` prints it"""
+    done, result = _callCommandClient(method, args, printCmd)
+    if done:
+        return 0, str(result).split('\n')[-1]
+
+    return runCmd(getCryosparcProgram() + " '%s'" % cliExpression(method, *args),
+                  printCmd=printCmd)
+
+
+def cryosparcCall(method, *args, printCmd=False):
+    """ Run a cryoSPARC command_core method and return its result as a
+    python object """
+    done, result = _callCommandClient(method, args, printCmd)
+    if done:
+        return result
+
+    output = runCmd(getCryosparcProgram() + " '%s'" % cliExpression(method, *args),
+                    printCmd=printCmd)[1]
+    try:
+        return ast.literal_eval(output)
+    except (ValueError, SyntaxError):
+        return output
+
+
+def _isRequestUnsent(error):
+    """ Whether a command client request failed before reaching
+    command_core, so none of its calls was run """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def cryosparcBatch(calls, printCmd=False):
+    """ Run several independent command_core methods, in a single request
+    if possible, one by one otherwise. The calls that already succeeded in
+    the batch request are not run again.
+    :param calls: list of (method, args) tuples
+    :returns: the list of results """
+    results = {}  # position -> result of the calls already run
+    client = getCommandClient()
+    if client is not None and calls:
+        for method, args in calls:
+            msg = "Running: %s" % cliExpression(method, *args)
+            if printCmd:
+                logger.info(pwutils.greenStr(msg))
+            else:
+                logger.debug(pwutils.greenStr(msg))
+        try:
+            return client.callBatch(calls)
+        except CommandBatchError as e:
+            logger.debug(e)
+            results = e.results
+        except ValueError as e:
+            logger.debug(e)
+        except requests.RequestException as e:
+            resetCommandClient()
+            if not _isRequestUnsent(e):
+                # Some of the calls may have been run
+                raise
+            logger.warning("cryoSPARC command client failed (%s), retrying "
+                           "with cryosparcm cli" % e)
+
+    return [results[position] if position in results
+            else cryosparcCall(method, *args, printCmd=printCmd)
+            for position, (method, args) in enumerate(calls)]
+
+
 def waitForCryosparc(projectName, jobId, failureMessage, protocol=None):
     """ Waits for cryosparc to finish or fail a job
     :parameter projectName: Cryosparc project name
@@ -779,37 +1186,32 @@ def waitForCryosparc(projectName, jobId, failureMessage, protocol=None):
     :returns job Status
     :raises Exception when parsing cryosparc's output looks wrong"""
 
-    # While is needed here, cause waitJob has a timeout of 5 secs.
+    # waitJob blocks on cryoSPARC's side until the job finishes or
+    # WAIT_JOB_TIMEOUT expires, so the loop returns as soon as the job stops
+    errors = 0
     while True:
         try:
             status = getJobStatus(projectName, jobId)
-            if status not in STOP_STATUSES:
-                waitJob(projectName, jobId)
-                if protocol is not None:
-                    jobStreamLog = getJobStreamlog(projectName, jobId)
-                    jobStreamLogList = eval(jobStreamLog[1])
-                    jobLogLastLine = protocol.getLogLine()
-                    lenLog = len(jobStreamLogList)
-                    if lenLog > jobLogLastLine:
-                        protocol.setLogLine(lenLog)
-                        for line in range(jobLogLastLine, lenLog):
-                            logDict = jobStreamLogList[line]
-                            if logDict['type'] == 'text' and 'text' in logDict and logDict['text']:
-                                logger.info(logDict['text'])
-                    else:
-                        jobLogLastLine = len(jobStreamLogList) - 1
-                        while jobLogLastLine:
-                            logDict = jobStreamLogList[jobLogLastLine]
-                            if logDict['type'] == 'text' and 'text' in logDict and logDict['text']:
-                                logger.info(logDict['text'])
-                                break
-                            jobLogLastLine -= 1
-            else:
+            if status in STOP_STATUSES:
                 break
+            waitJob(projectName, jobId, timeout=WAIT_JOB_TIMEOUT)
+            if protocol is not None:
+                streamLog = protocol.getJobStreamLog(jobId)
+                newEvents = streamLog.update()
+                # Skip the events printed before the protocol was resumed
+                skip = protocol.getLogLine() - (len(streamLog) - len(newEvents))
+                for event in newEvents[max(skip, 0):]:
+                    if event.get('type') == 'text' and event.get('text'):
+                        logger.info(event['text'])
+                protocol.setLogLine(len(streamLog))
+            errors = 0
         except Exception as e:
-            logger.error("Can't query cryoSPARC about the job %s. Maybe it needs a restart ? We'll wait 5 minutes" % jobId, exc_info=e)
-            import time
-            time.sleep(300)  # wait 5 minutes
+            errors += 1
+            delay = _backoffDelay(errors)
+            logger.error("Can't query cryoSPARC about the job %s. Maybe it "
+                         "needs a restart ? We'll retry in %d seconds"
+                         % (jobId, delay), exc_info=e)
+            time.sleep(delay)
 
     if status != STATUS_COMPLETED:
         raise Exception(failureMessage)
@@ -817,15 +1219,28 @@ def waitForCryosparc(projectName, jobId, failureMessage, protocol=None):
     return status
 
 
+def waitForCryosparcJobs(projectName, jobs, protocol=None):
+    """ Waits for several cryosparc jobs that were queued at the same time
+    (e.g. the imports of the protocol inputs)
+    :parameter projectName: Cryosparc project name
+    :parameter jobs: dictionary with the failure message of each job id
+    :raises Exception with the failure message of the first failed job"""
+    for jobId, failureMessage in jobs.items():
+        waitForCryosparc(projectName, jobId, failureMessage, protocol)
+
+
+def _backoffDelay(attempt):
+    """ Exponential backoff delay (seconds) with jitter for the given
+    failed attempt, bounded by WAIT_JOB_MAX_BACKOFF """
+    delay = min(WAIT_JOB_MAX_BACKOFF, WAIT_JOB_BACKOFF * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
 def getJobStatus(projectName, job):
     """
     Return the job status
     """
-    get_job_status_cmd = (getCryosparcProgram() +
-                          ' %sget_job_status("%s", "%s")%s'
-                          % ("'", projectName, job, "'"))
-
-    status = runCmd(get_job_status_cmd, printCmd=False)
+    status = runCryosparcCmd('get_job_status', str(projectName), str(job))
     return status[-1]
 
 
@@ -833,23 +1248,45 @@ def getJob(projectName, job):
     """
        Return the job
        """
-    get_job_status_cmd = (getCryosparcProgram() +
-                          ' %sget_job("%s", "%s")%s'
-                          % ("'", projectName, job, "'"))
-
-    job = runCmd(get_job_status_cmd, printCmd=False)
+    job = runCryosparcCmd('get_job', str(projectName), str(job))
     return job
 
 
+def getJobOutputGroup(projectName, job, groupName):
+    """
+    Return an output group (dictionary with its name, type, number of
+    items...) of a completed job, or None if the job is not completed or
+    has not that output
+    """
+    job = cryosparcCall('get_job', str(projectName), str(job), 'status',
+                        'output_result_groups')
+    if not isinstance(job, dict) or job.get('status') != STATUS_COMPLETED:
+        return None
+    for group in job.get('output_result_groups', []):
+        if group.get('name') == groupName:
+            return group
+    return None
+
+
+def getJobOutputFile(projectName, job, groupName, resultName='blob'):
+    """
+    Path (relative to the project folder) of the last .cs file written for
+    a result of an output group of a job, or None if there is no such file
+    """
+    results = cryosparcCall('get_job', str(projectName), str(job),
+                            'output_results').get('output_results', [])
+    for result in results:
+        if (result.get('group_name') == groupName and
+                result.get('name') == resultName and result.get('metafiles')):
+            return result['metafiles'][-1]
+    return None
+
+
 def getJobLog(projectName, job):
     """
        Get the full contents of the given job's standard output log
        """
-    get_job_log_cmd = (getCryosparcProgram() +
-                          ' %sget_job_log("%s", "%s")%s'
-                          % ("'", projectName, job, "'"))
-
-    logStr = runCmd(get_job_log_cmd, printCmd=False)
+    logStr = runCryosparcCmd('get_job_log', str(projectName), str(job))
     return logStr
 
 
@@ -857,30 +1294,24 @@ def getJobStreamlog(projectName, job):
     """
        Get a list of dictionaries representing the given job's event log
        """
-    get_job_stream_log_cmd = (getCryosparcProgram() +
-                          ' %sget_job_streamlog("%s", "%s")%s'
-                          % ("'", projectName, job, "'"))
-
-    logList = runCmd(get_job_stream_log_cmd, printCmd=False)
+    logList = runCryosparcCmd('get_job_streamlog', str(projectName), str(job))
     return logList
 
 
-def waitJob(projectName, job):
+def waitJob(projectName, job, timeout=None):
     """
     Wait while the job not finished
     """
-    wait_job_cmd = (getCryosparcProgram() +
-                    ' %swait_job_complete("%s", "%s")%s'
-                    % ("'", projectName, job, "'"))
-    runCmd(wait_job_cmd, printCmd=False)
+    args = [str(projectName), str(job)]
+    if timeout is not None:
+        args.append(timeout)
+    runCryosparcCmd('wait_job_complete', *args)
 
 
 def get_job_streamlog(projectName, job, fileName):
-    get_job_streamlog_cmd = (getCryosparcProgram() +
-                             ' %sget_job_streamlog("%s", "%s")%s%s'
-                             % ("'", projectName, job, "'", ">" + fileName))
-
-    runCmd(get_job_streamlog_cmd, printCmd=False)
+    streamLog = runCryosparcCmd('get_job_streamlog', str(projectName), str(job))[1]
+    with open(fileName, 'w') as f:
+        f.write(streamLog + '\n')
 
 
 def killJob(projectName, job):
@@ -889,10 +1320,7 @@ def killJob(projectName, job):
     :param projectName: the uid of the project that contains the job to kill
     :param job: the uid of the job to kill
     """
-    kill_job_cmd = (getCryosparcProgram() +
-                    ' %skill_job("%s", "%s")%s'
-                    % ("'", projectName, job, "'"))
-    runCmd(kill_job_cmd, printCmd=True)
+    runCryosparcCmd('kill_job', str(projectName), str(job), printCmd=True)
 
 
 def clearJob(projectName, job):
@@ -903,10 +1331,7 @@ def clearJob(projectName, job):
         :param job: the uid of the job to clear
         ** IMPORTANT: This method can be launch only if the job is queued
         """
-    clear_job_cmd = (getCryosparcProgram() +
-                     ' %sclear_job("%s", "%s")%s'
-                     % ("'", projectName, job, "'"))
-    runCmd(clear_job_cmd, printCmd=False)
+    runCryosparcCmd('clear_job', str(projectName), str(job))
 
 
 def clearIntermediateResults(projectName, job, wait=3):
@@ -916,14 +1341,12 @@ def clearIntermediateResults(projectName, job, wait=3):
     :param job: the uid of the job to clear
     """
     logger.info(pwutils.yellowStr("Removing intermediate results..."))
-    clear_int_results_cmd = (getCryosparcProgram() +
-                             ' %sclear_intermediate_results("%s", "%s")%s'
-                             % ("'", projectName, job, "'"))
-    runCmd(clear_int_results_cmd, printCmd=False)
+    runCryosparcCmd('clear_intermediate_results', str(projectName), str(job))
     # wait a delay in order to delete intermediate results correctly
     time.sleep(wait)
 
 
+@envCached
 def getSystemInfo():
     """
     Returns system-related information related to the cryosparc app
@@ -940,24 +1363,22 @@ def getSystemInfo():
         'version' : get_running_version(),
     }
     """
-    system_info_cmd = (getCryosparcProgram() + " 'get_system_info()'")
-    return runCmd(system_info_cmd, printCmd=False)
+    return runCryosparcCmd('get_system_info')
 
 
+@envCached
 def userExist(email):
     """
     Return if an user exist into cryoSPARC
     """
-    getUser_cmd = (getCryosparcProgram() + ' %sUserExists("%s")%s' % ("'", email, "'"))
-    return runCmd(getUser_cmd, printCmd=False)[1] == 'True'
+    return runCryosparcCmd('UserExists', str(email))[1] == 'True'
 
 
+@envCached
 def getUserId(email):
     """Get the user Id taking into account the user email"""
-    import ast
-    getUser_cmd = (getCryosparcProgram() + ' %sGetUser("%s")%s' % ("'", email, "'"))
-    user = runCmd(getUser_cmd, printCmd=False)
-    return ast.literal_eval(user[1])['_id']
+    user = cryosparcCall('GetUser', str(email))
+    return user['_id']
 
 
 def _getCredentials():
@@ -997,9 +1418,7 @@ def getSchedulerLanes():
     csValidate = cryosparcValidate()
     if not csValidate:
         try:
-            lanes_info_cmd = (getCryosparcProgram() + " 'get_scheduler_lanes()'")
-            _csLanes = runCmd(lanes_info_cmd, printCmd=False)[1]
-            lanes_dict_list = eval(_csLanes)
+            lanes_dict_list = _getSchedulerLanes()
             _csLanes = []
             for lanes in lanes_dict_list:
                 _csLanes.append(lanes.get('name'))
@@ -1013,6 +1432,11 @@ def getSchedulerLanes():
     return _csLanes, _defaultLane
 
 
+@envCached
+def _getSchedulerLanes():
+    return cryosparcCall('get_scheduler_lanes')
+
+
 def addComputeSectionParams(form, allowMultipleGPUs=True, needGPU=True):
     """
     Add the compute settings section
@@ -1146,30 +1570,237 @@ def fixVolume(paths):
         paths = [paths]
     for path in paths:
         ccp4header = Ccp4Header(path, readHeader=True)
+        if ccp4header.getISPG() == 1:
+            continue  # nothing to fix: the harvested file stays shared
+        # The header is written in place: never modify the cryoSPARC file
+        unshareFile(path)
         ccp4header.setISPG(1)
         ccp4header.writeHeader()
 
 
-def copyFiles(src, dst, files=None):
+HARVEST_HARDLINK = 'hardlink'
+HARVEST_REFLINK = 'reflink'
+HARVEST_SYMLINK = 'symlink'
+HARVEST_COPY = 'copy'
+
+_FICLONE = 0x40049409  # Linux ioctl to clone a file (reflink)
+_COPY_BUFFER = 1024 * 1024
+
+
+def useHarvestSymlinks():
     """
-    Copy a list of files from src to dst. If files is None, all files of src are
-    copied to dst
+    Whether the cryoSPARC output files that can not be hard linked or
+    reflinked (e.g. they are in another filesystem) are symlinked instead of
+    copied. If the environment variable CRYOSPARC_HARVEST_SYMLINKS isn't
+    present, the files are symlinked
+    """
+    return os.environ.get(CRYOSPARC_HARVEST_SYMLINKS, 'True') == 'True'
+
+
+def getFileChecksum(path):
+    """ sha1 checksum of a file """
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_COPY_BUFFER), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _reflink(src, dst):
+    import fcntl  # not available in all the platforms
+    try:
+        with open(src, 'rb') as srcFile, open(dst, 'wb') as dstFile:
+            fcntl.ioctl(dstFile.fileno(), _FICLONE, srcFile.fileno())
+    except OSError:
+        os.remove(dst)
+        raise
+
+
+def _copyFile(src, dst):
+    """ Copy a file verifying the checksum of the copy """
+    checksum = hashlib.sha1()
+    tmpDst = '%s.%d.%d.tmp' % (dst, os.getpid(), threading.get_ident())
+    with open(src, 'rb') as srcFile, open(tmpDst, 'wb') as dstFile:
+        for chunk in iter(lambda: srcFile.read(_COPY_BUFFER), b''):
+            checksum.update(chunk)
+            dstFile.write(chunk)
+    shutil.copystat(src, tmpDst)
+    if getFileChecksum(tmpDst) != checksum.hexdigest():
+        os.remove(tmpDst)
+        raise IOError("Checksum mismatch copying %s to %s" % (src, dst))
+    os.replace(tmpDst, dst)
+
+
+def harvestFile(src, dst, symlink=None):
+    """
+    Make a cryoSPARC output file available in the Scipion project without
+    duplicating its data when possible. The file is hard linked or reflinked
+    (same filesystem), symlinked (if allowed) or, as a last resort, copied.
+    :param src: cryoSPARC file
+    :param dst: destiny file path
+    :param symlink: allow symlinks (useHarvestSymlinks() by default)
+    :return: the method used (HARVEST_HARDLINK, HARVEST_REFLINK,
+             HARVEST_SYMLINK or HARVEST_COPY)
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return HARVEST_HARDLINK
+    except OSError:
+        pass
+    try:
+        _reflink(src, dst)
+        return HARVEST_REFLINK
+    except (OSError, ImportError):
+        pass
+    if symlink is None:
+        symlink = useHarvestSymlinks()
+    if symlink:
+        os.symlink(os.path.abspath(src), dst)
+        return HARVEST_SYMLINK
+    _copyFile(src, dst)
+    return HARVEST_COPY
+
+
+def unshareFile(path):
+    """ Replace a harvested file that shares its data with the cryoSPARC
+    file (hard link or symlink) by a private reflink, or a private copy if
+    the filesystem can not reflink, before modifying it """
+    if os.path.islink(path) or os.stat(path).st_nlink > 1:
+        src = os.path.realpath(path)
+        tmpPath = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            _reflink(src, tmpPath)
+        except (OSError, ImportError):
+            _copyFile(src, path)
+        else:
+            os.replace(tmpPath, path)
+
+
+def copyFiles(src, dst, files=None, numberOfWorkers=1):
+    """
+    Harvest a list of files from src to dst (see harvestFile). If files is
+    None, all files of src are harvested. With more than one worker (e.g.
+    the threads of the protocol), the files are harvested in a thread pool,
+    so large copies run in parallel. A pattern without matches is logged
+    and skipped; the rest of the files are harvested
     :param src: source folder path
     :param dst: destiny folder path
-    :param files: a list of files to be copied
+    :param files: a list of files (or glob patterns) relative to src
+    :param numberOfWorkers: maximum number of files harvested at once
     :return:
     """
-    try:
-        if files is None:
-            shutil.copytree(src, dst)
-        else:
-            if isinstance(files, str):
-                files = [files]
-            for file in files:
-                shutil.copy(os.path.join(src, file),
-                            os.path.join(dst, file))
-    except Exception as ex:
-        logger.error("Unable to execute the copy: Files or directory does not exist: ", exc_info=ex)
+    if files is None:
+        files = [os.path.relpath(os.path.join(root, fn), src)
+                 for root, _, fns in os.walk(src) for fn in fns]
+    else:
+        if isinstance(files, str):
+            files = [files]
+        matches = []
+        for file in files:
+            paths = sorted(glob.glob(os.path.join(src, file)))
+            if not paths:
+                logger.warning("Unable to harvest %s: no such file"
+                               % os.path.join(src, file))
+            matches.extend(os.path.relpath(path, src) for path in paths)
+        files = matches
+    if not files:
+        return
+
+    os.makedirs(dst, exist_ok=True)
+    for file in files:
+        os.makedirs(os.path.dirname(os.path.join(dst, file)), exist_ok=True)
+
+    def harvest(file):
+        return harvestFile(os.path.join(src, file), os.path.join(dst, file))
+
+    if numberOfWorkers > 1 and len(files) > 1:
+        with ThreadPoolExecutor(max_workers=min(numberOfWorkers, len(files))) as executor:
+            methods = list(executor.map(harvest, files))
+    else:
+        methods = [harvest(file) for file in files]
+    logger.info("Harvested %d files from %s (%s)"
+                % (len(files), src, ', '.join('%s: %d' % (m, methods.count(m))
+                                              for m in sorted(set(methods)))))
+
+
+class SeriesArchive:
+    """
+    Zip archive with a series of files (e.g. the volume series of 3D
+    variability or 3D flex generator). The files are extracted in process
+    to a folder, one by one and only when they are needed: a file that is
+    already extracted (same size) is never extracted again.
+    """
+    def __init__(self, zipFile, extractFolder):
+        self.zipFile = zipFile
+        self.extractFolder = extractFolder
+        self._infos = None
+
+    def _getInfos(self):
+        if self._infos is None:
+            with zipfile.ZipFile(self.zipFile) as fileZip:
+                self._infos = {info.filename: info for info in fileZip.infolist()
+                               if not info.is_dir()}
+        return self._infos
+
+    def getNames(self):
+        """ Names of the files of the archive """
+        return list(self._getInfos())
+
+    def getPath(self, name):
+        """ Path of a file once extracted (it may not exist yet) """
+        path = os.path.normpath(os.path.join(self.extractFolder, name))
+        if os.path.isabs(name) or not path.startswith(
+                os.path.normpath(self.extractFolder) + os.sep):
+            raise ValueError("Invalid file name %s in %s" % (name, self.zipFile))
+        return path
+
+    def isExtracted(self, name):
+        path = self.getPath(name)
+        return (os.path.exists(path) and
+                os.path.getsize(path) == self._getInfos()[name].file_size)
+
+    def getFile(self, name):
+        """ Path of a file, extracting it if needed """
+        path = self.getPath(name)
+        if not self.isExtracted(name):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Extracted with a temporary name, so a partial file is never
+            # taken as extracted
+            tmpPath = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+            with zipfile.ZipFile(self.zipFile) as fileZip:
+                with fileZip.open(name) as src, open(tmpPath, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(tmpPath, path)
+        return path
+
+    def extract(self, names=None, numberOfWorkers=1):
+        """ Extract some files (all of them by default) """
+        return extractArchives([self], names, numberOfWorkers)
+
+
+def extractArchives(archives, names=None, numberOfWorkers=1):
+    """ Extract the files of several archives in a thread pool (the
+    decompression does not hold the GIL)
+    :param archives: list of SeriesArchive
+    :param names: files to extract from each archive (all by default)
+    :param numberOfWorkers: files extracted at once (e.g. the threads of
+                            the protocol)
+    :returns: the paths of the extracted files
+    """
+    members = [(archive, name) for archive in archives
+               for name in (archive.getNames() if names is None else names)]
+    tasks = [(archive, name) for archive, name in members
+             if not archive.isExtracted(name)]
+    if len(tasks) > 1 and numberOfWorkers > 1:
+        numberOfWorkers = min(numberOfWorkers, len(tasks))
+        with ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+            list(executor.map(lambda task: task[0].getFile(task[1]), tasks))
+    else:
+        for archive, name in tasks:
+            archive.getFile(name)
+    return [archive.getPath(name) for archive, name in members]
 
 
 def matchItemRow(item, row):